@@ -1,212 +1,1898 @@
-import os, io, json, time, base64, logging, tempfile
+import os, io, re, ssl, sys, gzip, html, zlib, json, math, time, wave, array, heapq, base64, random, asyncio, hashlib, logging, importlib, threading, contextvars
+import urllib.parse
 from functools import wraps
+from collections import deque, OrderedDict
+from contextlib import contextmanager, asynccontextmanager
 from abc import ABC, abstractmethod
 from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, Request, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
-import requests
-from PIL import Image, UnidentifiedImageError
-
-from openai import OpenAI
-import google.generativeai as genai
-
 load_dotenv()
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("scribe-api")
 
-def retry_with_backoff(max_retries=3, base_delay=1):
-    def deco(fn):
+class _LazyModule:
+    """Imports the module on first attribute access.
+
+    The SDKs take most of a cold start to import, and /health, the landing page and the sessions routes
+    need none of them, so each one loads only when a route first uses it.
+    """
+    def __init__(self, name):
+        self._name, self._module = name, None
+
+    def __getattr__(self, attr):
+        # Only reached for names the proxy itself doesn't have; the import system's lock covers racing first uses.
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+httpx = _LazyModule("httpx")
+openai = _LazyModule("openai")
+genai = _LazyModule("google.generativeai")
+Image = _LazyModule("PIL.Image")
+pg_native = _LazyModule("pg8000.native")
+pg_errors = _LazyModule("pg8000.exceptions")
+
+# ---------- Retries and deadlines ----------
+# Each request gets a deadline: the client's X-Request-Deadline-Ms (how long it will wait for the answer),
+# else the route's default. Upstream calls take their timeouts from what's left of it, and a retry that
+# couldn't finish in time isn't started, so no work continues for a client that has already given up.
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+ROUTE_DEADLINES = {"/api/transcribe": 15.0, "/api/answer": 30.0, "/api/answer/stream": 60.0, "/api/answer/batch": 120.0,
+                   "/api/sessions/<session_id>/summary": 120.0}
+MAX_DEADLINE = float(os.getenv("MAX_REQUEST_DEADLINE_MS", 300000)) / 1000
+UPSTREAM_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))  # per call, when no deadline is tighter
+
+class DeadlineExceeded(Exception):
+    """The request's deadline has passed, or will before the next upstream call could finish: a 504."""
+
+_DEADLINE = contextvars.ContextVar("request_deadline", default=None)  # time.monotonic() value, or None
+
+def begin_request_deadline(route, header=None):
+    seconds = ROUTE_DEADLINES.get(route)
+    try:
+        if header and float(header) > 0: seconds = min(float(header) / 1000, MAX_DEADLINE)
+    except ValueError:
+        pass
+    _DEADLINE.set(time.monotonic() + seconds if seconds else None)
+
+def time_left(default=None):
+    """Seconds until this request's deadline (0 once it's passed), or `default` when it has none."""
+    deadline = _DEADLINE.get()
+    return default if deadline is None else max(0.0, deadline - time.monotonic())
+
+def call_timeout(cap=UPSTREAM_TIMEOUT):
+    """Timeout for one upstream call: `cap`, cut down to the time left. Raises DeadlineExceeded when none is."""
+    left = time_left()
+    if left is None: return cap
+    if left < 0.1: raise DeadlineExceeded("Request deadline exceeded")
+    return min(cap, left)
+
+# SDK exception classes that mean 429, by name (see RETRYABLE_ERRORS), and the phrases that mean it in an error
+# message that carries no status. Whole phrases only: "generate failed" is not a rate limit.
+RATE_LIMIT_ERRORS = {"RateLimitError", "TooManyRequests", "ResourceExhausted"}
+RATE_LIMIT_PHRASES = re.compile(r"\b(rate[ _]?limit|quota|resource[ _]exhausted)", re.IGNORECASE)
+
+def _is_rate_limited(e):
+    status = _status_of(e)
+    if status is not None: return status == 429
+    return type(e).__name__ in RATE_LIMIT_ERRORS or bool(RATE_LIMIT_PHRASES.search(str(e)))
+
+def _retry_after(e):
+    """Seconds from an upstream Retry-After header, when the SDK exception carries the response."""
+    resp = getattr(e, "response", None)
+    try: return float(resp.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError): return None
+
+def _status_of(e):
+    """HTTP status behind an SDK exception: openai's status_code, httpx's response, google api_core's code."""
+    for obj in (e, getattr(e, "response", None)):
+        for attr in ("status_code", "code"):
+            code = getattr(obj, attr, None)
+            if isinstance(code, int) and 100 <= code < 600: return code
+    return None
+
+# Transport failures, by class name so the SDKs don't have to be imported to classify their errors.
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError",
+                    "WriteTimeout", "RemoteProtocolError", "ServiceUnavailable", "InternalServerError", "TooManyRequests",
+                    "ResourceExhausted", "GatewayTimeout", "BadGateway", "ConnectionError", "Timeout"}
+
+class RetryPolicy:
+    """Decorator that retries upstream calls that can succeed on a second try.
+
+    Fatal errors raise at once: bad input (ValueError and friends), 4xx other than 408/429, and our own
+    deadline and admission rejections. Retryable ones (429, 5xx, timeouts, connection failures) wait for
+    the upstream's Retry-After or an exponential backoff with full jitter, but only while a retry could
+    still start at least `min_attempt` seconds before the request's deadline.
+    """
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, max_retry_after=30.0, min_attempt=1.0):
+        self.max_attempts, self.base_delay, self.max_delay = max_attempts, base_delay, max_delay
+        self.max_retry_after, self.min_attempt = max_retry_after, min_attempt
+
+    @staticmethod
+    def retryable(e):
+        if isinstance(e, (DeadlineExceeded, AdmissionRejected, ValueError, TypeError, KeyError)): return False
+        status = _status_of(e)
+        if status is not None: return status in (408, 429) or status >= 500
+        # No status: only typed transport/overload errors. Message text isn't evidence of anything transient.
+        return isinstance(e, (TimeoutError, ConnectionError)) or type(e).__name__ in RETRYABLE_ERRORS | RATE_LIMIT_ERRORS
+
+    def next_delay(self, attempt, e):
+        """Seconds to wait before attempt `attempt + 1`, or None to give up and re-raise."""
+        if attempt >= self.max_attempts or not self.retryable(e): return None
+        delay = _retry_after(e)
+        if delay is None: delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        elif delay > self.max_retry_after: return None
+        left = time_left()
+        if left is not None and delay + self.min_attempt > left: return None
+        return delay
+
+    def _after_failure(self, fn, attempt, e):
+        delay = self.next_delay(attempt, e)
+        outcome = "retry" if delay is not None else "gave_up" if self.retryable(e) else "fatal"
+        METRICS.inc("scribe_retries_total", call=fn.__qualname__, outcome=outcome)
+        if delay is None:
+            if outcome == "gave_up": log.error("%s failed on attempt %d, not retrying: %s", fn.__qualname__, attempt, e)
+        else:
+            log.warning("%s failed (attempt %d), retrying in %.2fs: %s", fn.__qualname__, attempt, delay, e)
+        return delay
+
+    def __call__(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            # Async providers back off on the event loop instead of parking a thread.
+            @wraps(fn)
+            async def awrap(*a, **k):
+                for attempt in range(1, self.max_attempts + 1):
+                    try: return await fn(*a, **k)
+                    except Exception as e:
+                        delay = self._after_failure(fn, attempt, e)
+                        if delay is None: raise
+                        await asyncio.sleep(delay)
+            return awrap
         @wraps(fn)
         def wrap(*a, **k):
-            for i in range(max_retries):
+            for attempt in range(1, self.max_attempts + 1):
                 try: return fn(*a, **k)
                 except Exception as e:
-                    if i == max_retries-1: log.error("Final attempt failed for %s: %s", fn.__name__, e); raise
-                    time.sleep(base_delay * (2 ** i))
+                    delay = self._after_failure(fn, attempt, e)
+                    if delay is None: raise
+                    time.sleep(delay)
         return wrap
-    return deco
+
+RETRY = RetryPolicy(
+    max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", 3)),
+    base_delay=float(os.getenv("RETRY_BASE_DELAY_MS", 500)) / 1000,
+    max_delay=float(os.getenv("RETRY_MAX_DELAY_MS", 8000)) / 1000,
+)
+
+def _sse(payload, event=None):
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(payload)}\n\n"
+
+def _parse_sse(frame):
+    event, data = None, None
+    for line in frame.splitlines():
+        if line.startswith("event: "): event = line[7:]
+        elif line.startswith("data: "): data = line[6:]
+    return event, json.loads(data) if data else None
+
+def _stream_timing(t0, ttft):
+    return {"ttft_ms": round(ttft * 1000) if ttft is not None else None,
+            "total_ms": round((time.perf_counter() - t0) * 1000)}
+
+# ---------- Metrics ----------
+class Metrics:
+    """In-process Prometheus-style histograms and counters, rendered in text format by /metrics.
+
+    The number of label combinations is capped, since model names can come from the client.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, max_series=5000):
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._hist = {}      # (name, labels) -> per-bucket counts + [+Inf, sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self.dropped = 0
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None and v != ""))
+
+    def _room(self, key, table):
+        if key in table or len(self._hist) + len(self._counters) < self.max_series: return True
+        self.dropped += 1
+        return False
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if not self._room(key, self._hist): return
+            h = self._hist.setdefault(key, [0] * (len(self.BUCKETS) + 3))
+            h[next((i for i, b in enumerate(self.BUCKETS) if seconds <= b), len(self.BUCKETS))] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if self._room(key, self._counters): self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs = [f'{k}="{esc(v)}"' for k, v in labels + tuple(extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            counters, dropped = dict(self._counters), self.dropped
+        lines, typed = [], set()
+        for (name, labels), h in sorted(hist.items()):
+            if name not in typed: lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf",), h):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for (name, labels), v in sorted(counters.items()):
+            if name not in typed: lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {v}")
+        lines += ["# TYPE scribe_metrics_dropped_series_total counter", f"scribe_metrics_dropped_series_total {dropped}"]
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics(max_series=int(os.getenv("METRICS_MAX_SERIES", 5000)))
+STAGE_METRIC = "scribe_stage_duration_seconds"
+
+def _quoteless(v): return str(v).replace('"', "")
+
+class RequestTimings:
+    """Stage durations for one request, sent back as a Server-Timing header."""
+    MAX_ENTRIES = 32
+
+    def __init__(self, route):
+        self.route, self.t0 = route, time.perf_counter()
+        self._lock = threading.Lock()  # image decodes report from worker threads
+        self.entries = []
+
+    def add(self, stage, seconds, desc=None):
+        with self._lock:
+            if len(self.entries) < self.MAX_ENTRIES: self.entries.append((stage, seconds, desc))
+
+    def header(self):
+        with self._lock: entries = list(self.entries)
+        parts = [f"{stage};dur={seconds * 1000:.1f}" + (f';desc="{_quoteless(desc)}"' if desc else "")
+                 for stage, seconds, desc in entries]
+        # A stream's header goes out before its upstream call finishes, so `total` is time-to-headers there.
+        parts.append(f"total;dur={(time.perf_counter() - self.t0) * 1000:.1f}")
+        return ", ".join(parts)
+
+# Set per request by the Flask hooks below and by the ASGI wrapper; asyncio tasks and to_thread inherit it.
+_REQUEST_TIMINGS = contextvars.ContextVar("request_timings", default=None)
+
+def begin_request_timing(route):
+    timings = RequestTimings(route)
+    _REQUEST_TIMINGS.set(timings)
+    return timings
+
+def current_timings():
+    return _REQUEST_TIMINGS.get()
+
+def observe_stage(stage, seconds, timings=None, outcome="ok", **labels):
+    """Record one stage into the histogram and, inside a request, into its Server-Timing header.
+
+    Worker threads don't inherit the request context, so callers there pass `timings` explicitly.
+    """
+    timings = timings or current_timings()
+    METRICS.observe(STAGE_METRIC, seconds, stage=stage, route=timings.route if timings else None, outcome=outcome, **labels)
+    if timings: timings.add(stage, seconds, labels.get("model") or labels.get("query") or labels.get("kind"))
+
+@contextmanager
+def timed(stage, timings=None, **labels):
+    t0, outcome = time.perf_counter(), "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe_stage(stage, time.perf_counter() - t0, timings, outcome, **labels)
+
+# ---------- Admission control ----------
+# Limits are per worker process. Lower priority values are served first: a transcription chunk that waits
+# behind answers falls behind the live audio, an answer that waits a little is just slower.
+PRIORITIES = {"transcribe": 0, "answer": 1, "batch": 2, "summary": 2}
+
+class AdmissionRejected(Exception):
+    """Not admitted in time (client out of tokens, upstream queue full or timed out): answered with a 429."""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "state", "wake")
+    def __init__(self, priority, seq, wake):
+        self.priority, self.seq, self.wake, self.state = priority, seq, wake, None  # -> admitted | evicted | timeout
+
+    def __lt__(self, other): return (self.priority, self.seq) < (other.priority, other.seq)
+
+class UpstreamGate:
+    """In-flight limit for one upstream provider, with a bounded wait queue ordered by priority.
+
+    A released slot is handed straight to the best waiter (lowest priority value, then oldest), so
+    newcomers never overtake the queue. When the queue is full a newcomer evicts the worst waiter if it
+    outranks it, and is rejected otherwise. Threads wait on an Event and coroutines on a Future, in the
+    same queue.
+    """
+    def __init__(self, name, max_inflight=16, max_queue=32):
+        self.name, self.max_inflight, self.max_queue = name, max_inflight, max_queue
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self._queue = []  # heap of _Waiter
+        self._seq = 0
+        self._hold = 1.0  # EWMA of seconds a slot is held, for Retry-After
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "evicted": 0, "timeouts": 0}
+
+    def _enter(self, priority, wake):
+        """None when a slot was free, else the queued _Waiter. Raises when the queue has no room."""
+        evicted = None
+        with self._lock:
+            if self.inflight < self.max_inflight:
+                self.inflight += 1
+                self._stats["admitted"] += 1
+                return None
+            waiter = _Waiter(priority, self._seq, wake)
+            self._seq += 1
+            if len(self._queue) >= self.max_queue:
+                worst = max(self._queue) if self._queue else None
+                if worst is None or worst.priority <= priority:
+                    self._stats["rejected"] += 1
+                    raise AdmissionRejected(f"{self.name} queue full", self._retry_after())
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                worst.state, evicted = "evicted", worst
+                self._stats["evicted"] += 1
+            heapq.heappush(self._queue, waiter)
+            self._stats["queued"] += 1
+        if evicted: evicted.wake()
+        return waiter
+
+    def _retry_after(self):
+        return self._hold * (len(self._queue) + 1) / self.max_inflight
+
+    def _withdraw(self, waiter):
+        """True if `waiter` was admitted after all; otherwise take it out of the queue."""
+        with self._lock:
+            if waiter.state == "admitted": return True
+            if waiter.state is None:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                waiter.state = "timeout"
+                self._stats["timeouts"] += 1
+            return False
+
+    def _settle(self, waiter, t0, timeout):
+        admitted = waiter is None or self._withdraw(waiter)
+        if waiter is not None:
+            observe_stage("queue", time.monotonic() - t0, outcome="ok" if admitted else waiter.state, provider=self.name)
+        if admitted: return time.monotonic()
+        with self._lock: retry_after = self._retry_after()
+        if waiter.state == "evicted": raise AdmissionRejected(f"{self.name} queue full", retry_after)
+        raise AdmissionRejected(f"{self.name} busy: no slot within {timeout:.1f}s", retry_after)
+
+    def acquire(self, priority, timeout):
+        """Block up to `timeout` seconds for a slot; returns when it was granted (monotonic)."""
+        t0, event = time.monotonic(), threading.Event()
+        waiter = self._enter(priority, event.set)
+        if waiter: event.wait(timeout)
+        return self._settle(waiter, t0, timeout)
+
+    async def acquire_async(self, priority, timeout):
+        loop = asyncio.get_running_loop()
+        t0, fut = time.monotonic(), loop.create_future()
+        waiter = self._enter(priority, lambda: loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None)))
+        if waiter:
+            try: await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError: pass
+            except asyncio.CancelledError:
+                if self._withdraw(waiter): self.release(0.0)  # admitted as we were cancelled: pass the slot on
+                raise
+        return self._settle(waiter, t0, timeout)
+
+    def release(self, held):
+        with self._lock:
+            self._hold = 0.8 * self._hold + 0.2 * held
+            waiter = heapq.heappop(self._queue) if self._queue else None
+            if waiter:
+                waiter.state = "admitted"
+                self._stats["admitted"] += 1
+            else:
+                self.inflight -= 1
+        if waiter: waiter.wake()
+
+    def release_once(self, granted):
+        """Release for a slot granted at `granted` that can be called from several places (a stream's end and
+        its response's close); only the first call frees the slot."""
+        pending = threading.Lock()
+        def release():
+            if pending.acquire(blocking=False): self.release(time.monotonic() - granted)
+        return release
+
+    @contextmanager
+    def admit(self, priority, timeout):
+        granted = self.acquire(priority, timeout)
+        try: yield
+        finally: self.release(time.monotonic() - granted)
+
+    @asynccontextmanager
+    async def admit_async(self, priority, timeout):
+        granted = await self.acquire_async(priority, timeout)
+        try: yield
+        finally: self.release(time.monotonic() - granted)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "inflight": self.inflight, "queued_now": len(self._queue),
+                    "max_inflight": self.max_inflight, "max_queue": self.max_queue, "hold_avg_ms": round(self._hold * 1000)}
+
+class ClientRateLimiter:
+    """Token bucket per client: `rate` tokens/s refilling up to `burst`. LRU-bounded."""
+    def __init__(self, rate=2.0, burst=30.0, max_clients=10000):
+        self.rate, self.burst, self.max_clients = rate, burst, max_clients
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # client -> (tokens, last refill)
+        self._stats = {"allowed": 0, "limited": 0}
+
+    def take(self, client, cost=1.0):
+        """0.0 if `cost` tokens were taken, else the seconds until they will be there."""
+        if self.rate <= 0: return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait_s = 0.0 if tokens >= cost else (cost - tokens) / self.rate
+            self._buckets[client] = (tokens - cost if not wait_s else tokens, now)
+            if len(self._buckets) > self.max_clients: self._buckets.popitem(last=False)
+            self._stats["limited" if wait_s else "allowed"] += 1
+        return wait_s
+
+    def stats(self):
+        with self._lock: return {**self._stats, "clients": len(self._buckets), "rate": self.rate, "burst": self.burst}
+
+# Proxies in front of the app that append the address they saw to X-Forwarded-For. Vercel (which sets VERCEL
+# in the function's environment) is one; elsewhere 0 trusts no header and keys on the socket address.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXY_COUNT", 1 if os.getenv("VERCEL") else 0))
+
+def _client_addr(headers, remote_addr, trusted_proxies=None):
+    """The client's address, as far as it can be trusted: all but the last `trusted_proxies` X-Forwarded-For
+    hops are whatever the client sent; the hop our outermost proxy appended is the one it saw connect."""
+    trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    if trusted_proxies:
+        hops = [h.strip() for h in headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if len(hops) >= trusted_proxies: return hops[-trusted_proxies]
+    return remote_addr
+
+def _client_key(headers, remote_addr, trusted_proxies=None):
+    """The API key when the client sends one (hashed), else origin plus address, else the address. Every
+    install of the extension shares one chrome-extension:// origin, so the origin alone would put all users
+    in one bucket."""
+    key = headers.get("X-API-Key") or headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if key: return "key:" + hashlib.sha256(key.encode()).hexdigest()[:16]
+    addr = _client_addr(headers, remote_addr, trusted_proxies) or "-"
+    origin = headers.get("Origin")
+    return f"origin:{origin}@{addr}" if origin else f"addr:{addr}"
+
+class AdmissionControl:
+    """Per-client rate limit at the door, then a gate per upstream provider around each call."""
+    # Token cost per route (route rule as registered); routes not listed aren't limited.
+    ROUTE_COSTS = {"/api/transcribe": 1, "/api/answer": 1, "/api/answer/stream": 1, "/api/answer/batch": 1,
+                   "/api/sessions/<session_id>/summary": 5}
+
+    def __init__(self, clients, max_inflight=16, max_queue=32, queue_timeouts=None):
+        self.clients, self.max_inflight, self.max_queue = clients, max_inflight, max_queue
+        self.queue_timeouts = queue_timeouts or {}
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    def gate(self, provider):
+        with self._lock:
+            if provider not in self._gates:
+                limit = int(os.getenv(f"UPSTREAM_MAX_INFLIGHT_{provider.upper()}", self.max_inflight))
+                self._gates[provider] = UpstreamGate(provider, limit, self.max_queue)
+            return self._gates[provider]
+
+    def timeout(self, kind):
+        """How long a call of this kind may queue: its limit, or less when the request's deadline is nearer."""
+        return min(self.queue_timeouts.get(kind, 5.0), time_left(float("inf")))
+
+    def check_client(self, route, headers, remote_addr, cost=None):
+        """Raise AdmissionRejected when this client is over its rate for `route` (or for `cost` tokens)."""
+        cost = self.ROUTE_COSTS.get(route) if cost is None else cost
+        if not cost: return
+        wait_s = self.clients.take(_client_key(headers, remote_addr), cost)
+        if wait_s:
+            METRICS.inc("scribe_rate_limited_total", route=route)
+            raise AdmissionRejected("Rate limit exceeded", wait_s)
+
+    def stats(self):
+        with self._lock: gates = dict(self._gates)
+        return {"clients": self.clients.stats(), "upstreams": {name: g.stats() for name, g in gates.items()}}
+
+ADMISSION = AdmissionControl(
+    ClientRateLimiter(rate=float(os.getenv("RATE_LIMIT_RPS", 2)), burst=float(os.getenv("RATE_LIMIT_BURST", 30)),
+                      max_clients=int(os.getenv("RATE_LIMIT_CLIENTS", 10000))),
+    max_inflight=int(os.getenv("UPSTREAM_MAX_INFLIGHT", 16)),
+    max_queue=int(os.getenv("UPSTREAM_MAX_QUEUE", 32)),
+    queue_timeouts={kind: float(os.getenv(f"QUEUE_TIMEOUT_{kind.upper()}_MS", ms)) / 1000
+                    for kind, ms in (("transcribe", 2000), ("answer", 5000), ("batch", 15000), ("summary", 15000))},
+)
+
+def _rejected_body(e):
+    return {"error": str(e), "retry_after": e.retry_after}, {"Retry-After": str(e.retry_after)}
+
+# ---------- Client registry ----------
+# Overridable so the benchmark harness (bench/) can point every upstream at its local stubs.
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "https://generativelanguage.googleapis.com")
+
+class ClientRegistry:
+    """Process-wide, thread-safe cache of SDK clients and providers.
+
+    Every upstream (OpenAI, Groq, ...) gets one pooled keep-alive httpx client, so requests after the
+    first reuse an open TLS connection instead of handshaking again.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._http = {}        # base_url -> httpx.Client
+        self._async_http = {}  # base_url -> httpx.AsyncClient (ASGI mode)
+        self._openai = {}      # (api_key, base_url) -> OpenAI
+        self._async_openai = {}
+        self._models = {}      # (model_name, system_instruction) -> genai.GenerativeModel
+        self._providers = {}   # (provider, model, base_url) -> BaseProvider
+        self._genai_key = None
+        self._counters = {"provider_hits": 0, "provider_misses": 0, "client_hits": 0, "client_misses": 0}
+        self._requests = {}    # base_url -> upstream requests sent over the pool
+
+    def _count_request(self, base_url):
+        with self._lock:
+            self._requests[base_url] = self._requests.get(base_url, 0) + 1
+
+    def http_client(self, base_url):
+        with self._lock:
+            client = self._http.get(base_url)
+            if client is None:
+                limits = httpx.Limits(
+                    max_connections=int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", 20)),
+                    max_keepalive_connections=int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", 10)),
+                    keepalive_expiry=float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", 60)),
+                )
+                client = httpx.Client(
+                    limits=limits,
+                    timeout=httpx.Timeout(float(os.getenv("HTTP_TIMEOUT", 60)), connect=10.0),
+                    event_hooks={"request": [lambda req, key=base_url: self._count_request(key)]},
+                )
+                self._http[base_url] = client
+            return client
+
+    def async_http_client(self, base_url):
+        # One event loop serves many in-flight calls, so the async pools are sized well above the sync ones.
+        with self._lock:
+            client = self._async_http.get(base_url)
+            if client is None:
+                client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 200)),
+                        max_keepalive_connections=int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE", 50)),
+                        keepalive_expiry=float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", 60)),
+                    ),
+                    timeout=httpx.Timeout(float(os.getenv("HTTP_TIMEOUT", 60)), connect=10.0),
+                )
+                self._async_http[base_url] = client
+            return client
+
+    def async_openai_client(self, api_key, base_url=OPENAI_BASE_URL):
+        with self._lock:
+            client = self._async_openai.get((api_key, base_url))
+            if client is None:
+                client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.async_http_client(base_url), max_retries=0)
+                self._async_openai[(api_key, base_url)] = client
+            return client
+
+    def openai_client(self, api_key, base_url=OPENAI_BASE_URL):
+        with self._lock:
+            client = self._openai.get((api_key, base_url))
+            if client is None:
+                self._counters["client_misses"] += 1
+                client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client(base_url), max_retries=0)
+                self._openai[(api_key, base_url)] = client
+            else:
+                self._counters["client_hits"] += 1
+            return client
+
+    def configure_genai(self, api_key):
+        # genai.configure() resets the SDK's cached transports, so only call it when the key changes.
+        with self._lock:
+            if self._genai_key != api_key:
+                genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+                self._genai_key = api_key
+                self._models.clear()
+
+    def gemini_model(self, model_name, system_instruction=None):
+        with self._lock:
+            model = self._models.get((model_name, system_instruction))
+            if model is None:
+                model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+                # Model names come from the client too: same bound and eviction as the provider cache.
+                if len(self._models) >= int(os.getenv("MAX_CACHED_MODELS", 32)):
+                    self._models.pop(next(iter(self._models)))
+                self._models[(model_name, system_instruction)] = model
+            return model
+
+    def provider(self, name, model=None, providers=None):
+        cls = (providers or PROVIDERS).get(name)
+        if not cls: raise ValueError("Invalid provider")
+        key = (name, model or cls.default_model(), cls.base_url, cls.is_async)
+        with self._lock:
+            inst = self._providers.get(key)
+            if inst is None:
+                self._counters["provider_misses"] += 1
+                inst = cls(model=key[1])
+                # `model` comes from the client, so keep the cache bounded; dicts evict oldest-first here.
+                if len(self._providers) >= int(os.getenv("MAX_CACHED_PROVIDERS", 16)):
+                    self._providers.pop(next(iter(self._providers)))
+                self._providers[key] = inst
+            else:
+                self._counters["provider_hits"] += 1
+            return inst
+
+    def warmup(self):
+        """Build configured providers and open one keep-alive connection per upstream."""
+        for name, cls in PROVIDERS.items():
+            try: self.provider(name)
+            except ValueError: continue  # key not configured
+        if os.getenv("GROQ_API_KEY"): self.openai_client(os.getenv("GROQ_API_KEY"), GROQ_BASE_URL)
+        for base_url in list(self._http):
+            try: self._http[base_url].head(base_url)  # status is irrelevant, the TLS session is what we keep
+            except httpx.HTTPError as e: log.warning("Warmup of %s failed: %s", base_url, e)
+        log.info("Client registry warmed: %s", self.stats())
+
+    def stats(self):
+        with self._lock:
+            pools = {}
+            for base_url, client in self._http.items():
+                # httpx keeps its connection list on the private transport pool; report it when available.
+                conns = getattr(getattr(client._transport, "_pool", None), "connections", None)
+                pools[base_url] = {
+                    "requests": self._requests.get(base_url, 0),
+                    "connections": len(conns) if conns is not None else None,
+                    "idle": sum(1 for c in conns if c.is_idle()) if conns is not None else None,
+                }
+            return {**self._counters, "providers": [list(k) for k in self._providers],
+                    "gemini_models": len(self._models), "pools": pools, "async_pools": list(self._async_http)}
+
+CLIENTS = ClientRegistry()
 
 # ---------- Providers ----------
 class BaseProvider(ABC):
+    is_async = False
+
     @abstractmethod
     def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None): ...
 
     @abstractmethod
-    def stream_response(self, transcript): ...
+    def stream_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        """Yield SSE frames: `delta` events with text, then one `done` event with usage and timing."""
+
+def _image_mime(buf):
+    head = bytes(buf[:12])
+    if head.startswith(b"\x89PNG"): return "image/png"
+    if head.startswith(b"GIF8"): return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "image/webp"
+    return "image/jpeg"
+
+def _as_data_uri(img):
+    """Images arrive as data URIs (JSON clients) or raw bytes (binary/multipart uploads)."""
+    if isinstance(img, str): return img
+    return f"data:{_image_mime(img)};base64,{base64.b64encode(img).decode()}"
+
+def _gemini_inline(img, mime=None):
+    """REST inline_data part for a data URI or raw image bytes."""
+    if isinstance(img, str):
+        header, encoded = img.split(",", 1) if "," in img else ("", img)
+        mime = header[5:].split(";")[0] if header.startswith("data:") else "image/jpeg"
+        return {"inline_data": {"mime_type": mime, "data": encoded}}
+    return {"inline_data": {"mime_type": mime or _image_mime(img), "data": base64.b64encode(img).decode()}}
+
+class StreamRun:
+    """Bookkeeping for one stream_response, shared by the sync providers and their asgi.py twins, which
+    only supply the transport loop: TTFT, usage, upstream metrics, router feedback and the SSE frames.
+
+        run = StreamRun("google", GEMINI_ROUTER)
+        for model in run.models(candidates):
+            try:
+                for chunk in upstream(model):
+                    frame = run.delta(*_gemini_sdk_delta(chunk))
+                    if frame: yield frame
+                run.require_text()
+            except Exception as e:
+                frame = run.failed(e)
+                if frame is None: continue
+                yield frame; return
+            yield run.done(); return
+        yield run.exhausted()
+    """
+    def __init__(self, provider, router=None):
+        self.provider, self.router = provider, router
+        self.t0 = time.perf_counter()
+        self.ttft, self.usage, self.last_err = None, {}, None
+        self.step = self.model = self.started = None
+
+    def models(self, names):
+        for self.step, self.model in enumerate(names):
+            self.started = time.perf_counter()
+            yield self.model
+
+    def _labels(self):
+        return {"provider": self.provider, "model": self.model, **({"step": self.step} if self.router else {})}
+
+    def delta(self, text, usage=None):
+        """The `delta` frame for one upstream chunk, or None if it carried no text."""
+        if usage: self.usage = usage
+        if not text: return None
+        if self.ttft is None: self.ttft = time.perf_counter() - self.t0
+        return _sse({"text": text}, "delta")
+
+    def failed(self, e):
+        """Record a failed attempt. Returns the frame that ends the stream, or None to fail over to the next
+        model; once tokens reached the client a retry would duplicate them, so only before that."""
+        elapsed = time.perf_counter() - self.started
+        if self.router: self.router.record(self.model, False, elapsed, e)
+        observe_stage("upstream", elapsed, outcome="error", **self._labels())
+        log.warning("%s stream on %s failed: %s", self.provider, self.model, e)
+        if self.router and self.ttft is None:
+            self.last_err = e
+            return None
+        return _sse({"error": f"AI Error: {str(e)}"}, "error")
+
+    def require_text(self):
+        """Raise if the attempt ended without a single token, like a non-streamed call that got no text."""
+        if self.ttft is None: raise ValueError(f"{self.model} returned no text")
+
+    def done(self):
+        elapsed = time.perf_counter() - self.started
+        if self.router: self.router.record(self.model, True, elapsed)
+        observe_stage("upstream", elapsed, **self._labels())
+        return _sse({"model": self.model, "usage": self.usage, "timing": _stream_timing(self.t0, self.ttft)}, "done")
+
+    def exhausted(self):
+        log.error("%s critical failure: %s", self.provider, self.last_err)
+        return _sse({"error": f"AI Error: {str(self.last_err)}"}, "error")
+
+def _openai_delta(chunk):
+    """(text, usage) of one chat.completions stream chunk."""
+    usage = chunk.usage and {"prompt_tokens": chunk.usage.prompt_tokens,
+                             "completion_tokens": chunk.usage.completion_tokens,
+                             "total_tokens": chunk.usage.total_tokens}
+    return (chunk.choices[0].delta.content if chunk.choices else None), usage
+
+def _gemini_sdk_delta(chunk):
+    """(text, usage) of one genai SDK stream chunk."""
+    meta = getattr(chunk, "usage_metadata", None)
+    usage = meta and {"prompt_tokens": meta.prompt_token_count, "completion_tokens": meta.candidates_token_count,
+                      "total_tokens": meta.total_token_count}
+    try: text = chunk.text
+    except ValueError: text = ""  # chunk without text parts (e.g. finish/safety only)
+    return text, usage
+
+def _gemini_text(resp):
+    candidates = resp.get("candidates") or [{}]
+    return "".join(p.get("text", "") for p in candidates[0].get("content", {}).get("parts", []))
+
+def _gemini_reply_text(resp):
+    """The text of a complete REST reply. Raises, as the SDK's resp.text does, when there is none (a blocked
+    prompt or response, or a candidate without parts), so the caller fails over instead of answering ""."""
+    text = _gemini_text(resp)
+    if text: return text
+    candidate = (resp.get("candidates") or [{}])[0]
+    reason = candidate.get("finishReason") or (resp.get("promptFeedback") or {}).get("blockReason") or "no candidates"
+    raise ValueError(f"Gemini returned no text ({reason})")
+
+def _gemini_usage(resp):
+    meta = resp.get("usageMetadata")
+    if not meta: return None
+    return {"prompt_tokens": meta.get("promptTokenCount"), "completion_tokens": meta.get("candidatesTokenCount"),
+            "total_tokens": meta.get("totalTokenCount")}
+
+def _gemini_rest_delta(line):
+    """(text, usage) of one line of a REST streamGenerateContent?alt=sse body."""
+    if not line.startswith("data: "): return None, None
+    chunk = json.loads(line[6:])
+    return _gemini_text(chunk), _gemini_usage(chunk)
 
 class OpenAIProvider(BaseProvider):
-    def __init__(self):
+    base_url = OPENAI_BASE_URL
+
+    @staticmethod
+    def default_model(): return os.getenv("OPENAI_MODEL", "gpt-4o")
+
+    def __init__(self, model=None):
         key = os.getenv("OPENAI_API_KEY")
         if not key: raise ValueError("OPENAI_API_KEY not configured")
-        self.client = OpenAI(api_key=key)
-        self.model = os.getenv("OPENAI_MODEL", "gpt-4o")
-
-    @retry_with_backoff()
-    def get_response(self, transcript=None, image_url=None, image_base64=None):
-        messages = []
-        if transcript and (image_url or image_base64):
-            content = [{"type": "text", "text": transcript}]
-            if image_base64:
-                content.append({"type":"image_url","image_url":{"url": image_base64}})
-            elif image_url:
-                content.append({"type":"image_url","image_url":{"url": image_url}})
-            messages.append({"role":"user","content":content})
-        elif transcript:
-            messages.append({"role":"user","content":transcript})
-        else:
-            if not (image_url or image_base64): return {"error":"No input provided"}
-            content = [{"type":"text","text":"Analyze this image and summarize key insights."}]
-            if image_base64:
-                content.append({"type":"image_url","image_url":{"url": image_base64}})
+        self.client = CLIENTS.openai_client(key, self.base_url)
+        self.model = self.model_name = model or self.default_model()
+
+    def _build_messages(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        images = list(image_array) if image_array else [image_base64] if image_base64 else [image_url] if image_url else []
+        if not transcript and not images: return None
+        if not images: return [{"role":"user","content":transcript}]
+        content = [{"type":"text","text": transcript or "Analyze this image and summarize key insights."}]
+        for img in images:
+            content.append({"type":"image_url","image_url":{"url": _as_data_uri(img)}})
+        return [{"role":"user","content":content}]
+
+    @RETRY
+    def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        messages = self._build_messages(transcript, image_url, image_base64, image_array)
+        if not messages: return {"error":"No input provided"}
+        with timed("upstream", provider="openai", model=self.model):
+            resp = self.client.chat.completions.create(model=self.model, messages=messages, timeout=call_timeout())
+        return {"answer": resp.choices[0].message.content, "model": self.model}
+
+    def stream_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        run = StreamRun("openai")
+        messages = self._build_messages(transcript, image_url, image_base64, image_array)
+        if not messages:
+            yield _sse({"error":"No input provided"}, "error"); return
+        for model in run.models([self.model]):
+            try:
+                stream = self.client.chat.completions.create(
+                    model=model, messages=messages, stream=True, stream_options={"include_usage": True}, timeout=call_timeout())
+                for chunk in stream:
+                    frame = run.delta(*_openai_delta(chunk))
+                    if frame: yield frame
+            except Exception as e:
+                yield run.failed(e); return
+            yield run.done()
+
+SCRIBE_SYSTEM_INSTRUCTION = (
+    "You are Scribe, an elite universal interview assistant and expert co-pilot embedded in a browser sidepanel. "
+    "Your primary purpose is to help the user answer complex questions and solve problems across ANY domain (e.g., Software Engineering, Teaching, Government Exams, Finance, Law, etc.).\n\n"
+    "CRITICAL Directives:\n"
+    "1. Read the provided transcript context and any attached screenshots deeply to understand exactly what is being asked.\n"
+    "2. Provide highly accurate, comprehensive, and well-thought-out answers. Do not make the answer so short that it loses critical nuance or context.\n"
+    "3. If it is a coding question, provide the optimal working code with a Time/Space complexity breakdown.\n"
+    "4. If it is a behavioral or scenario-based question (e.g., a teaching scenario or policy question), write out the ideal, comprehensive talking points the user should say in response.\n"
+    "5. While you should be comprehensive, format your answer powerfully so the user can skim it while speaking. Use bolding for key terms, clear paragraphs, and bullet points where appropriate."
+)
+
+# ---------- Gemini model routing ----------
+def _canon_model(name):
+    return name if name.startswith("models/") else f"models/{name}"
+
+class _ModelHealth:
+    __slots__ = ("err", "latency", "calls", "updated", "breaker")
+    def __init__(self, breaker):
+        self.err, self.latency, self.calls, self.updated, self.breaker = 0.0, None, 0, time.monotonic(), breaker
+
+class ModelRouter:
+    """Orders Gemini models by recent health so a failing primary is skipped instead of tried first.
+
+    Tracks an EWMA of error rate and latency per model, and caches the account's model catalog for
+    `catalog_ttl` seconds so fallbacks are checked against it without a list_models() call per failure.
+    The error rate decays with `half_life` while a model gets no traffic, so a demoted primary comes back.
+    """
+    def __init__(self, fallbacks, catalog_ttl=600.0, alpha=0.3, max_error_rate=0.5, half_life=60.0, max_models=32):
+        self.fallbacks = fallbacks
+        self.catalog_ttl, self.alpha, self.max_error_rate, self.half_life = catalog_ttl, alpha, max_error_rate, half_life
+        self.max_models = max_models
+        self._lock = threading.Lock()
+        self._health = {}
+        self._catalog, self._catalog_at = None, 0.0
+
+    def _claim_refresh(self):
+        """True when the cached catalog is stale and this caller should refresh it; concurrent callers keep
+        using the cached copy meanwhile."""
+        with self._lock:
+            if time.monotonic() - self._catalog_at < self.catalog_ttl: return False
+            self._catalog_at = time.monotonic()
+            return True
+
+    def _refreshed(self, names=None, error=None):
+        with self._lock:
+            if error is None:
+                self._catalog = names
+                log.info("Gemini model catalog refreshed: %d models", len(names))
             else:
-                content.append({"type":"image_url","image_url":{"url": image_url}})
-            messages.append({"role":"user","content":content})
+                log.warning("Gemini model listing failed, keeping cached catalog: %s", error)
+                self._catalog_at = time.monotonic() - self.catalog_ttl + 60  # retry in a minute
+            return self._catalog
+
+    def catalog(self):
+        """Names of models that support generateContent, or None if it has never been fetched successfully."""
+        if not self._claim_refresh(): return self.cached_catalog()
+        try: names = {m.name for m in genai.list_models() if "generateContent" in m.supported_generation_methods}
+        except Exception as e: return self._refreshed(error=e)
+        return self._refreshed(names)
+
+    async def catalog_async(self, fetch):
+        """catalog() for the event loop: `fetch` is a coroutine function returning the model names."""
+        if not self._claim_refresh(): return self.cached_catalog()
+        try: names = await fetch()
+        except Exception as e: return self._refreshed(error=e)
+        return self._refreshed(names)
+
+    def cached_catalog(self):
+        with self._lock: return self._catalog
+
+    def _get(self, name):
+        h = self._health.get(name)
+        if h is None:
+            # Primaries are client-chosen, so bound the map: drop the longest-idle model that isn't a fallback.
+            if len(self._health) >= self.max_models:
+                pinned = {_canon_model(n) for n in self.fallbacks}
+                idle = min((n for n in self._health if n not in pinned), key=lambda n: self._health[n].updated, default=None)
+                if idle is not None: del self._health[idle]
+            h = self._health[name] = _ModelHealth(CircuitBreaker(
+                failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", 3)),
+                cooldown=float(os.getenv("GEMINI_BREAKER_COOLDOWN", 30)),
+                ratelimit_cooldown=float(os.getenv("GEMINI_BREAKER_RATELIMIT_COOLDOWN", 60))))
+        return h
+
+    def record(self, name, ok, latency, error=None):
+        with self._lock:
+            h = self._get(_canon_model(name))
+            h.calls += 1
+            h.err = self._err(h) + self.alpha * ((0.0 if ok else 1.0) - self._err(h))
+            h.updated = time.monotonic()
+            h.latency = latency if h.latency is None else h.latency + self.alpha * (latency - h.latency)
+        if ok: h.breaker.record_success()
+        else: h.breaker.record_failure(_is_rate_limited(error), _retry_after(error))
 
-        resp = self.client.chat.completions.create(model=self.model, messages=messages)
-        return {"answer": resp.choices[0].message.content}
+    def _err(self, h):
+        return h.err * 0.5 ** ((time.monotonic() - h.updated) / self.half_life)
 
-    def stream_response(self, transcript):
-        yield f"data: {json.dumps({'error':'OpenAI streaming not used here'})}\n\n"
+    def _healthy(self, name):
+        with self._lock:
+            h = self._get(_canon_model(name))
+            err = self._err(h)
+        # state(), not allow(): ranking mustn't claim a half-open breaker's one probe for a model that may never
+        # be called. attempts() claims it right before the call.
+        return err < self.max_error_rate and h.breaker.state() != "open"
+
+    def _ranked(self, primary):
+        names, seen = [], set()
+        for name in [primary, *self.fallbacks]:
+            if _canon_model(name) not in seen:
+                seen.add(_canon_model(name)); names.append(name)
+        return names, [n for n in names if self._healthy(n)]
+
+    def needs_catalog(self, primary):
+        """Whether candidates(primary) goes past the primary, and so checks the fallbacks against the catalog."""
+        _, healthy = self._ranked(primary)
+        return not healthy or healthy[0] != primary
+
+    def candidates(self, primary, limit=3, catalog=None):
+        """Models to try in order: healthy ones first (primary preferred, then fastest fallbacks). `catalog`
+        supplies the model catalog when that's needed; by default it's fetched with the SDK."""
+        names, healthy = self._ranked(primary)
+        if not healthy or healthy[0] != primary:
+            # Going past the primary: make sure fallbacks actually exist for this key.
+            catalog = (catalog or self.catalog)()
+            if catalog:
+                names = [n for n in names if n == primary or _canon_model(n) in catalog]
+                healthy = [n for n in healthy if n in names]
+        with self._lock:
+            def score(n):
+                h = self._get(_canon_model(n))
+                return (n != primary, (h.latency or 0.0) * (1 + 4 * self._err(h)))
+            healthy.sort(key=score)
+        rest = [n for n in names if n not in healthy]
+        return (healthy + rest)[:limit]
+
+    def attempts(self, primary, limit=3, catalog=None):
+        """candidates(), claimed one at a time as each is about to be called: a model whose breaker refuses
+        (open, or its half-open probe already out) is skipped, unless it's the last one and nothing was tried."""
+        names, tried = self.candidates(primary, limit, catalog), 0
+        for i, name in enumerate(names):
+            with self._lock: breaker = self._get(_canon_model(name)).breaker
+            if breaker.allow() or (not tried and i == len(names) - 1):
+                tried += 1
+                yield name
+
+    def stats(self):
+        with self._lock:
+            return {name: {"error_rate": round(self._err(h), 3), "latency_ms": round(h.latency * 1000) if h.latency is not None else None,
+                           "calls": h.calls, "state": h.breaker.state()} for name, h in self._health.items()}
+
+GEMINI_ROUTER = ModelRouter(
+    [m.strip() for m in os.getenv("GOOGLE_FALLBACK_MODELS", "gemini-2.0-flash,gemini-1.5-flash").split(",") if m.strip()],
+    catalog_ttl=float(os.getenv("GEMINI_CATALOG_TTL", 600)),
+    max_models=int(os.getenv("GEMINI_MAX_TRACKED_MODELS", 32)),
+)
 
 class GoogleProvider(BaseProvider):
-    def __init__(self):
+    base_url = None  # genai REST transport manages its own endpoint
+
+    @staticmethod
+    def default_model(): return os.getenv("GOOGLE_MODEL", "gemini-2.5-flash")
+
+    def __init__(self, model=None):
         key = os.getenv("GOOGLE_API_KEY")
         if not key: raise ValueError("GOOGLE_API_KEY not configured")
-        genai.configure(api_key=key, transport="rest")
-        self.model_name = os.getenv("GOOGLE_MODEL", "gemini-2.5-flash")
+        CLIENTS.configure_genai(key)
+        self.model_name = model or self.default_model()
         log.info("Initializing GoogleProvider with model: %s", self.model_name)
-        self.model = genai.GenerativeModel(
-            self.model_name,
-            system_instruction=(
-                "You are Scribe, an elite universal interview assistant and expert co-pilot embedded in a browser sidepanel. "
-                "Your primary purpose is to help the user answer complex questions and solve problems across ANY domain (e.g., Software Engineering, Teaching, Government Exams, Finance, Law, etc.).\n\n"
-                "CRITICAL Directives:\n"
-                "1. Read the provided transcript context and any attached screenshots deeply to understand exactly what is being asked.\n"
-                "2. Provide highly accurate, comprehensive, and well-thought-out answers. Do not make the answer so short that it loses critical nuance or context.\n"
-                "3. If it is a coding question, provide the optimal working code with a Time/Space complexity breakdown.\n"
-                "4. If it is a behavioral or scenario-based question (e.g., a teaching scenario or policy question), write out the ideal, comprehensive talking points the user should say in response.\n"
-                "5. While you should be comprehensive, format your answer powerfully so the user can skim it while speaking. Use bolding for key terms, clear paragraphs, and bullet points where appropriate."
-            )
-        )
+        self.model = self._model(self.model_name)
+        # Build fallbacks up front so a failover reuses warm model objects.
+        for name in GEMINI_ROUTER.fallbacks: self._model(name)
 
-    def _pil_from_base64(self, data_uri:str):
+    @staticmethod
+    def _model(name):
+        return CLIENTS.gemini_model(name, SCRIBE_SYSTEM_INSTRUCTION)
+
+    def _pil_from_base64(self, data_uri):
+        # Already-encoded bytes (uploads, preprocessed images) go up as-is; PIL parts would be re-encoded by the SDK.
+        if not isinstance(data_uri, str):
+            return {"mime_type": _image_mime(data_uri), "data": bytes(data_uri)}
         header, encoded = data_uri.split(",",1)
-        b = base64.b64decode(encoded)
+        with timed("base64_decode", kind="image"): b = base64.b64decode(encoded)
         try:
-            return Image.open(BytesIO(b))
-        except UnidentifiedImageError:
+            with timed("image_decode"): return Image.open(BytesIO(b))
+        except Image.UnidentifiedImageError:
             raise ValueError("Invalid image data")
 
     def _pil_from_url(self, url:str):
-        r = requests.get(url, headers={"User-Agent":"Mozilla/5.0"}, timeout=10)
-        if r.status_code != 200: raise ValueError(f"Image download failed HTTP {r.status_code}")
-        try: return Image.open(BytesIO(r.content))
-        except UnidentifiedImageError: raise ValueError("Failed to decode image")
+        content, _ = IMAGE_FETCH.fetch(url, call_timeout(10))
+        try:
+            with timed("image_decode"): return Image.open(BytesIO(content))
+        except Image.UnidentifiedImageError: raise ValueError("Failed to decode image")
 
-    @retry_with_backoff()
-    def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+    def _build_parts(self, transcript=None, image_url=None, image_base64=None, image_array=None):
         parts = []
         if transcript: parts.append(transcript)
-        
+
         if image_array:
             for b64 in image_array:
                 parts.append(self._pil_from_base64(b64))
         elif image_base64: parts.append(self._pil_from_base64(image_base64))
         elif image_url:  parts.append(self._pil_from_url(image_url))
+        return parts
+
+    def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        parts = self._build_parts(transcript, image_url, image_base64, image_array)
         if not parts: return {"error":"No input provided"}
-        
+
+        last_err = None
+        for step, name in enumerate(GEMINI_ROUTER.attempts(self.model_name)):
+            t0 = time.perf_counter()
+            timeout = call_timeout()  # each fallback gets what's left of the deadline, and none once it's gone
+            try:
+                log.info("Generating content for model %s (parts: %d)", name, len(parts))
+                with timed("upstream", provider="google", model=name, step=step):
+                    resp = self._model(name).generate_content(parts, request_options={"timeout": timeout})
+                    text = resp.text
+            except Exception as e:
+                GEMINI_ROUTER.record(name, False, time.perf_counter() - t0, e)
+                log.warning("Gemini call to %s failed: %s", name, e)
+                last_err = e
+                continue
+            GEMINI_ROUTER.record(name, True, time.perf_counter() - t0)
+            return {"answer": text, "model": name}
+        log.error("Gemini critical failure: %s", last_err)
+        return {"error": f"AI Error: {str(last_err)}"}
+
+    def stream_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        run = StreamRun("google", GEMINI_ROUTER)
         try:
-            log.info("Generating content for model %s (parts: %d)", self.model_name, len(parts))
-            resp = self.model.generate_content(parts)
-            return {"answer": resp.text}
-        except Exception as e:
-            log.warning("Primary Gemini call failed: %s", e)
+            parts = self._build_parts(transcript, image_url, image_base64, image_array)
+        except ValueError as e:
+            yield _sse({"error": str(e)}, "error"); return
+        if not parts:
+            yield _sse({"error":"No input provided"}, "error"); return
+
+        for model_name in run.models(GEMINI_ROUTER.attempts(self.model_name)):
+            try: timeout = call_timeout()
+            except DeadlineExceeded as e:
+                yield _sse({"error": str(e)}, "error"); return
             try:
-                # Attempt to log available models to help debugging
-                available = [m.name for m in genai.list_models()]
-                log.info("Available models: %s", available)
-                
-                # Try a very safe fallback if available
-                fallback_name = "models/gemini-1.5-flash" if "models/gemini-1.5-flash" in available else available[0]
-                log.info("Trying fallback to %s", fallback_name)
-                
-                fallback = genai.GenerativeModel(fallback_name)
-                resp = fallback.generate_content(parts)
-                return {"answer": resp.text}
-            except Exception as e2:
-                log.error("Gemini critical failure: %s", e2)
-                return {"error": f"AI Error: {str(e2)}"}
-
-    def stream_response(self, transcript):
-        yield f"data: {json.dumps({'error':'Gemini streaming not used here'})}\n\n"
+                log.info("Streaming content for model %s (parts: %d)", model_name, len(parts))
+                for chunk in self._model(model_name).generate_content(parts, stream=True, request_options={"timeout": timeout}):
+                    frame = run.delta(*_gemini_sdk_delta(chunk))
+                    if frame: yield frame
+                run.require_text()
+            except Exception as e:
+                frame = run.failed(e)
+                if frame is None: continue
+                yield frame; return
+            yield run.done(); return
+        yield run.exhausted()
 
 PROVIDERS = {"openai": OpenAIProvider, "google": GoogleProvider}
 
-def get_provider(name):
-    cls = PROVIDERS.get(name)
-    if not cls: raise ValueError("Invalid provider")
-    return cls()
+def get_provider(name, model=None):
+    return CLIENTS.provider(name, model)
+
+if os.getenv("WARMUP_CLIENTS", "false").lower() == "true":
+    threading.Thread(target=CLIENTS.warmup, name="client-warmup", daemon=True).start()
+
+# ---------- Image preprocessing ----------
+# How each provider bills vision input: images are cut into `tile`-pixel tiles at `tile_tokens` each
+# (plus `base_tokens`), after the API's own downscale to `max_side` / `short_side`.
+IMAGE_PROFILES = {
+    "google": {"tile": 768, "tile_tokens": 258, "base_tokens": 0, "max_side": 3072, "short_side": None},
+    "openai": {"tile": 512, "tile_tokens": 170, "base_tokens": 85, "max_side": 2048, "short_side": 768},
+}
+
+def _image_tokens(w, h, p):
+    return p["base_tokens"] + p["tile_tokens"] * math.ceil(w / p["tile"]) * math.ceil(h / p["tile"])
+
+def _fit_size(w, h, p, budget):
+    """Largest size (keeping aspect) the provider won't downscale anyway and that fits `budget` tokens."""
+    scale = min(1.0, p["max_side"] / max(w, h))
+    if p["short_side"]: scale = min(scale, p["short_side"] / min(w, h))
+    while True:
+        tw, th = max(1, round(w * scale)), max(1, round(h * scale))
+        if _image_tokens(tw, th, p) <= budget or (tw <= p["tile"] and th <= p["tile"]): return tw, th
+        scale *= 0.9
+
+def _dhash(im, size=8):
+    """64-bit difference hash: compares neighbouring pixels of a tiny grayscale thumbnail."""
+    px = list(im.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = (bits << 1) | (px[row * (size + 1) + col] > px[row * (size + 1) + col + 1])
+    return bits
+
+class ImagePipeline:
+    """Decodes, downsizes, re-encodes and de-duplicates request images before they go to a provider."""
+    def __init__(self, token_budget=1100, jpeg_quality=85, dup_distance=5, max_workers=4):
+        self.token_budget, self.jpeg_quality, self.dup_distance = token_budget, jpeg_quality, dup_distance
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="img")
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "images_in": 0, "images_out": 0, "duplicates_dropped": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def _process(self, img, profile, timings=None):
+        if isinstance(img, str):
+            with timed("base64_decode", timings, kind="image"): raw = base64.b64decode(img.split(",", 1)[1] if "," in img else img)
+        else: raw = img
+        try:
+            with timed("image_decode", timings):
+                im = Image.open(BytesIO(raw))
+                im.load()
+        except (Image.UnidentifiedImageError, OSError):
+            raise ValueError("Invalid image data")
+        fingerprint = _dhash(im)
+        size = _fit_size(im.width, im.height, profile, self.token_budget)
+        resized = size != im.size
+        if resized: im = im.resize(size, Image.LANCZOS)
+        if not resized and im.format in ("JPEG", "WEBP"): return raw, fingerprint, len(raw)
+        buf = BytesIO()
+        im.convert("RGB").save(buf, "JPEG", quality=self.jpeg_quality, optimize=True)
+        out = buf.getvalue()
+        return (out if resized or len(out) < len(raw) else raw), fingerprint, len(raw)
+
+    def prepare(self, images, provider):
+        """Return (images as encoded bytes, report) for `provider`'s token budget."""
+        t0 = time.perf_counter()
+        profile = IMAGE_PROFILES.get(provider, IMAGE_PROFILES["google"])
+        timings = current_timings()  # the pool's threads don't see the request's context
+        processed = list(self._pool.map(lambda img: self._process(img, profile, timings), images))
+        kept, hashes = [], []
+        for out, fingerprint, _ in processed:
+            # Consecutive captures of an unchanged screen differ by a few bits at most.
+            if any(bin(fingerprint ^ h).count("1") <= self.dup_distance for h in hashes): continue
+            kept.append(out); hashes.append(fingerprint)
+        report = {"images_in": len(images), "images_out": len(kept), "duplicates_dropped": len(images) - len(kept),
+                  "bytes_in": sum(n for _, _, n in processed), "bytes_out": sum(len(b) for b in kept),
+                  "ms": round((time.perf_counter() - t0) * 1000)}
+        report["bytes_saved"] = report["bytes_in"] - report["bytes_out"]
+        with self._lock:
+            self._stats["requests"] += 1
+            for k in ("images_in", "images_out", "duplicates_dropped", "bytes_in", "bytes_out"): self._stats[k] += report[k]
+        return kept, report
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "bytes_saved": self._stats["bytes_in"] - self._stats["bytes_out"]}
+
+IMAGE_PIPELINE = ImagePipeline(
+    token_budget=int(os.getenv("IMAGE_TOKEN_BUDGET", 1100)),
+    jpeg_quality=int(os.getenv("IMAGE_JPEG_QUALITY", 85)),
+    dup_distance=int(os.getenv("IMAGE_DUP_DISTANCE", 5)),
+    max_workers=int(os.getenv("IMAGE_WORKERS", 4)),
+)
+
+def _prepare_images(provider_name, data):
+    """Swap the request's imageArray/imageBase64 for preprocessed bytes in place; returns the report or None."""
+    images = data.get("imageArray") or ([data["imageBase64"]] if data.get("imageBase64") else None)
+    if not images or os.getenv("IMAGE_PREPROCESS", "true").lower() != "true": return None
+    data["imageArray"], report = IMAGE_PIPELINE.prepare(images, provider_name)
+    data.pop("imageBase64", None)
+    return report
+
+# ---------- Image URL fetches ----------
+def _max_age(cache_control):
+    m = re.search(r"(?:^|[,\s])max-age=(\d+)", cache_control or "")
+    return int(m.group(1)) if m else 0
+
+class ImageFetchCache:
+    """Recently downloaded `imageUrl` bodies: an LRU bounded by total bytes, fetched over one pooled client.
+
+    An entry inside its max-age is served without a request. After that it's revalidated with If-None-Match /
+    If-Modified-Since, and a 304 reuses the stored bytes. Responses with neither a max-age nor a validator,
+    or marked no-store, aren't kept.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=8 * 1024 * 1024):
+        self.max_bytes, self.max_entry_bytes = max_bytes, max_entry_bytes
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # url -> (fresh_until, etag, last_modified, mime, body)
+        self._bytes = 0
+        self._stats = {"hits": 0, "revalidated": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def lookup(self, url):
+        """(entry, conditional headers); a fresh entry comes with None, meaning no request is needed."""
+        with self._lock:
+            entry = self._mem.get(url)
+            if entry is None: return None, {}
+            self._mem.move_to_end(url)
+            if entry[0] > time.time():
+                self._stats["hits"] += 1
+                return entry, None
+        _, etag, last_modified, _, _ = entry
+        return entry, {k: v for k, v in (("If-None-Match", etag), ("If-Modified-Since", last_modified)) if v}
+
+    def settle(self, url, entry, status, headers, content):
+        """(body, mime) for a response to a lookup()'s request, remembering it when it's cacheable."""
+        cache_control = headers.get("cache-control", "")
+        if status == 304 and entry:
+            with self._lock: self._stats["revalidated"] += 1
+            self._remember(url, (time.time() + _max_age(cache_control), headers.get("etag") or entry[1],
+                                 headers.get("last-modified") or entry[2], entry[3], entry[4]))
+            return entry[4], entry[3]
+        if status != 200: raise ValueError(f"Image download failed HTTP {status}")
+        mime = headers.get("content-type") or _image_mime(content)
+        with self._lock: self._stats["misses"] += 1
+        etag, last_modified, max_age = headers.get("etag"), headers.get("last-modified"), _max_age(cache_control)
+        if "no-store" not in cache_control and (etag or last_modified or max_age):
+            self._remember(url, (time.time() + max_age, etag, last_modified, mime, content))
+        return content, mime
+
+    def _remember(self, url, entry):
+        size = len(entry[4])
+        if size > min(self.max_entry_bytes, self.max_bytes): return
+        with self._lock:
+            old = self._mem.pop(url, None)
+            if old: self._bytes -= len(old[4])
+            else: self._stats["stores"] += 1
+            self._mem[url] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, dropped = self._mem.popitem(last=False)
+                self._bytes -= len(dropped[4])
+                self._stats["evictions"] += 1
+
+    def fetch(self, url, timeout):
+        entry, conditional = self.lookup(url)
+        if conditional is None: return entry[4], entry[3]
+        with timed("upstream", provider="image-url"):
+            r = CLIENTS.http_client("image-fetch").get(url, headers={"User-Agent": "Mozilla/5.0", **conditional},
+                                                       timeout=timeout, follow_redirects=True)
+        return self.settle(url, entry, r.status_code, r.headers, r.content)
+
+    async def fetch_async(self, url, timeout):
+        entry, conditional = self.lookup(url)
+        if conditional is None: return entry[4], entry[3]
+        with timed("upstream", provider="image-url"):
+            r = await CLIENTS.async_http_client("image-fetch").get(url, headers={"User-Agent": "Mozilla/5.0", **conditional},
+                                                                   timeout=timeout, follow_redirects=True)
+        return self.settle(url, entry, r.status_code, r.headers, r.content)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._mem), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+IMAGE_FETCH = ImageFetchCache(
+    max_bytes=int(os.getenv("IMAGE_FETCH_CACHE_BYTES", 32 * 1024 * 1024)),
+    max_entry_bytes=int(os.getenv("IMAGE_FETCH_MAX_ENTRY_BYTES", 8 * 1024 * 1024)),
+)
+
+# ---------- Answer cache ----------
+def _image_digest(img):
+    """sha256 of the decoded image, so a data URI and the same bytes uploaded as binary share an entry."""
+    if isinstance(img, str):
+        with timed("base64_decode", kind="image"): img = base64.b64decode(img.split(",", 1)[1] if "," in img else img)
+    return hashlib.sha256(img).hexdigest()
+
+class AnswerCache:
+    """Content-addressed cache for /api/answer results.
+
+    In memory it's an LRU bounded by total bytes, with a TTL per entry. When `disk_dir` is set,
+    entries are also written there as JSON files so they survive worker restarts.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600.0, disk_dir=None, disk_max_bytes=256 * 1024 * 1024):
+        self.max_bytes, self.ttl = max_bytes, ttl
+        self.disk_dir, self.disk_max_bytes = disk_dir, disk_max_bytes
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # key -> (expires, size, value)
+        self._bytes = 0
+        self._disk_puts = 0
+        self._stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self): return self.max_bytes > 0 and self.ttl > 0
+
+    @staticmethod
+    def key(provider, model, transcript=None, image_url=None, image_base64=None, image_array=None):
+        h = hashlib.sha256()
+        h.update(f"{provider}\0{model}\0{' '.join((transcript or '').split())}\0".encode())
+        # Same precedence as the providers: an imageArray wins over imageBase64, which wins over imageUrl.
+        if image_array:
+            for img in image_array: h.update(f"img:{_image_digest(img)}\0".encode())
+        elif image_base64: h.update(f"img:{_image_digest(image_base64)}\0".encode())
+        elif image_url: h.update(f"url:{image_url}\0".encode())
+        return h.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key):
+        """Return (value, tier) where tier is 'memory' or 'disk', or (None, None) on a miss."""
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit and hit[0] > now:
+                self._mem.move_to_end(key)
+                self._stats["hits_memory"] += 1
+                return hit[2], "memory"
+            if hit: self._drop(key)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                if os.path.getmtime(path) + self.ttl > now:
+                    with open(path, encoding="utf-8") as f: value = json.load(f)
+                    self._remember(key, value, os.path.getmtime(path) + self.ttl)
+                    with self._lock: self._stats["hits_disk"] += 1
+                    return value, "disk"
+                os.remove(path)
+            except (OSError, ValueError):
+                pass
+        with self._lock: self._stats["misses"] += 1
+        return None, None
+
+    def _drop(self, key):
+        _, size, _ = self._mem.pop(key)
+        self._bytes -= size
+
+    def _remember(self, key, value, expires):
+        size = len(json.dumps(value))
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self._mem: self._drop(key)
+            self._mem[key] = (expires, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._mem)))
+                self._stats["evictions"] += 1
+
+    def put(self, key, value):
+        self._remember(key, value, time.time() + self.ttl)
+        with self._lock: self._stats["stores"] += 1
+        if not self.disk_dir: return
+        path = self._disk_path(key)
+        try:
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f: json.dump(value, f)
+            os.replace(tmp, path)  # atomic, so concurrent workers never read a half-written entry
+        except OSError as e:
+            log.warning("Answer cache disk write failed: %s", e)
+            return
+        with self._lock:
+            self._disk_puts += 1
+            sweep = self._disk_puts % 50 == 0
+        if sweep: self._sweep_disk()
+
+    def _sweep_disk(self):
+        # Oldest-first eviction down to the disk budget; expired entries go regardless.
+        try:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.disk_dir) if e.name.endswith(".json")]
+        except OSError: return
+        entries.sort()
+        total, now = sum(size for _, size, _ in entries), time.time()
+        for mtime, size, path in entries:
+            if total <= self.disk_max_bytes and mtime + self.ttl > now: continue
+            try: os.remove(path); total -= size
+            except OSError: pass
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._mem), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "disk_dir": self.disk_dir}
+
+ANSWER_CACHE = AnswerCache(
+    max_bytes=int(os.getenv("ANSWER_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", 3600)),
+    disk_dir=os.getenv("ANSWER_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("ANSWER_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)),
+)
+
+def _answer_cache_key(provider_name, provider, data, no_cache=False):
+    """Cache key for this answer, or None when caching is off or the client asked to bypass it."""
+    if not ANSWER_CACHE.enabled or no_cache: return None
+    return AnswerCache.key(provider_name, provider.model_name, data.get("transcript"), data.get("imageUrl"),
+                           data.get("imageBase64"), data.get("imageArray"))
+
+def _cacheable(provider, model):
+    """Whether an answer from `model` may go under the key, which names the requested model. A fallback's
+    answer cached there would keep being served after the primary recovers, until the TTL ran out."""
+    return _canon_model(model or provider.model_name) == _canon_model(provider.model_name)
 
 # ---------- Flask ----------
+class InMemoryRequest(Request):
+    """Keeps multipart file parts in memory; werkzeug spools anything over 500KB to a temp file by default."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
 CORS(app, resources={r"/*":{"origins":["chrome-extension://*","http://localhost:*","http://127.0.0.1:*"]}})
 
 import mimetypes
 from flask import send_file
 
 db_error = None
-try:
-    import urllib.parse
-    import ssl
-    import pg8000.dbapi
-    pg8000.dbapi.paramstyle = 'format'
-except Exception as e:
-    db_error = f"Import error: {e}"
-
-def get_db_connection():
-    global db_error
-    if db_error: return None
-    db_url = os.environ.get("POSTGRES_URL")
-    if not db_url: return None
+
+# Fixed queries, prepared once per pooled connection and reused by name.
+# A session's text is its base transcript followed by any appended chunks (in seq order) not yet compacted.
+# The base is either plain `transcript` or zlib-compressed `transcript_z` (see _pack_transcript), which only
+# Python can read, so queries return the pieces and _unpack_transcript puts them together.
+PENDING_TEXT = ("(SELECT string_agg(c.content, '' ORDER BY c.seq) "
+                "FROM scribe_session_chunks c WHERE c.session_id = s.id)")
+TRANSCRIPT_PARTS = f"s.transcript, s.transcript_z, {PENDING_TEXT}"
+# search_tsv is maintained by the writes (Postgres can't index what it can't decompress): title weighted above text.
+SESSION_TSV = "setweight(to_tsvector('english', COALESCE(:title, '')), 'A') || setweight(to_tsvector('english', :text), 'B')"
+HEADLINE_OPTIONS = "StartSel=\x02, StopSel=\x03, MaxFragments=2, MaxWords=30, MinWords=10, FragmentDelimiter=\" … \""
+
+SQL = {
+    "get_session": f"SELECT s.id, s.title, {TRANSCRIPT_PARTS}, s.created_at, s.transcript_len FROM scribe_sessions s WHERE s.id = :id",
+    "save_session": f"""
+        WITH dropped AS (DELETE FROM scribe_session_chunks WHERE session_id = :id)
+        INSERT INTO scribe_sessions (id, title, transcript, transcript_z, transcript_len, chunk_seq, pending_chunks, search_tsv)
+        VALUES (:id, :title, :transcript, :transcript_z, :length, 0, 0, {SESSION_TSV})
+        ON CONFLICT (id) DO UPDATE SET
+          title = EXCLUDED.title,
+          transcript = EXCLUDED.transcript,
+          transcript_z = EXCLUDED.transcript_z,
+          transcript_len = EXCLUDED.transcript_len,
+          chunk_seq = 0,
+          pending_chunks = 0,
+          search_tsv = EXCLUDED.search_tsv
+    """,
+    "delete_session": """
+        WITH ctx AS (DELETE FROM scribe_stt_context WHERE session_id = :id)
+        DELETE FROM scribe_sessions WHERE id = :id
+    """,
+    # Optimistic append: only applies when the caller's offset matches what's stored. Touching the session
+    # row leaves the (TOASTed) transcript alone, so an append costs the size of the delta.
+    "append_chunk": """
+        WITH s AS (
+          UPDATE scribe_sessions
+          SET transcript_len = transcript_len + char_length(:delta), chunk_seq = chunk_seq + 1,
+              pending_chunks = pending_chunks + 1, title = COALESCE(:title, title),
+              -- A new title replaces the title lexemes (weight A); the transcript ones (weight B) stay.
+              search_tsv = CASE WHEN COALESCE(:title, title) IS DISTINCT FROM title
+                                THEN setweight(to_tsvector('english', COALESCE(:title, '')), 'A') || ts_filter(COALESCE(search_tsv, ''), '{b}')
+                                ELSE search_tsv END
+          WHERE id = :id AND transcript_len = :offset
+          RETURNING chunk_seq, transcript_len, pending_chunks
+        ), c AS (
+          INSERT INTO scribe_session_chunks (session_id, seq, content) SELECT :id, chunk_seq, :delta FROM s
+        )
+        SELECT chunk_seq, transcript_len, pending_chunks FROM s
+    """,
+    "create_empty_session": """
+        INSERT INTO scribe_sessions (id, title, transcript, transcript_len, search_tsv)
+        VALUES (:id, :title, '', 0, setweight(to_tsvector('english', COALESCE(:title, '')), 'A'))
+        ON CONFLICT (id) DO NOTHING
+    """,
+    "session_length": "SELECT transcript_len FROM scribe_sessions WHERE id = :id",
+    # In-database compaction, for plain-text bases only; a compressed one is left alone (no rows returned)
+    # for _compact_session to do in Python.
+    "compact_session": """
+        WITH moved AS (
+          DELETE FROM scribe_session_chunks WHERE session_id = :id
+            AND NOT EXISTS (SELECT 1 FROM scribe_sessions WHERE id = :id AND transcript_z IS NOT NULL)
+          RETURNING seq, content
+        ), merged AS (SELECT COALESCE(string_agg(content, '' ORDER BY seq), '') AS text FROM moved)
+        UPDATE scribe_sessions
+        SET transcript = COALESCE(transcript, '') || merged.text,
+            search_tsv = COALESCE(search_tsv, '') || setweight(to_tsvector('english', merged.text), 'B'),
+            pending_chunks = 0
+        FROM merged
+        WHERE id = :id AND transcript_z IS NULL
+        RETURNING id
+    """,
+    "lock_session_base": "SELECT transcript, transcript_z FROM scribe_sessions WHERE id = :id FOR UPDATE",
+    "take_chunks": "DELETE FROM scribe_session_chunks WHERE session_id = :id RETURNING seq, content",
+    "put_session_base": """
+        UPDATE scribe_sessions
+        SET transcript = :transcript, transcript_z = :transcript_z, pending_chunks = 0,
+            search_tsv = COALESCE(search_tsv, '') || setweight(to_tsvector('english', :text), 'B')
+        WHERE id = :id
+    """,
+    "get_stt_context": "SELECT state FROM scribe_stt_context WHERE session_id = :id",
+    # A worker finishing an older chunk after a newer one must not roll the context back.
+    "put_stt_context": """
+        INSERT INTO scribe_stt_context (session_id, seq, state, updated_at) VALUES (:id, :seq, CAST(:state AS jsonb), CURRENT_TIMESTAMP)
+        ON CONFLICT (session_id) DO UPDATE SET seq = EXCLUDED.seq, state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+        WHERE scribe_stt_context.seq <= EXCLUDED.seq
+    """,
+    "expire_stt_context": "DELETE FROM scribe_stt_context WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => :ttl)",
+    "sessions_to_compact": "SELECT id FROM scribe_sessions WHERE pending_chunks >= :min_chunks ORDER BY pending_chunks DESC LIMIT :limit",
+    # Rows written before compression was turned on (or that have since grown past the threshold).
+    "sessions_to_pack": """
+        SELECT id FROM scribe_sessions WHERE transcript_z IS NULL AND transcript_len >= :min_chars
+        ORDER BY transcript_len DESC LIMIT :limit
+    """,
+    # Ranked full-text search. Chunks that haven't been compacted yet carry their own tsvector, so a
+    # session's score is the sum over its base row and pending chunks. Both sides are GIN index scans;
+    # ts_headline only runs on the page being returned. Snippet highlights use \x02/\x03 so the route can
+    # HTML-escape the text around them. A compressed base comes back as-is (with its pending text) for
+    # the route to decompress and headline.
+    "search_sessions": f"""
+        WITH q AS (SELECT websearch_to_tsquery('english', :q) AS query),
+        hits AS (
+          SELECT s.id, ts_rank_cd(s.search_tsv, q.query) AS rank FROM scribe_sessions s, q WHERE s.search_tsv @@ q.query
+          UNION ALL
+          SELECT c.session_id, ts_rank_cd(c.search_tsv, q.query) FROM scribe_session_chunks c, q WHERE c.search_tsv @@ q.query
+        ),
+        ranked AS (SELECT id, sum(rank)::float8 AS rank FROM hits GROUP BY id)
+        SELECT s.id, s.title, s.created_at, r.rank,
+               CASE WHEN s.transcript_z IS NULL
+                    THEN ts_headline('english', COALESCE(s.transcript, '') || COALESCE({PENDING_TEXT}, ''), q.query, '{HEADLINE_OPTIONS}') END,
+               s.transcript_z, CASE WHEN s.transcript_z IS NOT NULL THEN {PENDING_TEXT} END
+        FROM ranked r JOIN scribe_sessions s ON s.id = r.id, q
+        WHERE (CAST(:rank AS float8) IS NULL OR (r.rank, s.id) < (CAST(:rank AS float8), CAST(:sid AS varchar)))
+        ORDER BY r.rank DESC, s.id DESC
+        LIMIT :limit
+    """,
+    "headline": f"SELECT ts_headline('english', :text, websearch_to_tsquery('english', :q), '{HEADLINE_OPTIONS}')",
+}
+
+# Off by default: compressed bases can't be searched for snippets or compacted inside Postgres, so those
+# steps move into Python. Short transcripts stay plain; zlib gains little on them and TOAST covers the rest.
+TRANSCRIPT_COMPRESSION = os.getenv("SESSION_COMPRESSION", "").lower() == "zlib"
+TRANSCRIPT_COMPRESS_MIN_CHARS = int(os.getenv("SESSION_COMPRESS_MIN_CHARS", 4096))
+TRANSCRIPT_COMPRESS_LEVEL = int(os.getenv("SESSION_COMPRESS_LEVEL", 6))
+
+def _pack_transcript(text):
+    """(transcript, transcript_z) column values for a base transcript."""
+    if TRANSCRIPT_COMPRESSION and len(text) >= TRANSCRIPT_COMPRESS_MIN_CHARS:
+        with timed("transcript_compress"): return None, zlib.compress(text.encode(), TRANSCRIPT_COMPRESS_LEVEL)
+    return text, None
+
+def _unpack_transcript(text, packed, pending=None, max_chars=None):
+    """A session's text from its plain or compressed base plus pending chunks; `max_chars` decodes just a prefix."""
+    if packed is None: base = text or ""
+    elif max_chars is None:
+        with timed("transcript_decompress"): base = zlib.decompress(bytes(packed)).decode()
+    else:
+        # Works on a truncated stream too (see the `preview` field): zlib yields whatever the bytes cover.
+        base = zlib.decompressobj().decompress(bytes(packed), max_chars * 4).decode(errors="ignore")[:max_chars]
+    full = base + (pending or "")
+    return full if max_chars is None else full[:max_chars]
+
+def _compact_session(db, pc, session_id):
+    """Fold a session's pending chunks into its base transcript, compressing it as configured."""
+    if not TRANSCRIPT_COMPRESSION and db.run(pc, "compact_session", id=session_id): return
+    pc.conn.run("BEGIN")
     try:
+        base = db.run(pc, "lock_session_base", id=session_id)
+        if base:
+            tail = "".join(content for _, content in sorted(db.run(pc, "take_chunks", id=session_id)))
+            transcript, packed = _pack_transcript(_unpack_transcript(*base[0]) + tail)
+            db.run(pc, "put_session_base", id=session_id, transcript=transcript, transcript_z=packed, text=tail)
+        pc.conn.run("COMMIT")
+    except Exception:
+        pc.conn.run("ROLLBACK")
+        raise
+
+class PoolTimeout(Exception): ...
+
+class _PooledConn:
+    __slots__ = ("conn", "created", "last_used", "statements")
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.last_used = time.monotonic()
+        self.statements = {}
+
+class DBPool:
+    """Bounded pool of pg8000 connections.
+
+    Idle connections are reused LIFO, pinged before reuse once they've been idle a while, and closed
+    after `max_idle` seconds so the database's connection slots aren't held by a quiet worker.
+    """
+    WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, db_url, max_size=5, timeout=5.0, max_idle=300.0, ping_after=30.0):
         parsed = urllib.parse.urlparse(db_url)
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        return pg8000.dbapi.connect(
-            user=parsed.username,
-            password=parsed.password,
-            host=parsed.hostname,
-            database=parsed.path[1:],
-            port=parsed.port or 5432,
-            ssl_context=context
+        self._params = dict(user=parsed.username, password=parsed.password, host=parsed.hostname,
+                            database=parsed.path[1:], port=parsed.port or 5432)
+        self._ssl = ssl.create_default_context()
+        self._ssl.check_hostname = False
+        self._ssl.verify_mode = ssl.CERT_NONE
+        self.max_size, self.timeout, self.max_idle, self.ping_after = max_size, timeout, max_idle, ping_after
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._stats = {"created": 0, "recycled": 0, "discarded": 0, "checkouts": 0, "timeouts": 0,
+                       "wait_count": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0,
+                       "wait_buckets": {b: 0 for b in self.WAIT_BUCKETS_MS}}
+
+    def _connect(self):
+        global db_error
+        try:
+            conn = pg_native.Connection(**self._params, ssl_context=self._ssl)
+        except Exception as e:
+            db_error = f"Connect error: {e}"
+            raise
+        db_error = None
+        self._bump("created")
+        return _PooledConn(conn)
+
+    def _bump(self, name):
+        with self._cond: self._stats[name] += 1
+
+    @staticmethod
+    def _close(pc):
+        try: pc.conn.close()
+        except Exception: pass
+
+    def _record_wait(self, ms):
+        st = self._stats
+        st["wait_count"] += 1
+        st["wait_total_ms"] += ms
+        st["wait_max_ms"] = max(st["wait_max_ms"], ms)
+        for b in self.WAIT_BUCKETS_MS:
+            if ms <= b: st["wait_buckets"][b] += 1; break
+
+    def _checkout(self):
+        t0 = time.monotonic()
+        deadline = t0 + self.timeout
+        expired = []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                # Oldest idle connections sit at the left; recycle the ones past max_idle.
+                while self._idle and now - self._idle[0].last_used > self.max_idle:
+                    expired.append(self._idle.popleft())
+                    self._size -= 1
+                    self._stats["recycled"] += 1
+                if self._idle:
+                    pc = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    pc = None
+                    break
+                if now >= deadline:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available within {self.timeout:.1f}s")
+                self._cond.wait(deadline - now)
+            self._stats["checkouts"] += 1
+            self._record_wait((time.monotonic() - t0) * 1000)
+        for old in expired: self._close(old)
+
+        if pc is not None and time.monotonic() - pc.last_used > self.ping_after:
+            try: pc.conn.run("SELECT 1")
+            except Exception:
+                log.info("Pooled DB connection failed liveness check, reconnecting")
+                self._close(pc)
+                self._bump("discarded")
+                pc = None
+        if pc is None:
+            try: pc = self._connect()
+            except Exception:
+                self._release(None)
+                raise
+        return pc
+
+    def _release(self, pc):
+        with self._cond:
+            if pc is None: self._size -= 1
+            else:
+                pc.last_used = time.monotonic()
+                self._idle.append(pc)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        with timed("db_checkout"): pc = self._checkout()
+        try:
+            yield pc
+        except (pg_errors.InterfaceError, OSError):
+            # Network drop or protocol error: the socket is in an unknown state.
+            self._discard(pc)
+            raise
+        except Exception:
+            # A SQL error, or one in the caller's own code: the session is fine once no transaction is left open.
+            try: pc.conn.run("ROLLBACK")
+            except Exception: self._discard(pc)
+            else: self._release(pc)
+            raise
+        except BaseException:
+            self._discard(pc)
+            raise
+        else:
+            self._release(pc)
+
+    def _discard(self, pc):
+        self._close(pc)
+        self._bump("discarded")
+        self._release(None)
+
+    @staticmethod
+    def run(pc, name, sql=None, **params):
+        """Run a prepared statement by name; `sql` supplies the text for generated (e.g. projected) queries."""
+        with timed("db_query", query=name.split(":")[0]):
+            stmt = pc.statements.get(name)
+            if stmt is None:
+                stmt = pc.statements[name] = pc.conn.prepare(sql or SQL[name])
+            return stmt.run(**params)
+
+    def stats(self):
+        with self._cond:
+            st = dict(self._stats, wait_buckets=dict(self._stats["wait_buckets"]))
+            st.update(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle), max_size=self.max_size)
+            st["wait_avg_ms"] = round(st["wait_total_ms"] / st["wait_count"], 3) if st["wait_count"] else 0.0
+            return st
+
+# ---------- Schema ----------
+# Applied in order, once per database, and recorded in scribe_schema_version. Every statement is idempotent,
+# so databases set up by the old unversioned startup DDL just get their version rows filled in.
+MIGRATIONS = [
+    (1, "sessions table", [
+        """
+        CREATE TABLE IF NOT EXISTS scribe_sessions (
+            id VARCHAR(255) PRIMARY KEY,
+            title VARCHAR(255),
+            transcript TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    except Exception as e:
-        db_error = f"Connect error: {e}"
-        return None
+        """,
+        # Serves the history list's ORDER BY / keyset scan without sorting the table.
+        "CREATE INDEX IF NOT EXISTS scribe_sessions_created_at_id_idx ON scribe_sessions (created_at DESC, id DESC)",
+    ]),
+    (2, "append-only transcript chunks", [
+        # Running length/sequence on the session, deltas in their own table.
+        "ALTER TABLE scribe_sessions ADD COLUMN IF NOT EXISTS transcript_len INTEGER",
+        "ALTER TABLE scribe_sessions ADD COLUMN IF NOT EXISTS chunk_seq INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE scribe_sessions ADD COLUMN IF NOT EXISTS pending_chunks INTEGER NOT NULL DEFAULT 0",
+        "UPDATE scribe_sessions SET transcript_len = char_length(COALESCE(transcript, '')) WHERE transcript_len IS NULL",
+        """
+        CREATE TABLE IF NOT EXISTS scribe_session_chunks (
+            session_id VARCHAR(255) NOT NULL REFERENCES scribe_sessions(id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (session_id, seq)
+        )
+        """,
+    ]),
+    (3, "full-text search", [
+        # Generated tsvectors (title weighted above transcript) with GIN indexes; ADD COLUMN ... GENERATED
+        # backfills existing rows as part of the ALTER.
+        """
+        ALTER TABLE scribe_sessions ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', COALESCE(title, '')), 'A') ||
+            setweight(to_tsvector('english', COALESCE(transcript, '')), 'B')
+        ) STORED
+        """,
+        "ALTER TABLE scribe_session_chunks ADD COLUMN IF NOT EXISTS search_tsv tsvector "
+        "GENERATED ALWAYS AS (setweight(to_tsvector('english', content), 'B')) STORED",
+        "CREATE INDEX IF NOT EXISTS scribe_sessions_search_idx ON scribe_sessions USING GIN (search_tsv)",
+        "CREATE INDEX IF NOT EXISTS scribe_session_chunks_search_idx ON scribe_session_chunks USING GIN (search_tsv)",
+    ]),
+    (4, "shared STT session context", [
+        # Written on every transcribed chunk and rebuildable, so UNLOGGED: no WAL. Not keyed to scribe_sessions,
+        # since transcription starts before a session is saved.
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS scribe_stt_context (
+            session_id VARCHAR(255) PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS scribe_stt_context_updated_at_idx ON scribe_stt_context (updated_at)",
+    ]),
+    (5, "compressed transcripts", [
+        # A row's base text is in `transcript` or, zlib-compressed, in `transcript_z`; never both. Existing
+        # rows are compressed in batches by the compaction job once SESSION_COMPRESSION is on.
+        "ALTER TABLE scribe_sessions ADD COLUMN IF NOT EXISTS transcript_z BYTEA",
+        # Postgres can't read transcript_z, so search_tsv becomes a plain column (values kept) that the writes maintain.
+        "ALTER TABLE scribe_sessions ALTER COLUMN search_tsv DROP EXPRESSION IF EXISTS",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+SCHEMA_LOCK_ID = 7261001  # pg_advisory_lock key: one instance migrates, concurrent cold starts wait for it
+
+def _schema_version(pc):
+    if pc.conn.run("SELECT to_regclass('scribe_schema_version') IS NULL")[0][0]: return 0
+    return pc.conn.run("SELECT COALESCE(MAX(version), 0) FROM scribe_schema_version")[0][0]
+
+def migrate(pc):
+    """Bring the database up to SCHEMA_VERSION. Each migration commits together with its version row."""
+    version = _schema_version(pc)
+    if version >= SCHEMA_VERSION: return version
+    pc.conn.run("SELECT pg_advisory_lock(:id)", id=SCHEMA_LOCK_ID)
+    try:
+        pc.conn.run("CREATE TABLE IF NOT EXISTS scribe_schema_version "
+                    "(version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        version = _schema_version(pc)  # another instance may have finished while we waited for the lock
+        for number, name, statements in MIGRATIONS:
+            if number <= version: continue
+            log.info("Applying schema migration %d (%s)", number, name)
+            pc.conn.run("BEGIN")
+            try:
+                for sql in statements: pc.conn.run(sql)
+                pc.conn.run("INSERT INTO scribe_schema_version (version, name) VALUES (:v, :name)", v=number, name=name)
+                pc.conn.run("COMMIT")
+            except Exception:
+                pc.conn.run("ROLLBACK")
+                raise
+            version = number
+        return version
+    finally:
+        pc.conn.run("SELECT pg_advisory_unlock(:id)", id=SCHEMA_LOCK_ID)
 
-# Initialize table
-try:
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS scribe_sessions (
-                id VARCHAR(255) PRIMARY KEY,
-                title VARCHAR(255),
-                transcript TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+_db_pool = None
+_db_pool_lock = threading.Lock()
+schema_version = None  # set once the first DB request has checked/migrated the schema
+_schema_lock = threading.Lock()
+
+def _ensure_schema(pool):
+    global schema_version, db_error
+    with _schema_lock:
+        if schema_version is not None: return
+        try:
+            with pool.connection() as pc: schema_version = migrate(pc)
+            db_error = None
+        except Exception as e:
+            # Leave it unset so the next request tries again; the route's own query reports the failure.
+            db_error = f"Schema migration failed: {e}"
+            log.exception("schema migration failed")
+
+def get_db():
+    """The connection pool, created (and the schema checked) on first use rather than at import."""
+    global _db_pool, db_error
+    if db_error and db_error.startswith("Import error"): return None
+    db_url = os.environ.get("POSTGRES_URL")
+    if not db_url: return None
+    with _db_pool_lock:
+        if _db_pool is None:
+            try: importlib.import_module("pg8000.native")
+            except Exception as e:
+                db_error = f"Import error: {e}"
+                return None
+            _db_pool = DBPool(
+                db_url,
+                max_size=int(os.getenv("DB_POOL_SIZE", 5)),
+                timeout=float(os.getenv("DB_POOL_TIMEOUT", 5)),
+                max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 300)),
+                ping_after=float(os.getenv("DB_POOL_PING_AFTER", 30)),
             )
-        """)
-        cur.close()
-        conn.commit()
-        conn.close()
-except:
-    pass
+        pool = _db_pool
+    if schema_version is None: _ensure_schema(pool)
+    return pool
 
 @app.get("/favicon.ico")
 @app.get("/favicon.png")
@@ -327,30 +2013,184 @@ def root():
 </html>
     """, 200, {"Content-Type": "text/html"}
 
+@app.before_request
+def _start_request_timing():
+    # The rule, not the path, so /api/sessions/<id> is one series.
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    begin_request_timing(route)
+    begin_request_deadline(route, request.headers.get(DEADLINE_HEADER))
+
+@app.before_request
+def _admit_client():
+    # Cheap rejection before the body is read: an over-rate client costs a header parse, not an upload.
+    if request.method == "OPTIONS" or not request.url_rule: return None
+    try: ADMISSION.check_client(request.url_rule.rule, request.headers, request.remote_addr)
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return jsonify(body), 429, headers
+
+@app.after_request
+def _finish_request_timing(resp):
+    timings = current_timings()
+    if timings:
+        METRICS.inc("scribe_requests_total", route=timings.route, method=request.method, status=resp.status_code)
+        resp.headers.add("Server-Timing", timings.header())
+    return resp
+
+@app.get("/metrics")
+@app.get("/api/metrics")
+def metrics():
+    return Response(METRICS.render(), 200, mimetype="text/plain; version=0.0.4")
+
 @app.get("/health")
-def health(): return jsonify({"status":"ok", "db_error": db_error}), 200
+def health():
+    return jsonify({"status":"ok", "db_error": db_error, "db_pool": _db_pool.stats() if _db_pool else None, "schema_version": schema_version,
+                    "clients": CLIENTS.stats(), "stt_breakers": STT.stats(), "gemini_models": GEMINI_ROUTER.stats(),
+                    "answer_cache": ANSWER_CACHE.stats(), "images": IMAGE_PIPELINE.stats(), "image_fetch": IMAGE_FETCH.stats(), "stt_skips": STT_SKIPS.stats(),
+                    "stt_context": SESSION_CONTEXT.stats(),
+                    "summary_cache": SUMMARIZER.cache.stats(),
+                    "admission": ADMISSION.stats()}), 200
 
 # -------- Sessions API (Postgres) --------
+SESSION_COLS = ("id", "title", "transcript", "created_at")
+# Projectable columns for the list view; `preview` lets it show a snippet without pulling whole transcripts.
+SESSION_FIELDS = {
+    "id": "s.id", "title": "s.title", "created_at": "s.created_at",
+    "transcript": TRANSCRIPT_PARTS,
+    # Only the first few chunks are needed for a snippet, so don't aggregate the whole session; a compressed
+    # base sends just its first KiB, which decodes to well over 200 characters.
+    "preview": ("LEFT(s.transcript, 200), substring(s.transcript_z FROM 1 FOR 1024), (SELECT string_agg(f.content, '' ORDER BY f.seq) FROM "
+                "(SELECT content, seq FROM scribe_session_chunks c WHERE c.session_id = s.id ORDER BY seq LIMIT 8) f)"),
+}
+# Fields selected as (plain base, compressed base, pending text) and put back together in Python.
+SESSION_TEXT_FIELDS = {"transcript": None, "preview": 200}
+
+def _session_row(cols, values):
+    row, values = {}, iter(values)
+    for c in cols:
+        if c in SESSION_TEXT_FIELDS:
+            row[c] = _unpack_transcript(next(values), next(values), next(values), SESSION_TEXT_FIELDS[c])
+        else: row[c] = next(values)
+    return row
+
+def _json_compressed(payload, status=200, headers=None):
+    """JSON response, gzipped when the client accepts it and the body is big enough to be worth it."""
+    body = app.json.dumps(payload).encode()
+    headers = dict(headers or {}, Vary="Accept-Encoding")
+    if len(body) > 1024 and "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, status, headers, mimetype="application/json")
+
+def _encode_cursor(row):
+    raw = json.dumps([row["created_at"].isoformat(), row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    try:
+        ts, sid = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(ts), sid
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
 @app.get("/api/sessions")
 def get_sessions():
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": f"No database attached. {db_error}"}), 503
+    """Newest-first page of sessions. `?fields=` picks columns, `?cursor=` continues from X-Next-Cursor."""
+    db = get_db()
+    if not db: return jsonify({"error": f"No database attached. {db_error}"}), 503
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, title, transcript, created_at FROM scribe_sessions ORDER BY created_at DESC LIMIT 50")
-        cols = [desc[0] for desc in cur.description]
-        rows = [dict(zip(cols, row)) for row in cur.fetchall()]
-        cur.close()
-        
+        fields = [f for f in request.args.get("fields", ",".join(SESSION_COLS)).split(",") if f]
+        if any(f not in SESSION_FIELDS for f in fields): return jsonify({"error": "Unknown field"}), 400
+        # id and created_at drive the cursor, so they're always selected.
+        cols = ["id", "created_at"] + [f for f in dict.fromkeys(fields) if f not in ("id", "created_at")]
+        limit = max(1, min(int(request.args.get("limit", 50)), 200))
+        # Decoded before checking out a connection: a bad cursor shouldn't cost the pool anything.
+        after = _decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+
+        select = f"SELECT {', '.join(SESSION_FIELDS[c] for c in cols)} FROM scribe_sessions s"
+        order = "ORDER BY s.created_at DESC, s.id DESC LIMIT :limit"
+        with db.connection() as pc:
+            if after:
+                ts, sid = after
+                sql = f"{select} WHERE (s.created_at, s.id) < (:ts, :sid) {order}"
+                result = db.run(pc, f"list_sessions_after:{','.join(cols)}", sql, ts=ts, sid=sid, limit=limit)
+            else:
+                result = db.run(pc, f"list_sessions:{','.join(cols)}", f"{select} {order}", limit=limit)
+            rows = [_session_row(cols, row) for row in result]
+
+        headers = {"X-Next-Cursor": _encode_cursor(rows[-1])} if len(rows) == limit and rows[-1]["created_at"] else {}
         # Convert datetime to string
         for r in rows:
             if r.get('created_at'): r['started_at'] = r['created_at'].isoformat()
-        return jsonify(rows), 200
+        return _json_compressed([{k: v for k, v in r.items() if k in fields or k == "started_at"} for r in rows], 200, headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         log.exception("get sessions failed")
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+def _highlight(snippet):
+    """ts_headline output -> HTML: escape the transcript text, wrap matches in <mark>."""
+    parts = (snippet or "").split("\x02")
+    out = [html.escape(parts[0])]
+    for part in parts[1:]:
+        hit, _, rest = part.partition("\x03")
+        out.append(f"<mark>{html.escape(hit)}</mark>{html.escape(rest)}")
+    return "".join(out)
+
+@app.get("/api/sessions/search")
+def search_sessions():
+    """Ranked full-text search: `?q=` (web-search syntax), `?limit=`, `?cursor=` from X-Next-Cursor."""
+    q = request.args.get("q", "").strip()
+    if not q: return jsonify({"error": "Missing q"}), 400
+    db = get_db()
+    if not db: return jsonify({"error": f"No database attached. {db_error}"}), 503
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 100))
+        rank = sid = None
+        if request.args.get("cursor"):
+            try:
+                rank, sid = json.loads(base64.urlsafe_b64decode(request.args["cursor"] + "=" * (-len(request.args["cursor"]) % 4)))
+                rank, sid = float(rank), str(sid)
+            except (ValueError, TypeError):
+                raise ValueError("Invalid cursor")
+        with db.connection() as pc:
+            result = db.run(pc, "search_sessions", q=q, rank=rank, sid=sid, limit=limit)
+            rows = [{"id": r[0], "title": r[1], "started_at": r[2].isoformat() if r[2] else None, "rank": r[3],
+                     "snippet": _highlight(r[4] if r[5] is None else
+                                           db.run(pc, "headline", text=_unpack_transcript(None, r[5], r[6]), q=q)[0][0])}
+                    for r in result]
+        headers = {}
+        if len(rows) == limit:
+            raw = json.dumps([rows[-1]["rank"], rows[-1]["id"]])
+            headers["X-Next-Cursor"] = base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+        return _json_compressed(rows, 200, headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        log.exception("search sessions failed")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/api/sessions/<session_id>")
+def get_session(session_id):
+    db = get_db()
+    if not db: return jsonify({"error": f"No database attached. {db_error}"}), 503
+    try:
+        with db.connection() as pc:
+            result = db.run(pc, "get_session", id=session_id)
+        if not result: return jsonify({"error": "Not found"}), 404
+        row = _session_row(SESSION_COLS + ("length",), result[0])
+        if row.get('created_at'): row['started_at'] = row['created_at'].isoformat()
+        return _json_compressed(row)
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        log.exception("get session failed")
+        return jsonify({"error": str(e)}), 500
 
 @app.post("/api/sessions")
 def save_session():
@@ -360,196 +2200,1025 @@ def save_session():
     transcript = data.get("transcript", "")
     if not sid: return jsonify({"error": "Missing id"}), 400
     
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "No database attached"}), 503
+    db = get_db()
+    if not db: return jsonify({"error": "No database attached"}), 503
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO scribe_sessions (id, title, transcript) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET 
-              title = EXCLUDED.title, 
-              transcript = EXCLUDED.transcript
-        """, (sid, title, transcript))
-        cur.close()
-        conn.commit()
-        return jsonify({"status": "saved", "id": sid}), 200
+        plain, packed = _pack_transcript(transcript)
+        with db.connection() as pc:
+            db.run(pc, "save_session", id=sid, title=title, transcript=plain, transcript_z=packed, length=len(transcript), text=transcript)
+        return jsonify({"status": "saved", "id": sid, "length": len(transcript)}), 200
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         log.exception("save session failed")
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+@app.patch("/api/sessions/<session_id>/append")
+def append_session(session_id):
+    """Append `delta` at `offset` (the stored length in characters); a stale offset gets 409 with the real length."""
+    data = request.get_json(force=True) or {}
+    delta, offset, title = data.get("delta", ""), data.get("offset"), data.get("title")
+    if not isinstance(offset, int) or not isinstance(delta, str): return jsonify({"error": "Need integer offset and string delta"}), 400
+
+    db = get_db()
+    if not db: return jsonify({"error": "No database attached"}), 503
+    try:
+        with db.connection() as pc:
+            if not delta:
+                current = db.run(pc, "session_length", id=session_id)
+                return jsonify({"status": "appended", "id": session_id, "length": current[0][0] if current else 0}), 200
+            result = db.run(pc, "append_chunk", id=session_id, delta=delta, offset=offset, title=title)
+            if not result and offset == 0:
+                db.run(pc, "create_empty_session", id=session_id, title=title or "Untitled session")
+                result = db.run(pc, "append_chunk", id=session_id, delta=delta, offset=offset, title=title)
+            if not result:
+                current = db.run(pc, "session_length", id=session_id)
+                if not current: return jsonify({"error": "Not found"}), 404
+                return jsonify({"error": "Offset mismatch", "length": current[0][0]}), 409
+            seq, length, pending = result[0]
+            # Fold chunks back into the base row now and then, so reads don't aggregate an ever-growing list.
+            if pending >= int(os.getenv("SESSION_COMPACT_CHUNKS", 100)):
+                _compact_session(db, pc, session_id)
+        return jsonify({"status": "appended", "id": session_id, "seq": seq, "length": length}), 200
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        log.exception("append session failed")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/sessions/compact", methods=["GET", "POST"])
+def compact_sessions():
+    """Compaction job (Vercel cron calls it with GET): merges pending chunks of the busiest sessions, and with
+    SESSION_COMPRESSION on, compresses long plain-text transcripts (a batch of `limit` per run)."""
+    secret = os.getenv("CRON_SECRET")
+    if secret and request.headers.get("Authorization") != f"Bearer {secret}": return jsonify({"error": "Unauthorized"}), 401
+    db = get_db()
+    if not db: return jsonify({"error": "No database attached"}), 503
+    try:
+        with db.connection() as pc:
+            limit = int(request.args.get("limit", 100))
+            ids = [r[0] for r in db.run(pc, "sessions_to_compact", min_chunks=int(request.args.get("min_chunks", 1)), limit=limit)]
+            packing = [r[0] for r in db.run(pc, "sessions_to_pack", min_chars=TRANSCRIPT_COMPRESS_MIN_CHARS, limit=limit)
+                       if r[0] not in ids] if TRANSCRIPT_COMPRESSION else []
+            for sid in ids + packing: _compact_session(db, pc, sid)
+            db.run(pc, "expire_stt_context", ttl=float(os.getenv("STT_CONTEXT_TTL", 86400)))
+        return jsonify({"status": "compacted", "sessions": len(ids), "compressed": len(packing)}), 200
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        log.exception("compact sessions failed")
+        return jsonify({"error": str(e)}), 500
 
 @app.delete("/api/sessions/<session_id>")
 def delete_session(session_id):
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "No database attached"}), 503
+    db = get_db()
+    if not db: return jsonify({"error": "No database attached"}), 503
     try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM scribe_sessions WHERE id = %s", (session_id,))
-        cur.close()
-        conn.commit()
+        with db.connection() as pc:
+            db.run(pc, "delete_session", id=session_id)
+        SESSION_CONTEXT.forget(session_id)
         return jsonify({"status": "deleted"}), 200
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+# -------- Session summaries (map-reduce) --------
+# The map prompt carries no segment number or count: those change as the session grows and would make
+# every cached segment summary miss.
+SUMMARY_PROMPT = "Summarize this meeting transcript concisely in bullet points:\n{text}"
+SUMMARY_MAP_PROMPT = ("Summarize this excerpt of a longer meeting transcript in concise bullet points. Keep decisions, "
+                      "action items, names, numbers and open questions; drop small talk.\n\n{text}")
+SUMMARY_REDUCE_PROMPT = ("These are bullet-point summaries of consecutive parts of one meeting transcript, in order. Merge "
+                         "them into one concise summary in bullet points, without repeats, keeping decisions, action items "
+                         "and open questions.\n\n{text}")
+
+def _text_tokens(text): return math.ceil(len(text) / 4)  # ~4 characters per token: close enough for budgeting
+
+def _pack(units, max_chars, sep=" "):
+    """Greedily join `units` into pieces of at most `max_chars` (a unit longer than that stands alone)."""
+    pieces, current = [], ""
+    for unit in units:
+        if current and len(current) + len(sep) + len(unit) > max_chars:
+            pieces.append(current)
+            current = unit
+        else:
+            current = f"{current}{sep}{unit}" if current else unit
+    if current: pieces.append(current)
+    return pieces
+
+def _split_segments(text, max_tokens):
+    """Token-bounded segments cut at sentence boundaries (word boundaries inside an overlong sentence).
+
+    Packing is greedy from the start, so appending to a transcript only ever changes its last segment.
+    """
+    max_chars = max_tokens * 4
+    units = []
+    for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+        units.extend([sentence] if len(sentence) <= max_chars else _pack(sentence.split(), max_chars))
+    return _pack([u for u in units if u], max_chars)
+
+class SessionSummarizer:
+    """Map-reduce summaries for transcripts too long for one prompt.
+
+    Segments of `segment_tokens` are summarized in parallel, at most `concurrency` calls at a time across
+    the process, then the segment summaries are merged by one more call (in rounds while they don't fit a
+    single prompt). Each call's output is cached under a hash of provider, model and prompt, so a session
+    that has grown since its last summary only pays for its new segments and the merge.
+    """
+    def __init__(self, cache, segment_tokens=3000, concurrency=4):
+        self.cache, self.segment_tokens = cache, segment_tokens
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="summary")
+
+    def _generate(self, provider_name, provider, prompt):
+        with ADMISSION.gate(provider_name).admit(PRIORITIES["summary"], ADMISSION.timeout("summary")):
+            result = provider.get_response(transcript=prompt)
+        if "error" in result: raise RuntimeError(result["error"])
+        return result["answer"]
+
+    def _run(self, provider_name, provider, prompts, stats):
+        """Outputs for `prompts`, in order: cached ones straight away, the rest on the pool."""
+        outputs, pending = [None] * len(prompts), {}
+        for i, prompt in enumerate(prompts):
+            key = self.cache.key(f"summary:{provider_name}", provider.model_name, prompt) if self.cache.enabled else None
+            cached = self.cache.get(key)[0] if key else None
+            if cached:
+                outputs[i] = cached["answer"]
+                stats["cached"] += 1
+                continue
+            # copy_context: the upstream calls land in this request's Server-Timing.
+            pending[self._pool.submit(contextvars.copy_context().run, self._generate, provider_name, provider, prompt)] = (i, key)
+        for fut, (i, key) in pending.items():
+            outputs[i] = fut.result()
+            stats["generated"] += 1
+            if key: self.cache.put(key, {"answer": outputs[i]})
+        return outputs
+
+    def summarize(self, provider_name, provider, transcript):
+        """(summary, stats) for `transcript`."""
+        segments = _split_segments(transcript, self.segment_tokens)
+        stats = {"segments": len(segments), "cached": 0, "generated": 0, "reduce_rounds": 0}
+        if len(segments) <= 1:
+            return self._run(provider_name, provider, [SUMMARY_PROMPT.format(text=transcript.strip())], stats)[0], stats
+        parts = self._run(provider_name, provider, [SUMMARY_MAP_PROMPT.format(text=seg) for seg in segments], stats)
+        max_chars = self.segment_tokens * 4
+        while _text_tokens("\n\n".join(parts)) > self.segment_tokens:
+            groups = _pack(parts, max_chars, "\n\n")
+            if len(groups) >= len(parts): break  # each summary already fills a prompt; merge what we have
+            parts = self._run(provider_name, provider, [SUMMARY_REDUCE_PROMPT.format(text=g) for g in groups], stats)
+            stats["reduce_rounds"] += 1
+        summary = self._run(provider_name, provider, [SUMMARY_REDUCE_PROMPT.format(text="\n\n".join(parts))], stats)[0]
+        stats["reduce_rounds"] += 1
+        return summary, stats
+
+SUMMARIZER = SessionSummarizer(
+    AnswerCache(
+        max_bytes=int(os.getenv("SUMMARY_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+        ttl=float(os.getenv("SUMMARY_CACHE_TTL", 7 * 86400)),
+        disk_dir=os.getenv("SUMMARY_CACHE_DIR") or None,
+    ),
+    segment_tokens=int(os.getenv("SUMMARY_SEGMENT_TOKENS", 3000)),
+    concurrency=int(os.getenv("SUMMARY_CONCURRENCY", 4)),
+)
+
+@app.get("/api/sessions/<session_id>/summary")
+def summarize_session(session_id):
+    db = get_db()
+    if not db: return jsonify({"error": f"No database attached. {db_error}"}), 503
+    try:
+        with db.connection() as pc:
+            result = db.run(pc, "get_session", id=session_id)
+        if not result: return jsonify({"error": "Not found"}), 404
+        transcript = _unpack_transcript(*result[0][2:5])
+        if not transcript.strip(): return jsonify({"error": "Session has no transcript"}), 400
+        provider_name = request.args.get("provider", "google")
+        provider = get_provider(provider_name, request.args.get("model"))
+        t0 = time.perf_counter()
+        summary, stats = SUMMARIZER.summarize(provider_name, provider, transcript)
+        return jsonify({"id": session_id, "summary": summary, "model": provider.model_name, "length": len(transcript),
+                        **stats, "elapsed_ms": round((time.perf_counter() - t0) * 1000)}), 200
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return jsonify(body), 429, headers
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 502
+    except Exception as e:
+        log.exception("summarize session failed")
+        return jsonify({"error": str(e)}), 500
+
+def _is_binary_body():
+    mt = request.mimetype
+    return mt.startswith(("audio/", "video/", "image/")) or mt == "application/octet-stream"
+
+def _upload_bytes(f):
+    # getvalue() hands back the BytesIO's own buffer, so this is not another copy of the upload.
+    return f.stream.getvalue() if isinstance(f.stream, BytesIO) else f.read()
+
+def _answer_payload():
+    """Answer inputs from JSON, multipart (`images` file parts) or a raw image body (fields in the query string)."""
+    if request.mimetype == "multipart/form-data":
+        data = request.form.to_dict()
+        images = [_upload_bytes(f) for f in request.files.getlist("images")]
+    elif _is_binary_body():
+        data = request.args.to_dict()
+        images = [request.get_data(cache=False)]
+    else:
+        return request.get_json(force=True) or {}
+    if images: data["imageArray"] = images
+    return data
+
+def _no_cache():
+    return "no-cache" in request.headers.get("Cache-Control", "")
+
+def _answer_job(data, no_cache=False, priority="answer"):
+    """One answer, from answer()'s input shape: (result, cache headers). Upstream failures come back as an
+    {"error"} result; bad input, admission and deadline failures raise."""
+    provider_name = data.get("provider","google")
+    provider = get_provider(provider_name, data.get("model"))
+    cache_key = _answer_cache_key(provider_name, provider, data, no_cache)
+    if cache_key:
+        cached, tier = ANSWER_CACHE.get(cache_key)
+        if cached: return cached, {"X-Cache": "HIT", "X-Cache-Tier": tier}
+    report = _prepare_images(provider_name, data)
+    with ADMISSION.gate(provider_name).admit(PRIORITIES[priority], ADMISSION.timeout(priority)):
+        result = provider.get_response(transcript=data.get("transcript"), image_url=data.get("imageUrl"),
+                                       image_base64=data.get("imageBase64"), image_array=data.get("imageArray"))
+    if "error" in result: return result, {}
+    if cache_key and _cacheable(provider, result.get("model")): ANSWER_CACHE.put(cache_key, result)
+    if report: result = {**result, "images": report}
+    return result, {"X-Cache": "MISS" if cache_key else "BYPASS"}
 
 @app.post("/api/answer")
 def answer():
     try:
-        data = request.get_json(force=True) or {}
-        provider_name = data.get("provider","google")
-        transcript = data.get("transcript")
-        image_url = data.get("imageUrl")
-        image_base64 = data.get("imageBase64")
-        image_array = data.get("imageArray")
-
-        provider = get_provider(provider_name)
-        result = provider.get_response(transcript=transcript, image_url=image_url, image_base64=image_base64, image_array=image_array)
-        if "error" in result: return jsonify(result), 400
-        return jsonify(result), 200
+        with timed("upload_read"): data = _answer_payload()
+        result, headers = _answer_job(data, _no_cache())
+        return jsonify(result), 400 if "error" in result else 200, headers
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return jsonify(body), 429, headers
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         log.exception("answer failed")
         return jsonify({"error":"Server error"}), 500
 
+@app.post("/api/answer/stream")
+def answer_stream():
+    try:
+        with timed("upload_read"): data = _answer_payload()
+        provider_name = data.get("provider","google")
+        provider = get_provider(provider_name, data.get("model"))
+        cache_key = _answer_cache_key(provider_name, provider, data, _no_cache())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "MISS" if cache_key else "BYPASS"}
+
+    if cache_key:
+        cached, tier = ANSWER_CACHE.get(cache_key)
+        if cached:
+            headers.update({"X-Cache": "HIT", "X-Cache-Tier": tier})
+            body = _sse({"text": cached["answer"]}, "delta") + _sse({"model": provider.model_name, "cache": tier}, "done")
+            return Response(body, mimetype="text/event-stream", headers=headers)
+
+    try:
+        report = _prepare_images(provider_name, data)
+        # The slot is held until the stream ends, which is when the upstream call is actually done. A body that is
+        # never iterated (client gone before the first chunk) still gets closed, so release on close as well.
+        gate = ADMISSION.gate(provider_name)
+        release = gate.release_once(gate.acquire(PRIORITIES["answer"], ADMISSION.timeout("answer")))
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return jsonify(body), 429, headers
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    frames = provider.stream_response(
+        transcript=data.get("transcript"),
+        image_url=data.get("imageUrl"),
+        image_base64=data.get("imageBase64"),
+        image_array=data.get("imageArray"),
+    )
+    # Flush headers plus a comment frame immediately so the client can render as soon as tokens arrive.
+    def gen():
+        yield ": stream-open\n\n"
+        if report: yield _sse(report, "images")
+        answer_parts = []
+        try:
+            for frame in frames:
+                yield frame
+                if not cache_key: continue
+                event, payload = _parse_sse(frame)
+                if event == "delta": answer_parts.append(payload["text"])
+                elif event == "done" and _cacheable(provider, payload.get("model")):
+                    ANSWER_CACHE.put(cache_key, {"answer": "".join(answer_parts), "model": payload.get("model")})
+        finally:
+            release()
+    resp = Response(stream_with_context(gen()), mimetype="text/event-stream", headers=headers)
+    resp.call_on_close(release)
+    return resp
+
+# -------- Batch answers --------
+BATCH_MAX_JOBS = int(os.getenv("ANSWER_BATCH_MAX_JOBS", 20))
+BATCH_CONCURRENCY = int(os.getenv("ANSWER_BATCH_CONCURRENCY", 4))
+_batch_pool = ThreadPoolExecutor(max_workers=int(os.getenv("ANSWER_BATCH_WORKERS", 16)), thread_name_prefix="batch")
+
+def _batch_request(body):
+    """(jobs, concurrency) from {"jobs": [answer requests], "concurrency": n}; raises ValueError."""
+    jobs = body.get("jobs") if isinstance(body, dict) else None
+    if not isinstance(jobs, list) or not jobs or not all(isinstance(j, dict) for j in jobs):
+        raise ValueError("Expected a non-empty `jobs` list of answer requests")
+    if len(jobs) > BATCH_MAX_JOBS: raise ValueError(f"At most {BATCH_MAX_JOBS} jobs per batch")
+    try: concurrency = int(body.get("concurrency") or BATCH_CONCURRENCY)
+    except (TypeError, ValueError): raise ValueError("Invalid concurrency")
+    return jobs, max(1, min(concurrency, BATCH_CONCURRENCY))
+
+def _job_error(e):
+    """How a failed batch job is reported; the other jobs carry on."""
+    if isinstance(e, AdmissionRejected): return {"error": str(e), "status": 429, "retry_after": e.retry_after}
+    if isinstance(e, DeadlineExceeded): return {"error": str(e), "status": 504}
+    if isinstance(e, ValueError): return {"error": str(e), "status": 400}
+    log.error("batch job failed: %s", e, exc_info=e)
+    return {"error": "Server error", "status": 500}
+
+def _job_result(index, job, result, headers, t0):
+    return {"index": index, "id": job.get("id", index), **result, "status": 400 if "error" in result else 200,
+            "cache": headers.get("X-Cache"), "elapsed_ms": round((time.perf_counter() - t0) * 1000)}
+
+@app.post("/api/answer/batch")
+def answer_batch():
+    """Several answer jobs at once, `concurrency` in flight. Streams one SSE `result` event per job as it
+    finishes (completion order; `index` says which), then `done`. A failed job is a `result` with an error."""
+    try:
+        with timed("upload_read"): jobs, concurrency = _batch_request(request.get_json(force=True))
+        # The before_request hook charged one token; the rest of the batch pays per job.
+        if len(jobs) > 1: ADMISSION.check_client(request.url_rule.rule, request.headers, request.remote_addr, cost=len(jobs) - 1)
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return jsonify(body), 429, headers
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    no_cache = _no_cache()
+
+    def run(index):
+        t0 = time.perf_counter()
+        try: return _job_result(index, jobs[index], *_answer_job(jobs[index], no_cache, "batch"), t0)
+        except Exception as e: return {"index": index, "id": jobs[index].get("id", index), **_job_error(e),
+                                       "elapsed_ms": round((time.perf_counter() - t0) * 1000)}
+
+    def gen():
+        yield ": stream-open\n\n"
+        t0, waiting, pending, ok = time.perf_counter(), list(range(len(jobs))), set(), 0
+        try:
+            while waiting or pending:
+                while waiting and len(pending) < concurrency:
+                    # copy_context: jobs share the request's deadline and Server-Timing.
+                    pending.add(_batch_pool.submit(contextvars.copy_context().run, run, waiting.pop(0)))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    result = fut.result()
+                    ok += result["status"] == 200
+                    yield _sse(result, "result")
+        finally:
+            for fut in pending: fut.cancel()  # client went away: don't start what's still queued
+        yield _sse({"jobs": len(jobs), "ok": ok, "failed": len(jobs) - ok,
+                    "elapsed_ms": round((time.perf_counter() - t0) * 1000)}, "done")
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # -------- Simple chunked STT (Whisper-1) --------
-# Accepts audioBase64 (webm/opus) chunks and returns incremental text.
+# Accepts webm/opus chunks as raw binary, multipart (`audio` part) or audioBase64 JSON, and returns incremental text.
 from werkzeug.utils import secure_filename
 
-@app.post("/api/transcribe")
-def transcribe():
+def _decode_audio_b64(audio_b64):
+    encoded = audio_b64.split(",",1)[1] if "," in audio_b64 else audio_b64
+
+    # Fix base64 padding (browsers sometimes omit trailing '=')
+    encoded = encoded.strip()
+    padding = 4 - len(encoded) % 4
+    if padding != 4:
+        encoded += '=' * padding
+    with timed("base64_decode", kind="audio"): return base64.b64decode(encoded)
+
+def _read_audio():
+    """Return (audio bytes, mime, fields) for whichever upload format the client used."""
+    if request.mimetype == "multipart/form-data":
+        f = request.files.get("audio")
+        if not f: return None, None, request.form
+        return _upload_bytes(f), request.form.get("mimeType") or f.mimetype, request.form
+    if _is_binary_body():
+        return request.get_data(cache=False), request.mimetype, request.args
+
+    return _json_audio(request.get_json(force=True) or {})
+
+def _json_audio(data):
+    """(audio bytes, mime, fields) of a JSON upload: base64 audio in `audioBase64`."""
+    audio_b64 = data.get("audioBase64")
+    if not audio_b64: return None, None, data
+    return _decode_audio_b64(audio_b64), data.get("mimeType","audio/webm"), data
+
+# -------- Speech gate --------
+# Silent chunks and Whisper's stock silence hallucinations are dropped here, before they spend upstream quota.
+# WAV/PCM is measured by frame energy. Opus in WebM (what MediaRecorder sends) is measured without decoding:
+# libopus VBR spends almost no bits on silence, so a chunk whose packets all run at a trickle has no speech.
+EBML_MASTERS = {0x18538067, 0x1F43B675, 0xA0}  # Segment, Cluster, BlockGroup: descend instead of skipping
+EBML_BLOCKS = {0xA3, 0xA1}                      # SimpleBlock, Block
+OPUS_FRAME_MS = [10, 20, 40, 60] * 3 + [10, 20] * 2 + [2.5, 5, 10, 20] * 4  # by TOC config number (RFC 6716 3.1)
+WHISPER_HALLUCINATIONS = ("thankyou", "thanksforwatching", "subtitlesby.*", "amaraorg.*", "pleasesubscribe")
+
+def _ebml_vint(buf, pos, keep_marker=False):
+    first = buf[pos]
+    length = 9 - first.bit_length() if first else 9
+    if length > 8 or pos + length > len(buf): raise ValueError("Truncated EBML")
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in buf[pos + 1:pos + length]: value = (value << 8) | b
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+def _opus_packets(buf):
+    """Yield (bytes, ms) for each Opus packet in a WebM file; stops quietly at a truncated tail."""
+    pos = 0
     try:
-        data = request.get_json(force=True) or {}
-        audio_b64 = data.get("audioBase64")
-        mime = data.get("mimeType","audio/webm")
-        session_id = secure_filename(data.get("sessionId","default"))
-        previous_text = data.get("previousText", "")
-        if not audio_b64: return jsonify({"error":"No audioBase64"}), 400
-
-        # decode to temp file
-        if "," in audio_b64:
-            header, encoded = audio_b64.split(",",1)
-        else:
-            encoded = audio_b64
-        
-        # Fix base64 padding (browsers sometimes omit trailing '=')
-        encoded = encoded.strip()
-        padding = 4 - len(encoded) % 4
-        if padding != 4:
-            encoded += '=' * padding
-        
-        buf = base64.b64decode(encoded)
-        log.info("Received audio chunk: %d bytes, mime=%s", len(buf), mime)
-        
-        if len(buf) < 100:
-            return jsonify({"text": "", "method": "skip", "debug": "chunk too small"}), 200
-        
-        suffix = ".webm" if "webm" in mime else ".ogg" if "ogg" in mime else ".wav" if "wav" in mime else ".mp4" if "mp4" in mime else ".webm"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-            f.write(buf)
-            tmp_path = f.name
-
-        text = ""
-        method = "none"
-        debug_info = ""
-        
-        # PRIMARY: Groq Whisper (free, fast, reliable)
-        groq_key = os.getenv("GROQ_API_KEY")
-        if groq_key:
+        while pos < len(buf):
+            eid, pos, _ = _ebml_vint(buf, pos, keep_marker=True)
+            size, pos, unknown = _ebml_vint(buf, pos)
+            if eid in EBML_MASTERS: continue
+            if unknown: return
+            if eid in EBML_BLOCKS:
+                _, body, _ = _ebml_vint(buf, pos)  # track number
+                body += 3                          # timecode (2) + flags (1); MediaRecorder doesn't lace
+                packet = buf[body:pos + size]
+                if packet:
+                    toc = packet[0]
+                    frames = 1 if toc & 3 == 0 else 2 if toc & 3 in (1, 2) else (packet[1] & 0x3F if len(packet) > 1 else 1)
+                    yield len(packet), OPUS_FRAME_MS[toc >> 3] * frames
+            pos += size
+    except (ValueError, IndexError):
+        return
+
+def _pcm_frames_db(samples, rate, channels, frame_ms=20):
+    """dBFS of each `frame_ms` window of interleaved 16-bit samples."""
+    step = max(1, int(rate * channels * frame_ms / 1000))
+    for i in range(0, len(samples) - step + 1, step):
+        frame = samples[i:i + step]
+        rms = math.sqrt(sum(x * x for x in frame) / len(frame))
+        yield 20 * math.log10(rms / 32768) if rms else -120.0
+
+def _pcm_to_wav(buf, rate, channels=1):
+    out = BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(channels); w.setsampwidth(2); w.setframerate(rate)
+        w.writeframes(buf)
+    return out.getvalue()
+
+class SpeechGate:
+    """Voice-activity check and hallucination filter for /api/transcribe."""
+    def __init__(self, min_voiced_ms=250, dbfs=-45.0, opus_kbps=6.0, hallucinations=WHISPER_HALLUCINATIONS):
+        self.min_voiced_ms, self.dbfs, self.opus_kbps = min_voiced_ms, dbfs, opus_kbps
+        self._hallucination = re.compile(f"^({'|'.join(hallucinations)})+$")
+
+    def analyze(self, buf, mime):
+        """{"method", "voiced_ms", "duration_ms"} for formats we can measure, else None (always transcribe)."""
+        mime = (mime or "").lower()
+        if "wav" in mime or buf[:4] == b"RIFF":
+            try:
+                with wave.open(BytesIO(buf)) as w:
+                    if w.getsampwidth() != 2: return None
+                    rate, channels, raw = w.getframerate(), w.getnchannels(), w.readframes(w.getnframes())
+            except (wave.Error, EOFError):
+                return None
+            return self._energy(raw, rate, channels)
+        if "webm" in mime and "opus" in mime or buf[:4] == b"\x1a\x45\xdf\xa3":
+            voiced = total = 0.0
+            for size, ms in _opus_packets(buf):
+                total += ms
+                if size * 8 / ms >= self.opus_kbps: voiced += ms  # bits per ms == kbit/s
+            if not total: return None  # not Opus, or nothing we could parse
+            return {"method": "opus-bitrate", "voiced_ms": round(voiced), "duration_ms": round(total)}
+        return None
+
+    def _energy(self, raw, rate, channels):
+        samples = array.array("h", raw[:len(raw) - len(raw) % 2])
+        if sys.byteorder == "big": samples.byteswap()
+        frames = list(_pcm_frames_db(samples, rate, channels))
+        voiced = sum(1 for db in frames if db > self.dbfs)
+        return {"method": "pcm-energy", "voiced_ms": voiced * 20, "duration_ms": len(frames) * 20}
+
+    def is_silent(self, analysis):
+        return analysis is not None and analysis["voiced_ms"] < self.min_voiced_ms
+
+    def is_hallucination(self, text):
+        # Only a whole-chunk match counts: "thank you" inside real speech is kept.
+        clean = re.sub(r"[^a-z]", "", (text or "").lower())
+        return bool(clean) and bool(self._hallucination.match(clean))
+
+STT_GATE = SpeechGate(
+    min_voiced_ms=int(os.getenv("STT_VAD_MIN_VOICED_MS", 250)),
+    dbfs=float(os.getenv("STT_VAD_DBFS", -45)),
+    opus_kbps=float(os.getenv("STT_VAD_OPUS_KBPS", 6)),
+    hallucinations=WHISPER_HALLUCINATIONS + tuple(p for p in os.getenv("STT_HALLUCINATIONS", "").split(",") if p),
+)
+
+class SkipTracker:
+    """Per-session counts of chunks skipped before (silence) or after (hallucination) the STT call. LRU-bounded."""
+    SKIPPED = ("tiny", "silence", "hallucination")
+
+    def __init__(self, max_sessions=2000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session id -> {outcome: count}
+
+    def record(self, session_id, outcome):
+        """Count one chunk and return that session's running totals."""
+        METRICS.inc("scribe_stt_chunks_total", outcome=outcome)
+        with self._lock:
+            counts = self._sessions.pop(session_id, None) or {}
+            counts[outcome] = counts.get(outcome, 0) + 1
+            self._sessions[session_id] = counts
+            if len(self._sessions) > self.max_sessions: self._sessions.popitem(last=False)
+            return self._summary(counts)
+
+    def _summary(self, counts):
+        chunks, skipped = sum(counts.values()), sum(counts.get(k, 0) for k in self.SKIPPED)
+        return {"chunks": chunks, "skipped": skipped, "skip_rate": round(skipped / chunks, 3), **counts}
+
+    def stats(self):
+        with self._lock: sessions = [self._summary(c) for c in self._sessions.values()]
+        chunks, skipped = sum(s["chunks"] for s in sessions), sum(s["skipped"] for s in sessions)
+        return {"sessions": len(sessions), "chunks": chunks, "skipped": skipped,
+                "skip_rate": round(skipped / chunks, 3) if chunks else 0.0}
+
+STT_SKIPS = SkipTracker(max_sessions=int(os.getenv("STT_SKIP_SESSIONS", 2000)))
+
+def _stt_prepare(buf, mime):
+    """(buf, mime, analysis): raw PCM is wrapped as WAV for the upstreams, then measured."""
+    mime = (mime or "audio/webm").lower()
+    if mime.startswith(("audio/l16", "audio/pcm")):
+        rate = int(re.search(r"rate=(\d+)", mime).group(1)) if "rate=" in mime else 16000
+        channels = int(re.search(r"channels=(\d+)", mime).group(1)) if "channels=" in mime else 1
+        buf, mime = _pcm_to_wav(buf, rate, channels), "audio/wav"
+    with timed("vad"): analysis = STT_GATE.analyze(buf, mime)
+    return buf, mime, analysis
+
+def _skipped_response(ctx, reason, analysis=None):
+    session = STT_SKIPS.record(ctx["session_id"], reason)
+    SESSION_CONTEXT.commit(ctx, "")
+    return {"text": "", "method": "skip", "skipped": reason, "vad": analysis, "session": session, **_context_info(ctx),
+            "debug": f"{reason}" + (f" ({analysis['voiced_ms']}ms voiced of {analysis['duration_ms']}ms)" if analysis else "")}
+
+def _stt_finish(result, ctx, analysis):
+    """Drop hallucinated text, stitch the rest onto the session, and attach the VAD result and skip counts."""
+    if STT_GATE.is_hallucination(result["text"]):
+        log.info("Dropped likely hallucination from %s: %r", result["method"], result["text"])
+        result.update(filtered=result["text"], text="", skipped="hallucination")
+        result["session"] = STT_SKIPS.record(ctx["session_id"], "hallucination")
+    else:
+        result["session"] = STT_SKIPS.record(ctx["session_id"], "transcribed" if result["text"] else "empty")
+    result["text"] = SESSION_CONTEXT.commit(ctx, result["text"])
+    result.update(vad=analysis, **_context_info(ctx))
+    return result
+
+# -------- Session context --------
+# The STT prompt (the transcript so far) and chunk bookkeeping live on the server: clients send a sessionId
+# and a per-session chunk `seq`. Old clients that still send previousText get it used as the prompt until
+# the session has a tail of its own.
+def _norm_word(w): return re.sub(r"[^\w']", "", w.lower())
+
+def _stitch(tail, text, max_words=12, min_words=2):
+    """(text, n): `text` without its first n words when they repeat the last n words of `tail`.
+
+    Consecutive chunks often both catch the words at the boundary. One shared word is too often a real
+    repeat ("that that") to drop, so at least `min_words` have to match.
+    """
+    prev, words = [_norm_word(w) for w in tail.split()[-max_words:]], text.split()
+    head = [_norm_word(w) for w in words[:max_words]]
+    for n in range(min(len(prev), len(head)), min_words - 1, -1):
+        if prev[-n:] == head[:n] and any(head[:n]): return " ".join(words[n:]), n
+    return text, 0
+
+def _tail(text, max_chars):
+    """The last `max_chars` of `text`, starting on a word boundary."""
+    if len(text) <= max_chars: return text
+    cut = text[-max_chars:]
+    return cut.split(" ", 1)[1] if " " in cut else cut
+
+class SessionContextStore:
+    """Per-session STT state: the transcript tail used as the next prompt, the highest chunk seq seen, and
+    what the last `remember` chunks produced, so a retried chunk gets its first answer back instead of
+    being transcribed (and appended) twice.
+
+    State lives in an LRU of `max_sessions`. With a `backend` (anything with load(session_id) and
+    save(session_id, state)), that is the source of truth shared by all workers, and the LRU only stands in
+    while it's unreachable. A save never rolls a session back to an older seq.
+    """
+    STATUSES = ("next", "gap", "late", "replayed", "unsequenced")
+
+    def __init__(self, max_sessions=2000, tail_chars=500, remember=16, backend=None):
+        self.max_sessions, self.tail_chars, self.remember, self.backend = max_sessions, tail_chars, remember, backend
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # session id -> state
+        self._stats = {**{s: 0 for s in self.STATUSES}, "stitched_words": 0, "evictions": 0, "backend_errors": 0}
+
+    @staticmethod
+    def _copy(state):
+        return {**state, "results": dict(state["results"])}
+
+    def load(self, session_id):
+        if self.backend:
             try:
-                groq_client = OpenAI(api_key=groq_key, base_url="https://api.groq.com/openai/v1")
-                with open(tmp_path, "rb") as fp:
-                    tr = groq_client.audio.transcriptions.create(model="whisper-large-v3-turbo", file=fp, prompt=previous_text)
-                text = getattr(tr, "text", "").strip()
-                method = "groq-whisper"
-                debug_info = f"groq returned {len(text)} chars"
-                log.info("Groq Whisper result: '%s'", text[:100])
+                state = self.backend.load(session_id)
+                return self._copy(state) if state else {"tail": "", "last_seq": -1, "results": {}}
             except Exception as e:
-                err_str = str(e)
-                debug_info = f"groq error: {err_str[:100]}"
-                # If rate limited, set method so frontend shows what happened
-                if "429" in err_str or "rate" in err_str.lower():
-                    method = "groq-ratelimit"
-                    log.warning("Groq rate limited, trying fallbacks")
-                else:
-                    log.warning("Groq failed: %s, trying OpenAI fallback", e)
-        else:
-            debug_info = "no GROQ_API_KEY"
-        
-        # Fallback 1: OpenAI Whisper
-        if not text:
-            oai_key = os.getenv("OPENAI_API_KEY")
-            if oai_key:
-                try:
-                    client = OpenAI(api_key=oai_key)
-                    with open(tmp_path, "rb") as fp:
-                        tr = client.audio.transcriptions.create(model="whisper-1", file=fp, prompt=previous_text)
-                    text = getattr(tr, "text", "").strip()
-                    method = "whisper"
-                    debug_info += f" | whisper returned {len(text)} chars"
-                    log.info("Whisper result: '%s'", text[:100])
-                except Exception as e:
-                    debug_info += f" | whisper error: {str(e)[:100]}"
-                    log.warning("Whisper failed: %s, trying Gemini fallback", e)
-        
-        # Fallback 2: Google Gemini for audio transcription (with retry for 429)
-        if not text:
-            google_key = os.getenv("GOOGLE_API_KEY")
-            if google_key:
-                genai.configure(api_key=google_key, transport="rest")
-                audio_mime = mime if mime else "audio/webm"
-                audio_part = {
-                    "inline_data": {
-                        "mime_type": audio_mime,
-                        "data": encoded
-                    }
-                }
-                prompt = (
-                    "Transcribe this audio exactly. Output ONLY the spoken words, nothing else. "
-                    "If there is music but no speech, output just the word MUSIC. If completely silent, output SILENT. "
-                    f"Previous context for smooth stitching: '{previous_text[-200:]}'"
-                )
-                
-                # Try with retry + model fallback for rate limits
-                models_to_try = ["gemini-2.0-flash", "gemini-2.0-flash-lite", "models/gemini-1.5-flash"]
-                for model_name in models_to_try:
-                    for attempt in range(3):
-                        try:
-                            model = genai.GenerativeModel(model_name)
-                            resp = model.generate_content([prompt, audio_part])
-                            raw = resp.text.strip() if resp.text else ""
-                            method = f"gemini({model_name})"
-                            debug_info += f" | {model_name} returned: '{raw[:60]}'"
-                            if raw and raw not in ("MUSIC", "SILENT", ""):
-                                text = raw
-                            log.info("Gemini STT [%s] result: '%s'", model_name, raw[:100])
-                            break
-                        except Exception as e2:
-                            err_str = str(e2)
-                            if "429" in err_str and attempt < 2:
-                                time.sleep(2 * (attempt + 1))  # 2s, 4s backoff
-                                continue
-                            debug_info += f" | {model_name} err: {err_str[:60]}"
-                            log.warning("Gemini STT [%s] attempt %d failed: %s", model_name, attempt, e2)
-                            break
-                    if text:
-                        break
-            else:
-                debug_info += " | no GOOGLE_API_KEY"
-        
-        try: os.remove(tmp_path)
-        except: pass
-        
-        return jsonify({"text": text, "method": method, "debug": debug_info})
+                self._backend_failed("load", e)
+        with self._lock:
+            state = self._mem.get(session_id)
+            if state: self._mem.move_to_end(session_id)
+            return self._copy(state) if state else {"tail": "", "last_seq": -1, "results": {}}
+
+    def save(self, session_id, state):
+        with self._lock:
+            current = self._mem.get(session_id)
+            if not current or current["last_seq"] <= state["last_seq"]: self._mem[session_id] = state
+            self._mem.move_to_end(session_id)
+            while len(self._mem) > self.max_sessions:
+                self._mem.popitem(last=False)
+                self._stats["evictions"] += 1
+        if self.backend:
+            try: self.backend.save(session_id, state)
+            except Exception as e: self._backend_failed("save", e)
+
+    def forget(self, session_id):
+        with self._lock: self._mem.pop(session_id, None)
+
+    def _backend_failed(self, op, e):
+        log.warning("Session context backend %s failed: %s", op, e)
+        with self._lock: self._stats["backend_errors"] += 1
+
+    def begin(self, session_id, seq=None, previous_text=""):
+        """Context for one incoming chunk: its status against the session's sequence and the prompt to use."""
+        state = self.load(session_id)
+        if seq is None: status = "unsequenced"
+        elif str(seq) in state["results"]: status = "replayed"
+        elif seq <= state["last_seq"]: status = "late"
+        elif state["last_seq"] >= 0 and seq > state["last_seq"] + 1: status = "gap"
+        else: status = "next"
+        with self._lock: self._stats[status] += 1
+        METRICS.inc("scribe_stt_context_total", status=status)
+        return {"session_id": session_id, "seq": seq, "status": status, "state": state, "stitched_words": 0,
+                "gap": seq - state["last_seq"] - 1 if status == "gap" else 0,
+                "prompt": state["tail"] or _tail(previous_text, self.tail_chars)}
+
+    def replay(self, ctx):
+        """What this chunk produced the first time, if it's a retry; else None."""
+        return ctx["state"]["results"].get(str(ctx["seq"])) if ctx["status"] == "replayed" else None
+
+    def commit(self, ctx, text):
+        """Record the chunk's outcome and return the text to emit, with the overlap at its start removed.
+
+        Late chunks are emitted as they are: their text doesn't follow the tail, so it's neither stitched
+        nor added to it.
+        """
+        state, seq = ctx["state"], ctx["seq"]
+        if text and ctx["status"] != "late":
+            text, ctx["stitched_words"] = _stitch(state["tail"], text)
+            if text: state["tail"] = _tail(f"{state['tail']} {text}".strip(), self.tail_chars)
+        if ctx["stitched_words"]:
+            with self._lock: self._stats["stitched_words"] += ctx["stitched_words"]
+        if seq is not None:
+            state["results"][str(seq)] = text
+            state["results"] = dict(sorted(state["results"].items(), key=lambda kv: int(kv[0]))[-self.remember:])
+            state["last_seq"] = max(state["last_seq"], seq)
+        self.save(ctx["session_id"], state)
+        return text
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "sessions": len(self._mem), "max_sessions": self.max_sessions,
+                    "backend": type(self.backend).__name__ if self.backend else None}
+
+class PostgresContextBackend:
+    """Session context in scribe_stt_context, an UNLOGGED table: cheap to write on every chunk, and losing
+    it in a crash only costs the next chunk its prompt."""
+    def _db(self):
+        db = get_db()
+        if not db: raise RuntimeError(db_error or "No database attached")
+        return db
+
+    def load(self, session_id):
+        db = self._db()
+        with db.connection() as pc: rows = db.run(pc, "get_stt_context", id=session_id)
+        return rows[0][0] if rows else None
+
+    def save(self, session_id, state):
+        db = self._db()
+        with db.connection() as pc: db.run(pc, "put_stt_context", id=session_id, seq=state["last_seq"], state=json.dumps(state))
+
+SESSION_CONTEXT = SessionContextStore(
+    max_sessions=int(os.getenv("STT_CONTEXT_SESSIONS", 2000)),
+    tail_chars=int(os.getenv("STT_CONTEXT_CHARS", 500)),
+    backend=PostgresContextBackend() if os.getenv("STT_CONTEXT_BACKEND", "").lower() == "postgres" else None,
+)
+
+def _stt_context(fields):
+    """Context for the chunk in this request (sessionId, seq, and previousText from older clients)."""
+    try: seq = int(fields.get("seq"))
+    except (TypeError, ValueError): seq = None
+    return SESSION_CONTEXT.begin(secure_filename(fields.get("sessionId") or "default"), seq, fields.get("previousText") or "")
+
+def _context_info(ctx):
+    info = {"status": ctx["status"], "stitched_words": ctx["stitched_words"]}
+    if ctx["gap"]: info["missing_chunks"] = ctx["gap"]
+    return {"seq": ctx["seq"], "context": info}
+
+def _stt_rejected(result):
+    """(body, headers) for the 429 when no backend got an upstream slot. The chunk's seq stays unused, so a
+    retry is transcribed normally."""
+    retry_after = min(a["retry_after"] for a in result["attempts"] if a["status"] == "rejected")
+    return {"error": "STT upstreams busy", "retry_after": retry_after, "attempts": result["attempts"]}, {"Retry-After": str(retry_after)}
+
+def _replayed_response(ctx, text):
+    return {"text": text, "method": "replay", "replayed": True, **_context_info(ctx),
+            "debug": f"chunk {ctx['seq']} already transcribed"}
+
+def _stt_admit(buf, mime, fields):
+    """Everything /api/transcribe does before going upstream, for both serving modes. Returns
+    ((body, status, headers), None) when the chunk is answered without STT (replay, tiny, silent, no
+    time left), else (None, job) for STT.transcribe and _stt_respond."""
+    if not buf: return ({"error":"No audio provided"}, 400, {}), None
+    # Like the deadline header, a budgetMs of 0 or less means none was given.
+    try: asked = float(fields.get("budgetMs") or 0) / 1000
+    except (TypeError, ValueError): asked = math.nan
+    if not math.isfinite(asked): return ({"error": "budgetMs must be a number of milliseconds"}, 400, {}), None
+    log.info("Received audio chunk: %d bytes, mime=%s", len(buf), mime)
+    ctx = _stt_context(fields)
+    replayed = SESSION_CONTEXT.replay(ctx)
+    if replayed is not None: return (_replayed_response(ctx, replayed), 200, {}), None
+
+    if len(buf) < 100:
+        return ({**_skipped_response(ctx, "tiny"), "debug": "chunk too small"}, 200, {}), None
+
+    buf, mime, analysis = _stt_prepare(buf, mime)
+    if STT_GATE.is_silent(analysis): return (_skipped_response(ctx, "silence", analysis), 200, {}), None
+
+    suffix = ".webm" if "webm" in mime else ".ogg" if "ogg" in mime else ".wav" if "wav" in mime else ".mp4" if "mp4" in mime else ".webm"
+    # Clients may shrink the budget to fit their own timeout (budgetMs, or the request deadline); never
+    # beyond the server's own.
+    budget = min(asked, STT.budget) if asked > 0 else STT.budget
+    budget = min(budget, time_left(budget))
+    if budget < 0.5: return ({"error": "Request deadline exceeded"}, 504, {}), None
+    # The SDKs take (filename, bytes, mime) tuples, so the chunk goes upstream straight from memory.
+    return None, {"audio_file": (f"chunk{suffix}", buf, mime), "mime": mime, "prompt": ctx["prompt"],
+                  "budget": budget, "ctx": ctx, "analysis": analysis}
+
+def _stt_respond(result, job):
+    """(body, status, headers) for a transcription result."""
+    _observe_stt(result)
+    if result["method"] == "rejected":
+        body, headers = _stt_rejected(result)
+        return body, 429, headers
+    result["debug"] = " | ".join(
+        f"{a['backend']} {a['status']} {a['ms']}ms" + (f": {a['error'][:60]}" if a.get("error") else "")
+        for a in result["attempts"]) or "no STT backend configured"
+    return _stt_finish(result, job["ctx"], job["analysis"]), 200, {}
+
+# -------- STT router --------
+def _stt_failure_method(attempts, timed_out):
+    """`method` for a transcription nobody answered. "rejected" (every launched backend was refused an
+    upstream slot) is answered with a 429."""
+    launched = [a for a in attempts if a["status"] != "circuit-open"]
+    if timed_out: return "timeout"
+    if launched and all(a["status"] == "rejected" for a in launched): return "rejected"
+    return "groq-ratelimit" if any(a["status"] == "ratelimited" for a in attempts) else "none"
+
+def _observe_stt(result):
+    """Upstream stage metrics for each STT attempt; `step` is the backend's position in the fallback chain."""
+    for step, a in enumerate(result["attempts"]):
+        if a["status"] == "circuit-open": continue
+        observe_stage("upstream", a["ms"] / 1000, outcome=a["status"], provider="stt", model=a["backend"], step=step)
+
+class CircuitBreaker:
+    """Skips a backend for a cool-down after repeated errors or any 429; then lets one probe call through."""
+    def __init__(self, failure_threshold=3, cooldown=30.0, ratelimit_cooldown=60.0):
+        self.failure_threshold, self.cooldown, self.ratelimit_cooldown = failure_threshold, cooldown, ratelimit_cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+        self._probe_started = None
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if not self.open_until: return True
+            if now < self.open_until: return False
+            # Half-open: one probe at a time. A probe that never reports back expires after a cool-down.
+            if self._probe_started is not None and now - self._probe_started < self.cooldown: return False
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures, self.open_until, self._probe_started = 0, 0.0, None
+
+    def record_failure(self, rate_limited=False, retry_after=None):
+        with self._lock:
+            self.failures += 1
+            self._probe_started = None
+            if rate_limited:
+                self.open_until = time.monotonic() + (retry_after or self.ratelimit_cooldown)
+            elif self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.cooldown
+
+    def state(self):
+        with self._lock:
+            if not self.open_until: return "closed"
+            return "open" if time.monotonic() < self.open_until else "half-open"
+
+def _stt_whisper(base_url, env_key, model):
+    def run(audio_file, mime, previous_text, timeout):
+        client = CLIENTS.openai_client(os.getenv(env_key), base_url)
+        tr = client.audio.transcriptions.create(model=model, file=audio_file, prompt=previous_text, timeout=timeout)
+        return getattr(tr, "text", "").strip()
+    return run
+
+def _stt_prompt(previous_text):
+    return (
+        "Transcribe this audio exactly. Output ONLY the spoken words, nothing else. "
+        "If there is music but no speech, output just the word MUSIC. If completely silent, output SILENT. "
+        f"Previous context for smooth stitching: '{previous_text[-200:]}'"
+    )
+
+def _stt_gemini(model_name):
+    def run(audio_file, mime, previous_text, timeout):
+        CLIENTS.configure_genai(os.getenv("GOOGLE_API_KEY"))
+        audio_part = {"inline_data": {"mime_type": mime or "audio/webm", "data": audio_file[1]}}
+        resp = CLIENTS.gemini_model(model_name).generate_content([_stt_prompt(previous_text), audio_part], request_options={"timeout": timeout})
+        raw = resp.text.strip() if resp.text else ""
+        return "" if raw in ("MUSIC", "SILENT") else raw
+    return run
+
+STT_PROVIDERS = {"GROQ_API_KEY": "groq", "OPENAI_API_KEY": "openai", "GOOGLE_API_KEY": "google"}  # admission gate per key
+
+# (method name, required env key, callable) in preference order.
+STT_BACKENDS = [
+    ("groq-whisper", "GROQ_API_KEY", _stt_whisper(GROQ_BASE_URL, "GROQ_API_KEY", "whisper-large-v3-turbo")),
+    ("whisper", "OPENAI_API_KEY", _stt_whisper(OPENAI_BASE_URL, "OPENAI_API_KEY", "whisper-1")),
+    ("gemini(gemini-2.0-flash)", "GOOGLE_API_KEY", _stt_gemini("gemini-2.0-flash")),
+    ("gemini(gemini-2.0-flash-lite)", "GOOGLE_API_KEY", _stt_gemini("gemini-2.0-flash-lite")),
+    ("gemini(models/gemini-1.5-flash)", "GOOGLE_API_KEY", _stt_gemini("models/gemini-1.5-flash")),
+]
+
+class HedgedRun:
+    """The state machine of one hedged transcription, without the concurrency, so STTRouter (thread pool)
+    and the async serving mode (tasks) make the same decisions. The driver starts what `next_backend` hands
+    it, waits up to `wait_time` for the first of `pending` to finish and reports it to `finished`; a failure
+    or a wait that times out while backends are still queued means launching the next one. Handles are
+    futures or tasks: anything with cancel()."""
+    def __init__(self, router, backends, budget, clock=time.monotonic):
+        self.router, self.clock = router, clock
+        self.t0 = clock()
+        self.deadline = self.t0 + budget
+        self.attempts = []
+        self.queue = [(name, fn) for name, env_key, fn in backends if os.getenv(env_key)]
+        self.pending = {}  # handle -> (name, started)
+
+    def _ms(self, since): return round((self.clock() - since) * 1000)
+
+    def next_backend(self):
+        """(name, fn, timeout) of the next backend to start, or None when the chain is used up. Breakers are
+        consulted only when a backend is actually needed, so half-open probes aren't wasted."""
+        while self.queue:
+            name, fn = self.queue.pop(0)
+            if self.router.breakers[name].allow(): return name, fn, max(0.5, self.deadline - self.clock())
+            self.attempts.append({"backend": name, "status": "circuit-open", "ms": 0})
+        return None
+
+    def started(self, handle, name):
+        self.pending[handle] = (name, self.clock())
+
+    def wait_time(self):
+        """How long to wait for the next attempt to finish: up to the hedge delay while there's a backend left
+        to race, else the rest of the budget. None once the budget is spent."""
+        left = self.deadline - self.clock()
+        if left <= 0: return None
+        return min(left, self.router.hedge_delay) if self.queue else left
+
+    def finished(self, handle, text=None, error=None):
+        """Record a finished attempt. Returns the result if it won (the others are cancelled), else None."""
+        name, started = self.pending.pop(handle)
+        ms = self._ms(started)
+        if isinstance(error, AdmissionRejected):
+            self.attempts.append({"backend": name, "status": "rejected", "ms": ms, "retry_after": error.retry_after})
+            return None
+        if error is not None:
+            status = "ratelimited" if _is_rate_limited(error) else "error"
+            self.attempts.append({"backend": name, "status": status, "ms": ms, "error": str(error)[:100]})
+            log.warning("STT backend %s failed after %dms: %s", name, ms, error)
+            return None
+        self.attempts.append({"backend": name, "status": "ok", "ms": ms, "chars": len(text)})
+        self._cancel_pending("abandoned")
+        log.info("STT [%s] won in %dms: '%s'", name, ms, text[:100])
+        return {"text": text, "method": name, "attempts": self.attempts, "elapsed_ms": self._ms(self.t0)}
+
+    def give_up(self):
+        """The result when nothing answered: out of backends, or out of budget with attempts still running."""
+        timed_out = bool(self.pending)
+        self._cancel_pending("timeout")
+        return {"text": "", "method": _stt_failure_method(self.attempts, timed_out), "attempts": self.attempts,
+                "elapsed_ms": self._ms(self.t0)}
+
+    def _cancel_pending(self, status):
+        for handle, (name, started) in self.pending.items():
+            handle.cancel()
+            self.attempts.append({"backend": name, "status": status, "ms": self._ms(started)})
+        self.pending.clear()
+
+class STTRouter:
+    """Runs the STT fallback chain inside a latency budget.
+
+    Backends are tried in order; if one hasn't answered after `hedge_delay` the next is started in
+    parallel, and the first successful answer wins. A failure starts the next backend immediately.
+    """
+    def __init__(self, backends, budget=12.0, hedge_delay=2.5, max_workers=16):
+        self.backends = backends
+        self.budget, self.hedge_delay = budget, hedge_delay
+        self.breakers = {name: CircuitBreaker(
+            failure_threshold=int(os.getenv("STT_BREAKER_FAILURES", 3)),
+            cooldown=float(os.getenv("STT_BREAKER_COOLDOWN", 30)),
+            ratelimit_cooldown=float(os.getenv("STT_BREAKER_RATELIMIT_COOLDOWN", 60)),
+        ) for name, _, _ in backends}
+        self.providers = {name: STT_PROVIDERS[env_key] for name, env_key, _ in backends}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stt")
+
+    def admission(self, name, timeout):
+        """(gate, priority, queue timeout) for one attempt on `name` that may run for `timeout` seconds."""
+        return ADMISSION.gate(self.providers[name]), PRIORITIES["transcribe"], min(ADMISSION.timeout("transcribe"), timeout)
+
+    @contextmanager
+    def attempt(self, name):
+        """Feeds one upstream call's outcome to the backend's breaker. Runs where the call runs, so hedged
+        attempts that lose the race still count. Not getting an upstream slot isn't the backend's failure, so
+        it belongs outside this block: a rejection leaves the breaker alone."""
+        breaker = self.breakers[name]
+        try: yield
+        except Exception as e:
+            breaker.record_failure(_is_rate_limited(e), _retry_after(e))
+            raise
+        breaker.record_success()
+
+    def _call(self, name, fn, *args):
+        gate, priority, queue_timeout = self.admission(name, args[-1])
+        with gate.admit(priority, queue_timeout), self.attempt(name): return fn(*args)
+
+    def transcribe(self, audio_file, mime, previous_text, budget=None):
+        run = HedgedRun(self, self.backends, budget or self.budget)
+        def launch():
+            nxt = run.next_backend()
+            if nxt:
+                name, fn, timeout = nxt
+                run.started(self._pool.submit(self._call, name, fn, audio_file, mime, previous_text, timeout), name)
+
+        launch()
+        while run.pending:
+            wait_for = run.wait_time()
+            if wait_for is None: break
+            done, _ = wait(run.pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for fut in done:
+                error = fut.exception()
+                result = run.finished(fut, None if error else fut.result(), error)
+                if result: return result
+                launch()
+            if not done: launch()  # hedge: current attempt is slow, race the next one
+        return run.give_up()
+
+    def stats(self):
+        return {name: {"state": b.state(), "failures": b.failures} for name, b in self.breakers.items()}
+
+STT = STTRouter(
+    STT_BACKENDS,
+    budget=float(os.getenv("STT_BUDGET_MS", 12000)) / 1000,
+    hedge_delay=float(os.getenv("STT_HEDGE_DELAY_MS", 2500)) / 1000,
+    max_workers=int(os.getenv("STT_WORKERS", 16)),
+)
+
+@app.post("/api/transcribe")
+def transcribe():
+    try:
+        with timed("upload_read"): buf, mime, fields = _read_audio()
+        response, job = _stt_admit(buf, mime, fields)
+        if response: body, status, headers = response
+        else: body, status, headers = _stt_respond(STT.transcribe(job["audio_file"], job["mime"], job["prompt"], budget=job["budget"]), job)
+        return jsonify(body), status, headers
     except Exception as e:
         log.exception("transcribe failed")
         return jsonify({"error": f"Transcription error: {str(e)}"}), 500
 
-
-
 if __name__ == "__main__":
     host = os.getenv("HOST","0.0.0.0")
     port = int(os.getenv("PORT",5055))
@@ -0,0 +1,456 @@
+"""Async serving mode.
+
+The latency-heavy routes (/api/answer, /api/answer/stream, /api/answer/batch, /api/transcribe) run on an event loop with
+async provider implementations, so a slow LLM or Whisper call holds a coroutine rather than a worker
+thread. Every other route is served by the regular Flask app, mounted underneath as a WSGI fallback.
+
+    pip install -r requirements-async.txt
+    uvicorn asgi:app --host 0.0.0.0 --port 5055
+"""
+import os, re, json, time, base64, asyncio
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route, Mount
+from starlette.background import BackgroundTask
+from a2wsgi import WSGIMiddleware
+
+from api.index import (
+    app as flask_app, log, CLIENTS, OPENAI_BASE_URL, GROQ_BASE_URL, GEMINI_API_ENDPOINT, SCRIBE_SYSTEM_INSTRUCTION,
+    OpenAIProvider, GoogleProvider, GEMINI_ROUTER, ANSWER_CACHE, AnswerCache, STT, RETRY, StreamRun, HedgedRun,
+    _sse, _parse_sse, _canon_model, _prepare_images, _cacheable, _json_audio, _stt_admit, _stt_respond,
+    _openai_delta, _gemini_rest_delta, _gemini_text, _gemini_reply_text, _gemini_inline, _stt_prompt,
+    METRICS, timed, begin_request_timing, SESSION_CONTEXT,
+    ADMISSION, AdmissionRejected, PRIORITIES, _rejected_body,
+    DEADLINE_HEADER, DeadlineExceeded, begin_request_deadline, call_timeout,
+    _batch_request, _job_error, _job_result, IMAGE_FETCH,
+)
+
+GEMINI_REST_URL = f"{GEMINI_API_ENDPOINT}/v1beta"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+
+# ---------- Async providers ----------
+class AsyncOpenAIProvider(OpenAIProvider):
+    is_async = True
+
+    def __init__(self, model=None):
+        key = os.getenv("OPENAI_API_KEY")
+        if not key: raise ValueError("OPENAI_API_KEY not configured")
+        self.client = CLIENTS.async_openai_client(key, self.base_url)
+        self.model = self.model_name = model or self.default_model()
+
+    @RETRY
+    async def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        messages = self._build_messages(transcript, image_url, image_base64, image_array)
+        if not messages: return {"error":"No input provided"}
+        with timed("upstream", provider="openai", model=self.model):
+            resp = await self.client.chat.completions.create(model=self.model, messages=messages, timeout=call_timeout())
+        return {"answer": resp.choices[0].message.content, "model": self.model}
+
+    async def stream_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        run = StreamRun("openai")
+        messages = self._build_messages(transcript, image_url, image_base64, image_array)
+        if not messages:
+            yield _sse({"error":"No input provided"}, "error"); return
+        for model in run.models([self.model]):
+            try:
+                stream = await self.client.chat.completions.create(
+                    model=model, messages=messages, stream=True, stream_options={"include_usage": True}, timeout=call_timeout())
+                async for chunk in stream:
+                    frame = run.delta(*_openai_delta(chunk))
+                    if frame: yield frame
+            except Exception as e:
+                yield run.failed(e); return
+            yield run.done()
+
+async def _gemini_catalog():
+    """The Gemini model catalog over the pooled async client: genai.list_models() would block the event loop,
+    and the SDK isn't pointed at GEMINI_API_ENDPOINT in this mode."""
+    http, names, page = CLIENTS.async_http_client(GEMINI_REST_URL), set(), None
+    while True:
+        r = await http.get(f"{GEMINI_REST_URL}/models", headers={"x-goog-api-key": os.getenv("GOOGLE_API_KEY")},
+                           params={"pageSize": 1000, **({"pageToken": page} if page else {})}, timeout=call_timeout(10))
+        r.raise_for_status()
+        body = r.json()
+        names |= {m["name"] for m in body.get("models", []) if "generateContent" in m.get("supportedGenerationMethods", [])}
+        page = body.get("nextPageToken")
+        if not page: return names
+
+async def _gemini_attempts(primary):
+    """GEMINI_ROUTER.attempts(), with the catalog (when it's needed) fetched without blocking the loop."""
+    if GEMINI_ROUTER.needs_catalog(primary): await GEMINI_ROUTER.catalog_async(_gemini_catalog)
+    return GEMINI_ROUTER.attempts(primary, catalog=GEMINI_ROUTER.cached_catalog)
+
+class AsyncGoogleProvider(GoogleProvider):
+    """Gemini over its REST API on a pooled httpx.AsyncClient; the genai SDK has no async REST transport."""
+    is_async = True
+
+    def __init__(self, model=None):
+        self.key = os.getenv("GOOGLE_API_KEY")
+        if not self.key: raise ValueError("GOOGLE_API_KEY not configured")
+        self.model_name = model or self.default_model()
+        self.http = CLIENTS.async_http_client(GEMINI_REST_URL)
+
+    async def _build_parts(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        parts = [{"text": transcript}] if transcript else []
+        images = image_array or ([image_base64] if image_base64 else [])
+        parts += [_gemini_inline(img) for img in images]
+        if not images and image_url:
+            content, mime = await IMAGE_FETCH.fetch_async(image_url, call_timeout(10))
+            parts.append(_gemini_inline(content, mime))
+        return parts
+
+    def _request(self, name, parts, stream=False):
+        method = "streamGenerateContent?alt=sse" if stream else "generateContent"
+        body = {"systemInstruction": {"parts": [{"text": SCRIBE_SYSTEM_INSTRUCTION}]},
+                "contents": [{"role": "user", "parts": parts}]}
+        return f"{GEMINI_REST_URL}/{_canon_model(name)}:{method}", {"x-goog-api-key": self.key}, body
+
+    async def get_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        parts = await self._build_parts(transcript, image_url, image_base64, image_array)
+        if not parts: return {"error":"No input provided"}
+
+        last_err = None
+        for step, name in enumerate(await _gemini_attempts(self.model_name)):
+            t0 = time.perf_counter()
+            url, headers, body = self._request(name, parts)
+            timeout = call_timeout()
+            try:
+                log.info("Generating content for model %s (parts: %d)", name, len(parts))
+                with timed("upstream", provider="google", model=name, step=step):
+                    r = await self.http.post(url, headers=headers, json=body, timeout=timeout)
+                    r.raise_for_status()
+                text = _gemini_reply_text(r.json())
+            except Exception as e:
+                GEMINI_ROUTER.record(name, False, time.perf_counter() - t0, e)
+                log.warning("Gemini call to %s failed: %s", name, e)
+                last_err = e
+                continue
+            GEMINI_ROUTER.record(name, True, time.perf_counter() - t0)
+            return {"answer": text, "model": name}
+        log.error("Gemini critical failure: %s", last_err)
+        return {"error": f"AI Error: {str(last_err)}"}
+
+    async def stream_response(self, transcript=None, image_url=None, image_base64=None, image_array=None):
+        run = StreamRun("google", GEMINI_ROUTER)
+        try:
+            parts = await self._build_parts(transcript, image_url, image_base64, image_array)
+        except ValueError as e:
+            yield _sse({"error": str(e)}, "error"); return
+        if not parts:
+            yield _sse({"error":"No input provided"}, "error"); return
+
+        for model_name in run.models(await _gemini_attempts(self.model_name)):
+            url, headers, body = self._request(model_name, parts, stream=True)
+            try: timeout = call_timeout()
+            except DeadlineExceeded as e:
+                yield _sse({"error": str(e)}, "error"); return
+            try:
+                log.info("Streaming content for model %s (parts: %d)", model_name, len(parts))
+                async with self.http.stream("POST", url, headers=headers, json=body, timeout=timeout) as r:
+                    r.raise_for_status()
+                    async for line in r.aiter_lines():
+                        frame = run.delta(*_gemini_rest_delta(line))
+                        if frame: yield frame
+                run.require_text()
+            except Exception as e:
+                frame = run.failed(e)
+                if frame is None: continue
+                yield frame; return
+            yield run.done(); return
+        yield run.exhausted()
+
+ASYNC_PROVIDERS = {"openai": AsyncOpenAIProvider, "google": AsyncGoogleProvider}
+
+def get_async_provider(name, model=None):
+    return CLIENTS.provider(name, model, providers=ASYNC_PROVIDERS)
+
+# ---------- Async STT ----------
+def _whisper_async(base_url, env_key, model):
+    async def run(audio_file, mime, previous_text, timeout):
+        client = CLIENTS.async_openai_client(os.getenv(env_key), base_url)
+        tr = await client.audio.transcriptions.create(model=model, file=audio_file, prompt=previous_text, timeout=timeout)
+        return getattr(tr, "text", "").strip()
+    return run
+
+def _gemini_stt_async(model_name):
+    async def run(audio_file, mime, previous_text, timeout):
+        body = {"contents": [{"role": "user", "parts": [
+            {"text": _stt_prompt(previous_text)},
+            {"inline_data": {"mime_type": mime or "audio/webm", "data": base64.b64encode(audio_file[1]).decode()}},
+        ]}]}
+        r = await CLIENTS.async_http_client(GEMINI_REST_URL).post(
+            f"{GEMINI_REST_URL}/{_canon_model(model_name)}:generateContent",
+            headers={"x-goog-api-key": os.getenv("GOOGLE_API_KEY")}, json=body, timeout=timeout)
+        r.raise_for_status()
+        raw = _gemini_text(r.json()).strip()
+        return "" if raw in ("MUSIC", "SILENT") else raw
+    return run
+
+# Same names and order as STT_BACKENDS, so both serving modes share one set of circuit breakers.
+ASYNC_STT_BACKENDS = [
+    ("groq-whisper", "GROQ_API_KEY", _whisper_async(GROQ_BASE_URL, "GROQ_API_KEY", "whisper-large-v3-turbo")),
+    ("whisper", "OPENAI_API_KEY", _whisper_async(OPENAI_BASE_URL, "OPENAI_API_KEY", "whisper-1")),
+    ("gemini(gemini-2.0-flash)", "GOOGLE_API_KEY", _gemini_stt_async("gemini-2.0-flash")),
+    ("gemini(gemini-2.0-flash-lite)", "GOOGLE_API_KEY", _gemini_stt_async("gemini-2.0-flash-lite")),
+    ("gemini(models/gemini-1.5-flash)", "GOOGLE_API_KEY", _gemini_stt_async("models/gemini-1.5-flash")),
+]
+
+async def transcribe_hedged(audio_file, mime, previous_text, budget):
+    """Event-loop driver for HedgedRun (STTRouter.transcribe's); losing hedges are cancelled rather than left running."""
+    run = HedgedRun(STT, ASYNC_STT_BACKENDS, budget, clock=asyncio.get_running_loop().time)
+
+    async def call(name, fn, timeout):
+        gate, priority, queue_timeout = STT.admission(name, timeout)
+        async with gate.admit_async(priority, queue_timeout):
+            with STT.attempt(name): return await fn(audio_file, mime, previous_text, timeout)
+
+    def launch():
+        nxt = run.next_backend()
+        if nxt:
+            name, fn, timeout = nxt
+            run.started(asyncio.create_task(call(name, fn, timeout)), name)
+
+    launch()
+    while run.pending:
+        wait_for = run.wait_time()
+        if wait_for is None: break
+        done, _ = await asyncio.wait(run.pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            result = run.finished(task, None if error else task.result(), error)
+            if result: return result
+            launch()
+        if not done: launch()  # hedge: current attempt is slow, race the next one
+    return run.give_up()
+
+# ---------- Routes ----------
+BINARY_PREFIXES = ("audio/", "video/", "image/")
+# Mirrors the Flask CORS config; preflights fall through to Flask, which answers them itself.
+CORS_ORIGIN_RE = re.compile(r"^(chrome-extension://.+|http://localhost(:\d+)?|http://127\.0\.0\.1(:\d+)?)$")
+
+def instrumented(route, endpoint):
+    """Same request counter, Server-Timing header and deadline as the Flask hooks. Each request runs in its
+    own task, so the timings and deadline context vars are per request."""
+    async def wrapped(req):
+        timings = begin_request_timing(route)
+        begin_request_deadline(route, req.headers.get(DEADLINE_HEADER))
+        resp = await endpoint(req)
+        METRICS.inc("scribe_requests_total", route=route, method=req.method, status=resp.status_code)
+        resp.headers.append("Server-Timing", timings.header())
+        return resp
+    return wrapped
+
+def limited(route, endpoint):
+    """Per-client rate limit, checked before the body is read (the Flask app does this in a before_request hook)."""
+    async def wrapped(req):
+        try: ADMISSION.check_client(route, req.headers, req.client.host if req.client else None)
+        except AdmissionRejected as e:
+            body, headers = _rejected_body(e)
+            return JSONResponse(body, 429, headers)
+        return await endpoint(req)
+    return wrapped
+
+def cors(endpoint):
+    async def wrapped(req):
+        resp = await endpoint(req)
+        origin = req.headers.get("origin")
+        if origin and CORS_ORIGIN_RE.match(origin):
+            resp.headers["Access-Control-Allow-Origin"] = origin
+            resp.headers["Vary"] = "Origin"
+        return resp
+    return wrapped
+
+def _mimetype(req):
+    return req.headers.get("content-type", "").split(";")[0].strip().lower()
+
+def _is_binary(req):
+    mt = _mimetype(req)
+    return mt.startswith(BINARY_PREFIXES) or mt == "application/octet-stream"
+
+def _too_large(req):
+    try: return int(req.headers.get("content-length", 0)) > MAX_UPLOAD_BYTES
+    except ValueError: return False
+
+async def _json_body(req):
+    body = await req.body()
+    return json.loads(body) if body else {}
+
+async def _answer_payload(req):
+    """Same input formats as the Flask route: JSON, multipart `images` parts, or a raw image body."""
+    if _mimetype(req) == "multipart/form-data":
+        form = await req.form()
+        data = {k: v for k, v in form.items() if isinstance(v, str)}
+        images = [await f.read() for f in form.getlist("images") if not isinstance(f, str)]
+    elif _is_binary(req):
+        data = dict(req.query_params)
+        images = [await req.body()]
+    else:
+        return await _json_body(req) or {}
+    if images: data["imageArray"] = images
+    return data
+
+def _no_cache(req):
+    return "no-cache" in req.headers.get("cache-control", "")
+
+async def _cache_lookup(no_cache, provider_name, provider, data):
+    if not ANSWER_CACHE.enabled or no_cache: return None, None, None
+    key = AnswerCache.key(provider_name, provider.model_name, data.get("transcript"), data.get("imageUrl"),
+                          data.get("imageBase64"), data.get("imageArray"))
+    # The disk tier does file I/O, so keep it off the event loop.
+    cached, tier = await asyncio.to_thread(ANSWER_CACHE.get, key) if ANSWER_CACHE.disk_dir else ANSWER_CACHE.get(key)
+    return key, cached, tier
+
+async def _answer_job_async(data, no_cache=False, priority="answer"):
+    """Async twin of api.index._answer_job: (result, cache headers)."""
+    provider_name = data.get("provider","google")
+    provider = get_async_provider(provider_name, data.get("model"))
+    cache_key, cached, tier = await _cache_lookup(no_cache, provider_name, provider, data)
+    if cached: return cached, {"X-Cache": "HIT", "X-Cache-Tier": tier}
+    report = await asyncio.to_thread(_prepare_images, provider_name, data)
+    async with ADMISSION.gate(provider_name).admit_async(PRIORITIES[priority], ADMISSION.timeout(priority)):
+        result = await provider.get_response(transcript=data.get("transcript"), image_url=data.get("imageUrl"),
+                                             image_base64=data.get("imageBase64"), image_array=data.get("imageArray"))
+    if "error" in result: return result, {}
+    if cache_key and _cacheable(provider, result.get("model")): await asyncio.to_thread(ANSWER_CACHE.put, cache_key, result)
+    if report: result = {**result, "images": report}
+    return result, {"X-Cache": "MISS" if cache_key else "BYPASS"}
+
+async def answer(req: Request):
+    if _too_large(req): return JSONResponse({"error": "Payload too large"}, 413)
+    try:
+        with timed("upload_read"): data = await _answer_payload(req)
+        result, headers = await _answer_job_async(data, _no_cache(req))
+        return JSONResponse(result, 400 if "error" in result else 200, headers)
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return JSONResponse(body, 429, headers)
+    except DeadlineExceeded as e:
+        return JSONResponse({"error": str(e)}, 504)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except Exception:
+        log.exception("answer failed")
+        return JSONResponse({"error":"Server error"}, 500)
+
+async def answer_stream(req: Request):
+    if _too_large(req): return JSONResponse({"error": "Payload too large"}, 413)
+    try:
+        with timed("upload_read"): data = await _answer_payload(req)
+        provider_name = data.get("provider","google")
+        provider = get_async_provider(provider_name, data.get("model"))
+        cache_key, cached, tier = await _cache_lookup(_no_cache(req), provider_name, provider, data)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "MISS" if cache_key else "BYPASS"}
+        if cached:
+            headers.update({"X-Cache": "HIT", "X-Cache-Tier": tier})
+            body = _sse({"text": cached["answer"]}, "delta") + _sse({"model": provider.model_name, "cache": tier}, "done")
+            return StreamingResponse(iter([body]), media_type="text/event-stream", headers=headers)
+        report = await asyncio.to_thread(_prepare_images, provider_name, data)
+        gate = ADMISSION.gate(provider_name)
+        release = gate.release_once(await gate.acquire_async(PRIORITIES["answer"], ADMISSION.timeout("answer")))
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return JSONResponse(body, 429, headers)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+    async def gen():
+        yield ": stream-open\n\n"
+        if report: yield _sse(report, "images")
+        answer_parts = []
+        try:
+            async for frame in provider.stream_response(
+                    transcript=data.get("transcript"), image_url=data.get("imageUrl"),
+                    image_base64=data.get("imageBase64"), image_array=data.get("imageArray")):
+                yield frame
+                if not cache_key: continue
+                event, payload = _parse_sse(frame)
+                if event == "delta": answer_parts.append(payload["text"])
+                elif event == "done" and _cacheable(provider, payload.get("model")):
+                    await asyncio.to_thread(ANSWER_CACHE.put, cache_key, {"answer": "".join(answer_parts), "model": payload.get("model")})
+        finally:
+            release()
+    # The background task runs once the response is over, whether or not the body was ever iterated.
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=headers, background=BackgroundTask(release))
+
+async def answer_batch(req: Request):
+    """Same contract as the Flask route: one SSE `result` per job in completion order, then `done`."""
+    if _too_large(req): return JSONResponse({"error": "Payload too large"}, 413)
+    try:
+        with timed("upload_read"): jobs, concurrency = _batch_request(await _json_body(req))
+        if len(jobs) > 1:
+            ADMISSION.check_client("/api/answer/batch", req.headers, req.client.host if req.client else None, cost=len(jobs) - 1)
+    except AdmissionRejected as e:
+        body, headers = _rejected_body(e)
+        return JSONResponse(body, 429, headers)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    no_cache, slots = _no_cache(req), asyncio.Semaphore(concurrency)
+
+    async def run(index):
+        t0 = time.perf_counter()
+        try:
+            async with slots: return _job_result(index, jobs[index], *await _answer_job_async(jobs[index], no_cache, "batch"), t0)
+        except Exception as e:
+            return {"index": index, "id": jobs[index].get("id", index), **_job_error(e),
+                    "elapsed_ms": round((time.perf_counter() - t0) * 1000)}
+
+    async def gen():
+        yield ": stream-open\n\n"
+        t0, ok = time.perf_counter(), 0
+        tasks = [asyncio.ensure_future(run(i)) for i in range(len(jobs))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                ok += result["status"] == 200
+                yield _sse(result, "result")
+        finally:
+            for task in tasks: task.cancel()  # client went away: stop what's still running
+        yield _sse({"jobs": len(jobs), "ok": ok, "failed": len(jobs) - ok,
+                    "elapsed_ms": round((time.perf_counter() - t0) * 1000)}, "done")
+    return StreamingResponse(gen(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _off_loop(fn, *args):
+    # With a shared (Postgres) context backend, session context reads/writes are blocking DB round trips.
+    return await asyncio.to_thread(fn, *args) if SESSION_CONTEXT.backend else fn(*args)
+
+async def transcribe(req: Request):
+    if _too_large(req): return JSONResponse({"error": "Payload too large"}, 413)
+    try:
+        with timed("upload_read"):
+            if _mimetype(req) == "multipart/form-data":
+                fields = await req.form()
+                f = fields.get("audio")
+                buf = await f.read() if f is not None and not isinstance(f, str) else None
+                mime = fields.get("mimeType") or (f.content_type if buf else None)
+            elif _is_binary(req):
+                fields, buf, mime = req.query_params, await req.body(), _mimetype(req)
+            else:
+                buf, mime, fields = _json_audio(await _json_body(req) or {})
+        response, job = await _off_loop(_stt_admit, buf, mime, fields)
+        if not response:
+            result = await transcribe_hedged(job["audio_file"], job["mime"], job["prompt"], job["budget"])
+            response = await _off_loop(_stt_respond, result, job)
+        body, status, headers = response
+        return JSONResponse(body, status, headers)
+    except Exception as e:
+        log.exception("transcribe failed")
+        return JSONResponse({"error": f"Transcription error: {str(e)}"}, 500)
+
+app = Starlette(routes=[
+    Route("/api/answer", cors(instrumented("/api/answer", limited("/api/answer", answer))), methods=["POST"]),
+    Route("/api/answer/stream", cors(instrumented("/api/answer/stream", limited("/api/answer/stream", answer_stream))), methods=["POST"]),
+    Route("/api/answer/batch", cors(instrumented("/api/answer/batch", limited("/api/answer/batch", answer_batch))), methods=["POST"]),
+    Route("/api/transcribe", cors(instrumented("/api/transcribe", limited("/api/transcribe", transcribe))), methods=["POST"]),
+    # Sessions, health, landing page, CORS preflights: the sync Flask app, run on a thread pool.
+    Mount("/", app=WSGIMiddleware(flask_app, workers=int(os.getenv("WSGI_WORKERS", 10)))),
+])
+
+if __name__ == "__main__":
+    import uvicorn
+    host = os.getenv("HOST","0.0.0.0")
+    port = int(os.getenv("PORT",5055))
+    log.info("Starting AnswerAI API (async mode) on %s:%s", host, port)
+    uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,109 @@
+"""Cold-start benchmark: what a fresh serverless instance pays before answering its first request.
+
+Each sample is a new interpreter that imports api/index.py and serves one request through Flask's test
+client, the way a cold Vercel function does. Per route it reports the import time, the time to the first
+response, and which heavy SDKs that route ended up loading. Upstream calls go to the local stubs.
+
+    python -m bench.coldstart                 # every route, 5 fresh processes each
+    python -m bench.coldstart --runs 10 --route /health --importtime
+"""
+import os, sys, json, argparse, statistics, subprocess
+
+from bench.stubs import StubServer, StubConfig, UPSTREAMS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("openai", "google.generativeai", "PIL", "requests", "httpx", "pg8000")
+
+# name -> (method, path, body kind); the sessions routes answer 503 without POSTGRES_URL, which still
+# measures the import side.
+ROUTES = {
+    "/health": ("GET", "/health", None),
+    "/": ("GET", "/", None),
+    "/api/sessions": ("GET", "/api/sessions?fields=id,title,created_at,preview", None),
+    "/api/answer": ("POST", "/api/answer", "answer"),
+    "/api/answer (image)": ("POST", "/api/answer", "answer-image"),
+    "/api/transcribe": ("POST", "/api/transcribe", "audio"),
+}
+
+CHILD = r"""
+import sys, json, time
+t0 = time.perf_counter()
+import api.index as m
+imported = time.perf_counter()
+method, path, kind = json.loads(sys.argv[1])
+kwargs = {}
+if kind == "answer":
+    kwargs["json"] = {"provider": "google", "transcript": "What is a B-tree?"}
+elif kind == "answer-image":
+    import base64, io
+    png = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+    kwargs.update(data={"provider": "google", "transcript": "What does this show?", "images": (io.BytesIO(png), "shot.png", "image/png")},
+                  content_type="multipart/form-data")
+elif kind == "audio":
+    import io
+    kwargs.update(data={"mimeType": "audio/webm", "audio": (io.BytesIO(b"\x1a\x45\xdf\xa3" + bytes(20000)), "chunk.webm", "audio/webm")},
+                  content_type="multipart/form-data")
+resp = m.app.test_client().open(path, method=method, **kwargs)
+done = time.perf_counter()
+print(json.dumps({"import_ms": (imported - t0) * 1000, "first_response_ms": (done - imported) * 1000,
+                  "total_ms": (done - t0) * 1000, "status": resp.status_code,
+                  "loaded": sorted(n for n in %r if n in sys.modules)}))
+""" % (HEAVY_MODULES,)
+
+def sample(route, env, importtime=False):
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD, json.dumps(ROUTES[route])]
+    proc = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+    if proc.returncode or not lines:
+        raise RuntimeError(f"{route}: child failed (code {proc.returncode}):\n{proc.stderr[-2000:]}")
+    result = json.loads(lines[-1])
+    if importtime: result["slowest_imports"] = _slowest_imports(proc.stderr)
+    return result
+
+def _slowest_imports(stderr, top=8):
+    """Top cumulative entries from `-X importtime` output, as (module, ms)."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        try:
+            _, cumulative, name = [p.strip() for p in line[len("import time:"):].split("|")]
+            rows.append((name, int(cumulative) / 1000))
+        except ValueError:
+            continue
+    return sorted(rows, key=lambda r: -r[1])[:top]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per route")
+    parser.add_argument("--route", action="append", choices=sorted(ROUTES), help="limit to these routes (repeatable)")
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports (python -X importtime)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    stubs = StubServer({name: StubConfig(latency=0, token_ms=0) for name in UPSTREAMS}).start()
+    # Keys/URLs for the stubs, quiet logs, and no warm-up thread muddying the numbers.
+    env = dict(os.environ, **stubs.env(), LOG_LEVEL="ERROR", WARMUP_CLIENTS="false", PYTHONPATH=ROOT,
+               PYTHONDONTWRITEBYTECODE="1")
+    results = {}
+    try:
+        for route in args.route or ROUTES:
+            runs = [sample(route, env, args.importtime and i == 0) for i in range(args.runs)]
+            med = lambda key: round(statistics.median(r[key] for r in runs), 1)
+            results[route] = {"import_ms": med("import_ms"), "first_response_ms": med("first_response_ms"),
+                              "total_ms": med("total_ms"), "status": runs[-1]["status"], "loaded": runs[-1]["loaded"],
+                              "slowest_imports": runs[0].get("slowest_imports")}
+    finally:
+        stubs.stop()
+
+    print(f"{'route':<22} {'import':>8} {'first':>8} {'total':>8} {'status':>6}  SDKs loaded")
+    for route, r in results.items():
+        print(f"{route:<22} {r['import_ms']:>8.1f} {r['first_response_ms']:>8.1f} {r['total_ms']:>8.1f} {r['status']:>6}  "
+              f"{', '.join(r['loaded']) or '-'}")
+        for name, ms in r["slowest_imports"] or []: print(f"{'':<24}{ms:>8.1f} ms  {name}")
+    print(f"(median ms over {args.runs} fresh processes per route)")
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Traffic generator for the backend: replays what the side panel sends during an interview.
+
+Scenarios (weighted, closed loop: each worker starts its next request as soon as one finishes):
+
+    transcribe   a ~5 s webm/opus chunk, multipart, the way the recorder uploads it
+    answer       /api/answer with a question and 1-3 distinct screenshots as multipart `images` parts
+    stream       /api/answer/stream; latency is time to the `done` event, ttft is time to the first delta
+    session      PATCH /api/sessions/<id>/append with the next transcript delta (needs POSTGRES_URL on the server)
+"""
+import io, json, math, time, uuid, random, threading, http.client
+from urllib.parse import urlparse
+
+SCENARIOS = ("transcribe", "answer", "stream", "session")
+DEFAULT_MIX = "transcribe=8,answer=1,stream=1,session=2"
+QUESTIONS = [
+    "Given an array of integers, return the length of the longest subarray that sums to k.",
+    "How would you design a rate limiter for a public API?",
+    "Tell me about a time you disagreed with a teammate and how you resolved it.",
+    "What is the difference between a process and a thread?",
+]
+
+def parse_mix(spec):
+    mix = {}
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS: raise ValueError(f"Unknown scenario: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def webm_chunk(seconds=5.0, kbps=32):
+    """Bytes shaped like a MediaRecorder opus chunk: EBML magic plus payload at the recorder's bitrate."""
+    return b"\x1a\x45\xdf\xa3" + random.randbytes(int(seconds * kbps * 1000 / 8))
+
+def screenshots(n=12, size=(1440, 900)):
+    """PNG "screen captures": editor-like text blocks, different enough that none is dropped as a duplicate."""
+    from PIL import Image, ImageDraw
+    shots = []
+    for i in range(n):
+        rng = random.Random(i)
+        im = Image.new("RGB", size, (30, 30, 30))
+        draw = ImageDraw.Draw(im)
+        for row in range(40):
+            y = 20 + row * 21
+            x = 40 + rng.randint(0, 6) * 24
+            draw.rectangle([x, y, x + rng.randint(80, 900), y + 12], fill=tuple(rng.randint(90, 230) for _ in range(3)))
+        draw.rectangle([size[0] - 300, 0, size[0], size[1]], fill=(rng.randint(0, 80),) * 3)
+        buf = io.BytesIO()
+        im.save(buf, "PNG")
+        shots.append(buf.getvalue())
+    return shots
+
+def multipart(fields, files):
+    """(content type, body) for form fields plus (name, filename, mime, bytes) file parts."""
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields.items():
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, mime, data in files:
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                  f"Content-Type: {mime}\r\n\r\n".encode())
+        out.write(data + b"\r\n")
+    out.write(f"--{boundary}--\r\n".encode())
+    return f"multipart/form-data; boundary={boundary}", out.getvalue()
+
+class Recorder:
+    """Latency samples per scenario, plus status counts."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # scenario -> [(ms, ok)]
+        self.ttft = {}     # scenario -> [ms]
+        self.statuses = {}
+
+    def add(self, scenario, ms, status, ttft_ms=None):
+        with self._lock:
+            self.samples.setdefault(scenario, []).append((ms, 200 <= status < 300))
+            self.statuses.setdefault(scenario, {}).setdefault(status, 0)
+            self.statuses[scenario][status] += 1
+            if ttft_ms is not None: self.ttft.setdefault(scenario, []).append(ttft_ms)
+
+def percentile(sorted_values, p):
+    if not sorted_values: return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+def summarize(recorder, elapsed):
+    """{scenario: {count, errors, rps, p50, p95, p99, max, [ttft_p50, ttft_p95]}} plus an `all` row."""
+    rows = {}
+    everything = []
+    for scenario, samples in sorted(recorder.samples.items()):
+        everything += samples
+        rows[scenario] = _row(samples, elapsed)
+        if recorder.ttft.get(scenario):
+            ttft = sorted(recorder.ttft[scenario])
+            rows[scenario].update(ttft_p50=percentile(ttft, 50), ttft_p95=percentile(ttft, 95))
+        rows[scenario]["statuses"] = dict(recorder.statuses[scenario])
+    if everything: rows["all"] = _row(everything, elapsed)
+    return rows
+
+def _row(samples, elapsed):
+    ok = sorted(ms for ms, good in samples if good)
+    return {"count": len(samples), "errors": sum(1 for _, good in samples if not good),
+            "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+            "p50": percentile(ok, 50), "p95": percentile(ok, 95), "p99": percentile(ok, 99), "max": ok[-1] if ok else None}
+
+class LoadGenerator:
+    """`concurrency` worker threads, each with its own keep-alive connection, for `duration` seconds."""
+    def __init__(self, base_url, mix, concurrency=8, duration=30.0, warmup=3.0, timeout=60.0):
+        parsed = urlparse(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.mix, self.concurrency, self.duration, self.warmup, self.timeout = mix, concurrency, duration, warmup, timeout
+        self.recorder = Recorder()
+        self.chunk = webm_chunk()
+        self.images = screenshots() if {"answer", "stream"} & set(mix) else []
+        self.session_ids = []
+        self.elapsed = 0.0
+
+    def run(self):
+        names, weights = zip(*self.mix.items())
+        start = time.monotonic()
+        measure_from, stop_at = start + self.warmup, start + self.warmup + self.duration
+        def worker(n):
+            conn, rng = None, random.Random(n)
+            session = {"id": f"bench-{uuid.uuid4().hex[:12]}", "offset": 0}
+            self.session_ids.append(session["id"])
+            while time.monotonic() < stop_at:
+                scenario = rng.choices(names, weights)[0]
+                conn = conn or http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                t0 = time.monotonic()
+                try:
+                    status, ttft = getattr(self, f"_{scenario}")(conn, rng, session)
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    conn, status, ttft = None, 599, None
+                ms = (time.monotonic() - t0) * 1000
+                if t0 >= measure_from: self.recorder.add(scenario, round(ms, 2), status, ttft and round((ttft - t0) * 1000, 2))
+            if conn: conn.close()
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(self.concurrency)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.elapsed = max(0.0, time.monotonic() - measure_from)
+        return summarize(self.recorder, self.elapsed)
+
+    def cleanup(self):
+        """Delete the sessions the `session` scenario created."""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            for sid in self.session_ids: self._send(conn, "DELETE", f"/api/sessions/{sid}")
+        except (OSError, http.client.HTTPException): pass
+        finally: conn.close()
+
+    @staticmethod
+    def _send(conn, method, path, body=None, content_type=None):
+        conn.request(method, path, body=body, headers={"Content-Type": content_type} if content_type else {})
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp.status, data
+
+    def _transcribe(self, conn, rng, session):
+        session["seq"] = session.get("seq", -1) + 1
+        content_type, body = multipart({"mimeType": "audio/webm;codecs=opus", "sessionId": session["id"], "seq": session["seq"]},
+                                       [("audio", "chunk.webm", "audio/webm", self.chunk)])
+        return self._send(conn, "POST", "/api/transcribe", body, content_type)[0], None
+
+    def _answer_parts(self, rng):
+        # A unique question per call keeps the answer cache out of the measurement.
+        fields = {"provider": "google", "transcript": f"{rng.choice(QUESTIONS)} (#{uuid.uuid4().hex[:8]})"}
+        files = [("images", f"shot{i}.png", "image/png", img) for i, img in enumerate(rng.sample(self.images, rng.randint(1, 3)))]
+        return multipart(fields, files)
+
+    def _answer(self, conn, rng, session):
+        content_type, body = self._answer_parts(rng)
+        return self._send(conn, "POST", "/api/answer", body, content_type)[0], None
+
+    def _stream(self, conn, rng, session):
+        content_type, body = self._answer_parts(rng)
+        conn.request("POST", "/api/answer/stream", body=body, headers={"Content-Type": content_type})
+        resp = conn.getresponse()
+        ttft, status = None, resp.status
+        for line in resp:
+            if ttft is None and line.startswith(b"event: delta"): ttft = time.monotonic()
+            if line.startswith(b"event: error"): status = 502
+        return status, ttft
+
+    def _session(self, conn, rng, session):
+        delta = " ".join(rng.choice(QUESTIONS).split()[:rng.randint(6, 14)]) + " "
+        status, data = self._send(conn, "PATCH", f"/api/sessions/{session['id']}/append",
+                                  json.dumps({"delta": delta, "offset": session["offset"], "title": "Benchmark session"}),
+                                  "application/json")
+        if status == 200: session["offset"] = json.loads(data)["length"]
+        elif status == 409: session["offset"] = json.loads(data).get("length", 0)
+        return status, None
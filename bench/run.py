@@ -0,0 +1,127 @@
+"""Offline benchmark: stub upstreams + the real backend + a load generator, no network or API quota needed.
+
+    python -m bench.run                                   # sync Flask app, default traffic mix, 30 s
+    python -m bench.run --async --concurrency 32          # asgi.py under uvicorn
+    python -m bench.run --groq latency=250,ratelimit=0.1 --mix transcribe=1 --json bench_output.txt
+    python -m bench.run --baseline bench_output.txt        # exit 1 if any p95 regressed by more than 15%
+
+The backend runs as a subprocess with every upstream URL pointed at the stubs. The `session` scenario
+needs POSTGRES_URL in the environment (use a scratch database); without it, it's dropped from the mix.
+"""
+import os, sys, json, time, argparse, subprocess, http.client
+from urllib.parse import urlparse
+
+from bench.stubs import StubServer, add_stub_args, configs_from_args
+from bench.load import LoadGenerator, DEFAULT_MIX, parse_mix
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _get_json(base_url, path, timeout=2.0):
+    parsed = urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read() or b"null")
+    finally:
+        conn.close()
+
+def start_backend(args, stubs):
+    # Every load worker is the same client, so the per-client rate limit is off unless asked for.
+    env = dict(os.environ, **stubs.env(), PORT=str(args.port), HOST="127.0.0.1", DEBUG="false",
+               LOG_LEVEL=args.log_level, PYTHONPATH=ROOT, RATE_LIMIT_RPS=os.getenv("RATE_LIMIT_RPS", "0"))
+    cmd = [sys.executable, "asgi.py"] if args.use_async else [sys.executable, os.path.join("api", "index.py")]
+    if args.server_cmd: cmd = args.server_cmd.split()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None: raise SystemExit(f"Backend exited during startup (code {proc.returncode})")
+        try:
+            status, health = _get_json(base_url, "/health")
+            if status == 200: return proc, base_url, health
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit(f"Backend did not answer /health within {args.startup_timeout:.0f}s")
+
+def render(report):
+    head = f"{'scenario':<11} {'count':>7} {'errors':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'ttft50':>8} {'ttft95':>8}"
+    lines = [head, "-" * len(head)]
+    fmt = lambda v: "-" if v is None else f"{v:.0f}"
+    for name, r in report["scenarios"].items():
+        lines.append(f"{name:<11} {r['count']:>7} {r['errors']:>7} {r['rps']:>8.2f} {fmt(r['p50']):>8} {fmt(r['p95']):>8} "
+                     f"{fmt(r['p99']):>8} {fmt(r['max']):>8} {fmt(r.get('ttft_p50')):>8} {fmt(r.get('ttft_p95')):>8}")
+    lines.append("(latencies in ms, successful requests only)")
+    for name, r in report["scenarios"].items():
+        odd = {k: v for k, v in r.get("statuses", {}).items() if not 200 <= int(k) < 300}
+        if odd: lines.append(f"{name}: non-2xx statuses {odd}")
+    lines.append("upstream stubs: " + ", ".join(
+        f"{name} {s['calls']} calls ({s['errors']} 500s, {s['ratelimited']} 429s)" for name, s in report["stubs"].items()))
+    return "\n".join(lines)
+
+def regressions(report, baseline, tolerance):
+    """Scenarios whose p95 (or error count) got worse than `baseline` by more than `tolerance`."""
+    found = []
+    for name, r in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old or old.get("p95") is None or r.get("p95") is None: continue
+        if r["p95"] > old["p95"] * (1 + tolerance):
+            found.append(f"{name}: p95 {old['p95']:.0f}ms -> {r['p95']:.0f}ms")
+        old_rate, new_rate = old["errors"] / max(old["count"], 1), r["errors"] / max(r["count"], 1)
+        if new_rate > old_rate + tolerance * 0.1:
+            found.append(f"{name}: error rate {old_rate:.1%} -> {new_rate:.1%}")
+    return found
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--async", dest="use_async", action="store_true", help="serve with asgi.py instead of the Flask app")
+    parser.add_argument("--server-cmd", help="custom backend command (run from the repo root), e.g. a gunicorn line")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights (default {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds of load before measuring starts")
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--log-level", default="WARNING", help="backend LOG_LEVEL")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="JSON report from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed p95 regression vs --baseline (fraction)")
+    add_stub_args(parser)
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    stubs = StubServer(configs_from_args(args)).start()
+    proc, base_url, _ = start_backend(args, stubs)
+    try:
+        if "session" in mix and not os.getenv("POSTGRES_URL"):
+            print("No POSTGRES_URL: dropping the session scenario.", file=sys.stderr)
+            mix.pop("session")
+        if not mix: raise SystemExit("Nothing to run")
+        load = LoadGenerator(base_url, mix, args.concurrency, args.duration, args.warmup)
+        print(f"Running {args.duration:.0f}s ({args.warmup:.0f}s warm-up) at concurrency {args.concurrency} "
+              f"against {'asgi.py' if args.use_async else 'api/index.py'}, mix {mix}", file=sys.stderr)
+        scenarios = load.run()
+        if "session" in mix: load.cleanup()
+    finally:
+        proc.terminate()
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired: proc.kill()
+        stubs.stop()
+
+    report = {"mode": "async" if args.use_async else "sync", "concurrency": args.concurrency,
+              "duration_s": round(load.elapsed, 2), "mix": mix, "scenarios": scenarios, "stubs": stubs.stats(),
+              "stub_config": {name: vars(cfg) for name, cfg in stubs.configs.items()}}
+    print(render(report))
+    found = []
+    if args.baseline:  # read before --json, which may overwrite the same file
+        with open(args.baseline) as f: found = regressions(report, json.load(f), args.tolerance)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, indent=2)
+    for line in found: print(f"REGRESSION {line}", file=sys.stderr)
+    if found: raise SystemExit(1)
+    return report
+
+if __name__ == "__main__":
+    main()
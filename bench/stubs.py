@@ -0,0 +1,221 @@
+"""Local stand-ins for the upstream APIs, so the backend can be load-tested without network or quota.
+
+One server answers for all three upstreams, told apart by path prefix:
+
+    /v1/...          OpenAI      (chat completions, streaming or not; audio transcriptions)
+    /openai/v1/...   Groq        (same OpenAI-compatible surface)
+    /v1beta/...      Gemini REST (generateContent, streamGenerateContent, models list)
+
+Each upstream has its own latency, error rate and 429 rate:
+
+    python -m bench.stubs --port 9100 --groq latency=300,error=0.01,ratelimit=0.05
+"""
+import re, json, math, time, random, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+UPSTREAMS = {"openai": "/v1/", "groq": "/openai/v1/", "gemini": "/v1beta/"}
+GEMINI_MODELS = ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-2.0-flash-lite", "gemini-1.5-flash"]
+ANSWER_WORDS = ("Use a hash map keyed by the running prefix sum; each lookup is O(1), so the whole pass is "
+                "O(n) time and O(n) space. Edge cases: empty input, negative numbers, duplicate keys.").split()
+TRANSCRIPT = "so tell me about a time you had to debug a production issue under pressure"
+
+class StubConfig:
+    """Behaviour of one upstream. `latency` is the median in ms (log-normal, spread by `jitter`); `token_ms`
+    paces streamed chunks; `error` and `ratelimit` are the fractions of calls answered 500 / 429."""
+    FIELDS = {"latency": float, "jitter": float, "token_ms": float, "tokens": int, "error": float,
+              "ratelimit": float, "retry_after": float}
+
+    def __init__(self, latency=400.0, jitter=0.35, token_ms=15.0, tokens=40, error=0.0, ratelimit=0.0, retry_after=1.0):
+        self.latency, self.jitter, self.token_ms, self.tokens = latency, jitter, token_ms, tokens
+        self.error, self.ratelimit, self.retry_after = error, ratelimit, retry_after
+
+    @classmethod
+    def parse(cls, spec, base=None):
+        """'latency=300,error=0.01' on top of `base`'s values."""
+        cfg = cls(**(vars(base) if base else {}))
+        for item in filter(None, (spec or "").split(",")):
+            key, _, value = item.partition("=")
+            if key.strip() not in cls.FIELDS: raise ValueError(f"Unknown stub setting: {key}")
+            setattr(cfg, key.strip(), cls.FIELDS[key.strip()](value))
+        return cfg
+
+    def delay(self):
+        if self.latency <= 0: return 0.0
+        return random.lognormvariate(math.log(self.latency), self.jitter) / 1000
+
+class StubServer:
+    """ThreadingHTTPServer running the stubs on a background thread; `stats()` counts what was served."""
+    def __init__(self, configs, host="127.0.0.1", port=0):
+        self.configs = configs
+        self._lock = threading.Lock()
+        self._stats = {name: {"calls": 0, "ok": 0, "errors": 0, "ratelimited": 0} for name in UPSTREAMS}
+        self.httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        """Environment that points api/index.py (and asgi.py) at this server."""
+        return {"OPENAI_BASE_URL": f"{self.url}/v1", "GROQ_BASE_URL": f"{self.url}/openai/v1",
+                "GEMINI_API_ENDPOINT": self.url,
+                "OPENAI_API_KEY": "stub", "GROQ_API_KEY": "stub", "GOOGLE_API_KEY": "stub"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="bench-stubs", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, upstream, outcome):
+        with self._lock:
+            self._stats[upstream]["calls"] += 1
+            self._stats[upstream][outcome] += 1
+
+    def stats(self):
+        with self._lock: return {k: dict(v) for k, v in self._stats.items()}
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+        def log_message(self, *args): pass
+
+        def _upstream(self):
+            # Longest prefix first: /openai/v1/ would otherwise never beat /v1/.
+            for name, prefix in sorted(UPSTREAMS.items(), key=lambda kv: -len(kv[1])):
+                if self.path.startswith(prefix): return name
+            return None
+
+        def _json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items(): self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunked(self, content_type, pieces, pace):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, piece in enumerate(pieces):
+                if i: time.sleep(pace)
+                data = piece.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _fail(self, upstream, cfg):
+            """Inject a 429 or 500 for this call; returns True when it did."""
+            roll = random.random()
+            if roll < cfg.ratelimit:
+                server.count(upstream, "ratelimited")
+                self._json(429, {"error": {"message": "Rate limit reached (stub)", "code": 429, "type": "rate_limit_exceeded"}},
+                           {"Retry-After": f"{cfg.retry_after:g}"})
+                return True
+            if roll < cfg.ratelimit + cfg.error:
+                server.count(upstream, "errors")
+                self._json(500, {"error": {"message": "Internal error (stub)", "code": 500}})
+                return True
+            return False
+
+        def do_GET(self):
+            upstream = self._upstream()
+            if upstream == "gemini" and re.match(r"^/v1beta/models/?(\?|$)", self.path):
+                models = [{"name": f"models/{m}", "supportedGenerationMethods": ["generateContent", "countTokens"]}
+                          for m in GEMINI_MODELS]
+                return self._json(200, {"models": models})
+            self._json(404, {"error": {"message": f"No stub for GET {self.path}"}})
+
+        def do_HEAD(self):
+            # ClientRegistry.warmup HEADs each base URL just to open the connection.
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            upstream = self._upstream()
+            if upstream is None: return self._json(404, {"error": {"message": f"No stub for POST {self.path}"}})
+            cfg = server.configs[upstream]
+            time.sleep(cfg.delay())
+            if self._fail(upstream, cfg): return
+            path = self.path.split("?")[0]
+            if path.endswith("/audio/transcriptions"):
+                self._json(200, {"text": TRANSCRIPT})
+            elif path.endswith("/chat/completions"):
+                self._openai_chat(json.loads(body or b"{}"), cfg)
+            elif ":streamGenerateContent" in path:
+                self._gemini_stream(cfg)
+            elif ":generateContent" in path:
+                self._json(200, _gemini_response(" ".join(_answer_tokens(cfg.tokens)), final=True))
+            else:
+                return self._json(404, {"error": {"message": f"No stub for POST {self.path}"}})
+            server.count(upstream, "ok")
+
+        def _openai_chat(self, req, cfg):
+            model, tokens = req.get("model", "stub"), _answer_tokens(cfg.tokens)
+            usage = {"prompt_tokens": 120, "completion_tokens": len(tokens), "total_tokens": 120 + len(tokens)}
+            if not req.get("stream"):
+                return self._json(200, {"id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                                        "choices": [{"index": 0, "finish_reason": "stop",
+                                                     "message": {"role": "assistant", "content": " ".join(tokens)}}],
+                                        "usage": usage})
+            def chunk(delta, finish=None, usage=None):
+                return {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                        "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish}], "usage": usage}
+            frames = [chunk({"content": t + " "}) for t in tokens] + [chunk({}, "stop"), chunk(None, usage=usage)]
+            self._chunked("text/event-stream", [f"data: {json.dumps(f)}\n\n" for f in frames] + ["data: [DONE]\n\n"],
+                          cfg.token_ms / 1000)
+
+        def _gemini_stream(self, cfg):
+            tokens = _answer_tokens(cfg.tokens)
+            groups = [" ".join(tokens[i:i + 4]) + " " for i in range(0, len(tokens), 4)]
+            chunks = [_gemini_response(text, final=i == len(groups) - 1) for i, text in enumerate(groups)]
+            if "alt=sse" in self.path:  # REST clients (asgi.py) ask for SSE
+                return self._chunked("text/event-stream", [f"data: {json.dumps(c)}\n\n" for c in chunks], cfg.token_ms / 1000)
+            # The genai SDK's REST transport reads one JSON array, streamed element by element.
+            pieces = ["[" + json.dumps(chunks[0])] + ["," + json.dumps(c) for c in chunks[1:]] + ["]"]
+            self._chunked("application/json", pieces, cfg.token_ms / 1000)
+
+    return Handler
+
+def _answer_tokens(n):
+    return [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(n)]
+
+def _gemini_response(text, final=False):
+    resp = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+    if final:
+        resp["candidates"][0]["finishReason"] = "STOP"
+        resp["usageMetadata"] = {"promptTokenCount": 120, "candidatesTokenCount": 40, "totalTokenCount": 160}
+    return resp
+
+def add_stub_args(parser):
+    parser.add_argument("--stub-defaults", default="", help="settings shared by every upstream, e.g. latency=400,error=0.01")
+    for name in UPSTREAMS:
+        parser.add_argument(f"--{name}", default="", metavar="SPEC", help=f"{name} overrides, e.g. latency=300,ratelimit=0.05")
+
+def configs_from_args(args):
+    base = StubConfig.parse(args.stub_defaults)
+    return {name: StubConfig.parse(getattr(args, name), base) for name in UPSTREAMS}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the upstream API stubs on their own.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_stub_args(parser)
+    args = parser.parse_args()
+    stubs = StubServer(configs_from_args(args), args.host, args.port)
+    print(f"Stubs listening on {stubs.url}")
+    for k, v in stubs.env().items(): print(f"  {k}={v}")
+    try: stubs.httpd.serve_forever()
+    except KeyboardInterrupt: pass
@@ -136,15 +136,18 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 
   // ====== SESSION SAVE ======
+  function sessionTitle() {
+    return aggregatedTranscript.split(' ').slice(0, 8).join(' ') + '...';
+  }
+
   async function saveSession() {
     if (!aggregatedTranscript.trim()) return;
-    const apiBase = await getApiBase();
     const payload = {
       id: sessionId,
       transcript: aggregatedTranscript,
       started_at: sessionStart,
       ended_at: new Date().toISOString(),
-      title: aggregatedTranscript.split(' ').slice(0, 8).join(' ') + '...'
+      title: sessionTitle()
     };
     // Save locally
     const key = 'session_' + sessionId;
@@ -157,13 +160,48 @@ document.addEventListener('DOMContentLoaded', () => {
       chrome.storage.local.set({ session_index: idx });
     });
     // Try cloud sync
-    try {
-      fetch(apiBase + '/api/sessions', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
-      });
-    } catch { }
+    syncTranscript();
+  }
+
+  // ====== CLOUD SYNC ======
+  // Only text added since the last successful sync is sent (PATCH .../append). If the server's copy
+  // has a different length it answers 409, and we fall back to one full save before appending again.
+  let synced = { id: null, chars: 0, offset: 0 };
+  let syncChain = Promise.resolve();
+  let syncTimer = null;
+
+  function syncTranscript() {
+    syncChain = syncChain.then(doSync).catch(() => { });
+    return syncChain;
+  }
+
+  function scheduleSync() {
+    if (syncTimer) return;
+    syncTimer = setTimeout(() => { syncTimer = null; syncTranscript(); }, 10000);
+  }
+
+  async function doSync() {
+    const id = sessionId, upTo = aggregatedTranscript.length;
+    if (synced.id !== id) synced = { id, chars: 0, offset: 0 };
+    if (upTo <= synced.chars || !aggregatedTranscript.trim()) return;
+    const apiBase = await getApiBase();
+    const title = sessionTitle();
+    const res = await fetch(apiBase + '/api/sessions/' + encodeURIComponent(id) + '/append', {
+      method: 'PATCH',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ delta: aggregatedTranscript.slice(synced.chars, upTo), offset: synced.offset, title })
+    });
+    if (res.ok) {
+      synced = { id, chars: upTo, offset: (await res.json()).length };
+      return;
+    }
+    if (res.status !== 409) return;
+    const full = await fetch(apiBase + '/api/sessions', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ id, title, transcript: aggregatedTranscript.slice(0, upTo) })
+    });
+    if (full.ok) synced = { id, chars: upTo, offset: (await full.json()).length };
   }
 
   // ====== CORE RECORDING ======
@@ -325,43 +363,53 @@ document.addEventListener('DOMContentLoaded', () => {
         // Chunk queue - process one at a time, buffer the rest
         const chunkQueue = [];
         let processing = false;
+        let chunkSeq = 0; // per-session; the server uses it to spot retried and out-of-order chunks
 
         async function processQueue() {
           if (processing || chunkQueue.length === 0) return;
           processing = true;
-          const { b64, mime } = chunkQueue.shift();
+          const chunk = chunkQueue.shift();
+          const { blob, mime, seq } = chunk;
           try {
             const controller = new AbortController();
             const timeout = setTimeout(() => controller.abort(), 15000);
-            
-            // Append context snippet so ai engine properly stitches word boundaries
-            const previousText = aggregatedTranscript.slice(-500); 
+
+            // Multipart upload: raw audio bytes, no base64 inflation
+            const form = new FormData();
+            form.append('audio', blob, 'chunk.webm');
+            form.append('mimeType', mime || 'audio/webm');
+            form.append('sessionId', sessionId);
+            form.append('seq', seq); // the server keeps the transcript tail for prompting and stitching
 
             const res = await fetch(apiBase + '/api/transcribe', {
               method: 'POST',
-              headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ audioBase64: b64, mimeType: mime || 'audio/webm', sessionId, previousText }),
+              headers: { 'X-Request-Deadline-Ms': '15000' }, // matches the abort below: no server work past it
+              body: form,
               signal: controller.signal
             });
             clearTimeout(timeout);
             if (res.ok) {
               const data = await res.json();
               const text = (data.text || '').trim();
-              
-              // Whisper models aggressively hallucinate these phrases during pure silence
-              // Strip punctuation/spaces to catch repeating loops like "Thank you. Thank you."
-              const cleanText = text.toLowerCase().replace(/[^a-z]/g, '');
-              const isHallucination = /^(thankyou|thanksforwatching|subtitlesby.*|amaraorg.*|pleasesubscribe|you|bye)+$/.test(cleanText);
 
-              if (text && text.length > 1 && !['SILENT','MUSIC','.'].includes(text.toUpperCase()) && !isHallucination) {
+              // Silence and Whisper's silence hallucinations are dropped server-side (data.skipped says which).
+              if (text && text.length > 1 && !['SILENT','MUSIC','.'].includes(text.toUpperCase())) {
                 appendTranscript(data.text);
                 logStatus("[" + (data.method || "?") + "] ✓");
               } else {
                 // Show debug info so we can see WHY transcription failed
-                const reason = isHallucination ? "hallucination dropped" : "no speech";
+                const reason = data.skipped ? data.skipped + " skipped" : "no speech";
+                const rate = data.session ? " (" + Math.round(data.session.skip_rate * 100) + "% skipped)" : "";
                 const dbg = data.debug ? " | " + data.debug.substring(0, 80) : "";
-                logStatus((data.method || "none") + ": " + reason + dbg);
+                logStatus((data.method || "none") + ": " + reason + rate + dbg);
               }
+            } else if (res.status === 429 && !chunk.retried) {
+              // Rate limited or upstreams busy: retry once when the server says to (same seq, so never doubled).
+              // Wait while still holding the queue, so no later seq overtakes this chunk and it never lands "late".
+              const wait = parseInt(res.headers.get('Retry-After') || '1', 10);
+              logStatus("⏳ busy, retrying chunk in " + wait + "s");
+              await new Promise(r => setTimeout(r, wait * 1000));
+              chunkQueue.unshift({ ...chunk, retried: true });
             } else {
               const t = await res.text();
               logStatus("API " + res.status + ": " + t.substring(0, 50));
@@ -369,6 +417,8 @@ document.addEventListener('DOMContentLoaded', () => {
           } catch (err) {
             if (err.name === 'AbortError') logStatus("⏱ chunk timed out");
             else logStatus("Net: " + err.message);
+            // Retry once with the same seq: if the first attempt did get through, the server replays its text.
+            if (!chunk.retried) chunkQueue.unshift({ ...chunk, retried: true });
           }
           processing = false;
           if (chunkQueue.length > 0) processQueue();
@@ -402,9 +452,8 @@ document.addEventListener('DOMContentLoaded', () => {
             if (!e.data || e.data.size < 100 || isPaused) return; // Drop frame if paused or null
             const curVol = meterFill ? parseInt(meterFill.style.width) || 0 : -1;
             logStatus("Chunk: " + (e.data.size / 1024).toFixed(1) + "KB vol:" + curVol + "%");
-            const b64 = await blobToDataURL(e.data);
             if (chunkQueue.length >= 15) chunkQueue.shift(); // 75 second buffer max to prevent transcript drop off
-            chunkQueue.push({ b64, mime: e.data.type });
+            chunkQueue.push({ blob: e.data, mime: e.data.type, seq: chunkSeq++ });
             processQueue();
           };
 
@@ -461,6 +510,7 @@ document.addEventListener('DOMContentLoaded', () => {
   function appendTranscript(text) {
     const chunk = text + ' ';
     aggregatedTranscript += chunk;
+    if (isRecording) scheduleSync();
     const textNode = document.createTextNode(chunk);
     transcriptEl.appendChild(textNode);
     transcriptEl.scrollTop = transcriptEl.scrollHeight;
@@ -474,7 +524,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     try {
       const apiBase = await getApiBase();
-      const res = await fetch(apiBase + '/api/sessions');
+      // List view only needs a snippet; the full transcript is fetched when a session is opened
+      const res = await fetch(apiBase + '/api/sessions?fields=id,title,created_at,preview');
       if (!res.ok) throw new Error("Failed to load");
       const sessions = await res.json();
       
@@ -497,7 +548,7 @@ document.addEventListener('DOMContentLoaded', () => {
             <button class="hist-delete-btn" title="Delete session"><i data-lucide="trash-2"></i></button>
           </div>
           <div class="hist-title">${s.title || 'Untitled session'}</div>
-          <div class="hist-preview">${(s.transcript || '').substring(0, 80)}...</div>
+          <div class="hist-preview">${(s.preview || '').substring(0, 80)}...</div>
         `;
         
         // Delete button logic (Cloud)
@@ -513,11 +564,18 @@ document.addEventListener('DOMContentLoaded', () => {
         };
 
         // Open session logic
-        card.onclick = () => {
-          sessionId = s.id;
-          aggregatedTranscript = s.transcript || '';
-          transcriptEl.textContent = aggregatedTranscript;
-          setMode('recording');
+        card.onclick = async () => {
+          try {
+            const full = await (await fetch(apiBase + '/api/sessions/' + encodeURIComponent(s.id))).json();
+            if (full.error) throw new Error(full.error);
+            sessionId = s.id;
+            aggregatedTranscript = full.transcript || '';
+            synced = { id: s.id, chars: aggregatedTranscript.length, offset: full.length || 0 };
+            transcriptEl.textContent = aggregatedTranscript;
+            setMode('recording');
+          } catch (err) {
+            showError("Failed to open session.");
+          }
         };
         
         histList.appendChild(card);
@@ -593,6 +651,56 @@ document.addEventListener('DOMContentLoaded', () => {
     } catch (e) { showError("Snap error: " + e.message); }
   }
 
+  function renderAnswer(answer) {
+    if (window.marked) {
+      aiResponseText.innerHTML = marked.parse(answer);
+      if (window.hljs) {
+        aiResponseText.querySelectorAll('pre code').forEach((block) => {
+          hljs.highlightElement(block);
+        });
+      }
+    } else {
+      aiResponseText.innerHTML = answer
+        .replace(/\n\n/g, '<br><br>')
+        .replace(/\n/g, '<br>')
+        .replace(/\*\*(.*?)\*\*/g, '<b>$1</b>');
+    }
+  }
+
+  // Reads the /api/answer/stream SSE body, re-rendering as deltas arrive (at most once per frame).
+  async function readAnswerStream(res) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '', answer = '', error = null, pending = false;
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const frame = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = 'message', data = '';
+        for (const line of frame.split('\n')) {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        }
+        if (!data) continue;
+        const payload = JSON.parse(data);
+        if (event === 'delta') {
+          answer += payload.text;
+          if (!pending) {
+            pending = true;
+            requestAnimationFrame(() => { pending = false; renderAnswer(answer); });
+          }
+        } else if (event === 'error') {
+          error = payload.error;
+        }
+      }
+    }
+    return { answer, error };
+  }
+
   async function runAIAction(prompt, extra = {}) {
     if (!extra.imageArray || extra.imageArray.length === 0) activeCaptureDataList = [];
     setMode('result');
@@ -600,26 +708,26 @@ document.addEventListener('DOMContentLoaded', () => {
     try {
       const settings = await new Promise(r => chrome.storage.local.get(['vercelUrl', 'model'], r));
       const url = settings.vercelUrl || 'https://scribe-extension.vercel.app';
-      const res = await fetch(url + '/api/answer', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ provider: 'google', model: settings.model || 'gemini-2.5-flash', transcript: prompt, ...extra })
-      });
-      const data = await res.json();
-      if (data.answer) {
-        if (window.marked) {
-          aiResponseText.innerHTML = marked.parse(data.answer);
-          if (window.hljs) {
-            aiResponseText.querySelectorAll('pre code').forEach((block) => {
-              hljs.highlightElement(block);
-            });
-          }
-        } else {
-          aiResponseText.innerHTML = data.answer
-            .replace(/\n\n/g, '<br><br>')
-            .replace(/\n/g, '<br>')
-            .replace(/\*\*(.*?)\*\*/g, '<b>$1</b>');
+      const fields = { provider: 'google', model: settings.model || 'gemini-2.5-flash', transcript: prompt };
+      let body, headers = { 'Accept': 'text/event-stream' };
+      if (extra.imageArray && extra.imageArray.length > 0) {
+        // Send screenshots as binary parts instead of base64 strings inside JSON
+        body = new FormData();
+        for (const [k, v] of Object.entries(fields)) body.append(k, v);
+        for (const [i, dataUrl] of extra.imageArray.entries()) {
+          body.append('images', await (await fetch(dataUrl)).blob(), 'capture-' + i + '.jpg');
         }
+      } else {
+        body = JSON.stringify({ ...fields, ...extra });
+        headers['Content-Type'] = 'application/json';
+      }
+      const res = await fetch(url + '/api/answer/stream', { method: 'POST', headers, body });
+      const data = (res.headers.get('Content-Type') || '').includes('text/event-stream')
+        ? await readAnswerStream(res)
+        : await res.json();
+      if (data.answer) {
+        renderAnswer(data.answer);
+        if (data.error) showError('AI stream interrupted: ' + data.error);
       } else {
         aiResponseText.textContent = data.error || 'No response from AI.';
       }
@@ -629,11 +737,38 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   }
 
+  // Long meetings are summarized server-side (map-reduce over the synced session, cached per segment),
+  // so they don't overflow one prompt and re-summarizing only pays for what's new.
+  const LONG_TRANSCRIPT_CHARS = 12000;
+
+  async function summarizeSession(text) {
+    setMode('result');
+    aiResponseText.innerHTML = '<span class="thinking-text">Summarizing...</span>';
+    try {
+      await syncTranscript();
+      const settings = await new Promise(r => chrome.storage.local.get(['model'], r));
+      const apiBase = await getApiBase();
+      const res = await fetch(apiBase + '/api/sessions/' + encodeURIComponent(sessionId) + '/summary?provider=google&model='
+        + encodeURIComponent(settings.model || 'gemini-2.5-flash'));
+      const data = await res.json();
+      if (res.ok && data.summary) {
+        renderAnswer(data.summary);
+        logStatus("Summary: " + data.segments + " segments, " + data.cached + " cached");
+        return;
+      }
+      logStatus("Summary API " + res.status + ": " + (data.error || '').substring(0, 50));
+    } catch (e) {
+      logStatus("Summary: " + e.message);
+    }
+    runAIAction('Summarize this meeting transcript concisely in bullet points:\n' + text);
+  }
+
   processBtn.onclick = () => {
     if (currentMode === 'recording') {
       const text = transcriptEl.innerText || aggregatedTranscript;
       if (!text.trim()) { showError('No transcript to summarize yet.'); return; }
-      runAIAction('Summarize this meeting transcript concisely in bullet points:\n' + text);
+      if (aggregatedTranscript.length > LONG_TRANSCRIPT_CHARS) summarizeSession(text);
+      else runAIAction('Summarize this meeting transcript concisely in bullet points:\n' + text);
     } else if (currentMode === 'captured') {
       runAIAction('Analyze these screen captures and explain what is shown, highlight any key info.', { imageArray: activeCaptureDataList });
     }
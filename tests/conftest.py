@@ -0,0 +1,29 @@
+"""Every upstream is a bench.stubs server on localhost, started before api.index is imported so that its
+base URLs and API keys point there: nothing in the suite touches the network or spends quota."""
+import os, time
+
+import pytest
+
+from bench.stubs import StubServer, StubConfig, UPSTREAMS
+
+def _instant():
+    return {name: StubConfig(latency=0, token_ms=0) for name in UPSTREAMS}
+
+STUBS = StubServer(_instant()).start()
+os.environ.update(STUBS.env())
+
+def pytest_unconfigure(config):
+    STUBS.stop()
+
+@pytest.fixture
+def stubs():
+    """The stub server; whatever a test sets in `stubs.configs` is reset to instant, error-free answers after it."""
+    yield STUBS
+    STUBS.configs.update(_instant())
+
+def wait_until(cond, timeout=2.0):
+    """Poll `cond` until it holds, for state another thread is about to reach."""
+    end = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.005)
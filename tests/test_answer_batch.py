@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import app, _parse_sse
+from bench.stubs import StubConfig
+
+def _batch(jobs, **body):
+    r = app.test_client().post("/api/answer/batch", json={"jobs": jobs, **body}, headers={"Cache-Control": "no-cache"})
+    assert r.status_code == 200
+    events = [_parse_sse(frame) for frame in r.get_data(as_text=True).split("\n\n") if frame.startswith("event: ")]
+    return {p["index"]: p for e, p in events if e == "result"}, events[-1]
+
+def test_a_failed_job_does_not_sink_the_batch(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, error=1.0)
+    results, (event, summary) = _batch([
+        {"id": "ok", "provider": "google", "transcript": "batch: first question"},
+        {"id": "bad-image", "provider": "google", "imageBase64": "bm90IGFuIGltYWdl"},
+        {"id": "upstream-down", "provider": "openai", "transcript": "batch: second question"},
+        {"id": "ok-too", "provider": "google", "transcript": "batch: third question"},
+    ], concurrency=2)
+    assert [results[i]["id"] for i in range(4)] == ["ok", "bad-image", "upstream-down", "ok-too"]
+    assert results[0]["status"] == results[3]["status"] == 200 and results[0]["answer"] and results[3]["answer"]
+    assert results[1]["status"] == 400 and results[1]["error"] == "Invalid image data"
+    assert results[2]["status"] >= 400 and results[2]["error"]
+    assert event == "done" and summary["ok"] == 2 and summary["failed"] == 2
+
+def test_malformed_batch_is_a_bad_request():
+    r = app.test_client().post("/api/answer/batch", json={"jobs": ["not a job"]})
+    assert r.status_code == 400 and "jobs" in r.get_json()["error"]
@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+import api.index
+from api.index import app, ModelRouter
+
+def _answer(transcript, path="/api/answer", **headers):
+    return app.test_client().post(path, json={"provider": "google", "transcript": transcript}, headers=headers)
+
+def _fallback_only(monkeypatch):
+    """A fresh router whose primary (the default gemini-2.5-flash) has an open breaker, so answers come from gemini-2.0-flash."""
+    router = ModelRouter(["gemini-2.0-flash"])
+    for _ in range(3): router.record("gemini-2.5-flash", False, 0.1, RuntimeError("boom"))
+    monkeypatch.setattr(api.index, "GEMINI_ROUTER", router)
+
+def test_repeat_question_is_served_from_the_cache(stubs):
+    first, again = _answer("cache: what is a mutex?"), _answer("cache: what   is a mutex?")
+    assert first.headers["X-Cache"] == "MISS" and again.headers["X-Cache"] == "HIT"
+    assert again.get_json()["answer"] == first.get_json()["answer"]
+    assert _answer("cache: what is a mutex?", **{"Cache-Control": "no-cache"}).headers["X-Cache"] == "BYPASS"
+
+@pytest.mark.parametrize("path", ["/api/answer", "/api/answer/stream"])
+def test_fallback_answers_are_not_cached_under_the_primary(stubs, monkeypatch, path):
+    _fallback_only(monkeypatch)
+    transcript = f"cache: fallback via {path}"
+    first = _answer(transcript, path)
+    assert first.status_code == 200 and b"gemini-2.0-flash" in first.data
+    assert _answer(transcript, path).headers["X-Cache"] == "MISS"
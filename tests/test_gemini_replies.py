@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import StreamRun, _gemini_reply_text
+
+def test_reply_text_is_joined_from_parts():
+    assert _gemini_reply_text({"candidates": [{"content": {"parts": [{"text": "a"}, {"text": "b"}]}}]}) == "ab"
+
+@pytest.mark.parametrize("reply, reason", [
+    ({"candidates": [{"finishReason": "SAFETY"}]}, "SAFETY"),
+    ({"candidates": [{"content": {"parts": []}, "finishReason": "STOP"}]}, "STOP"),
+    ({"promptFeedback": {"blockReason": "OTHER"}}, "OTHER"),
+])
+def test_empty_reply_raises_so_the_router_fails_over(reply, reason):
+    with pytest.raises(ValueError, match=reason): _gemini_reply_text(reply)
+
+def test_stream_without_tokens_fails_over_to_the_next_model():
+    class Router:
+        def __init__(self): self.calls = []
+        def record(self, name, ok, *_): self.calls.append((name, ok))
+    router = Router()
+    run, frames = StreamRun("google", router), []
+    for model in run.models(["blocked", "next"]):
+        try:
+            for text in ([] if model == "blocked" else ["hi"]):
+                frames.append(run.delta(text))
+            run.require_text()
+        except Exception as e:
+            frame = run.failed(e)
+            if frame is None: continue
+            frames.append(frame); break
+        frames.append(run.done()); break
+    assert router.calls == [("blocked", False), ("next", True)]
+    assert frames[0].startswith("event: delta") and frames[-1].startswith("event: done")
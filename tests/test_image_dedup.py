@@ -0,0 +1,38 @@
+import base64
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from PIL import Image, ImageDraw
+from api.index import app, _dhash
+
+def _screen(blocks, noise=0):
+    """A 1280x720 'screenshot': a title bar and a block per (x, y) grid cell in `blocks`, with `noise` stray pixels flipped."""
+    im = Image.new("RGB", (1280, 720), "white")
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((0, 0, 1280, 60), fill="navy")
+    for x, y in blocks: draw.rectangle((160 * x, 90 * y, 160 * x + 150, 90 * y + 80), fill="black")
+    for i in range(noise): im.putpixel((300 + 7 * i, 500), (0, 0, 0))
+    return im
+
+SLIDE_ONE = [(1, 2), (2, 2), (3, 2), (1, 4)]
+SLIDE_TWO = [(5, 1), (6, 1), (5, 5), (6, 6), (7, 3)]
+
+def _b64(im):
+    buf = BytesIO()
+    im.save(buf, "PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+def test_near_identical_captures_hash_alike():
+    assert bin(_dhash(_screen(SLIDE_ONE)) ^ _dhash(_screen(SLIDE_ONE, noise=20))).count("1") <= 5
+    assert bin(_dhash(_screen(SLIDE_ONE)) ^ _dhash(_screen(SLIDE_TWO))).count("1") > 5
+
+def test_answer_drops_repeated_captures(stubs):
+    images = [_b64(_screen(SLIDE_ONE)), _b64(_screen(SLIDE_ONE, noise=20)), _b64(_screen(SLIDE_TWO))]
+    r = app.test_client().post("/api/answer", json={"provider": "google", "imageArray": images},
+                               headers={"Cache-Control": "no-cache"})
+    assert r.status_code == 200 and r.get_json()["answer"]
+    report = r.get_json()["images"]
+    assert report["images_in"] == 3 and report["images_out"] == 2 and report["duplicates_dropped"] == 1
+    assert report["bytes_out"] < report["bytes_in"]
@@ -0,0 +1,62 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from PIL import Image
+import api.index
+from api.index import app, ImageFetchCache
+
+def _png():
+    buf = BytesIO()
+    Image.new("RGB", (64, 64), "teal").save(buf, "PNG")
+    return buf.getvalue()
+
+class Origin:
+    """An image host on localhost serving one PNG with an ETag; answers a matching If-None-Match with 304."""
+    def __init__(self, cache_control):
+        origin, body = self, _png()
+        self.requests = []  # (If-None-Match sent, status returned)
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sent = self.headers.get("If-None-Match")
+                status = 304 if sent == '"v1"' else 200
+                origin.requests.append((sent, status))
+                self.send_response(status)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Cache-Control", cache_control)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", "0" if status == 304 else str(len(body)))
+                self.end_headers()
+                if status == 200: self.wfile.write(body)
+            def log_message(self, *args): pass
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/capture.png"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+@pytest.fixture
+def fetch_cache(monkeypatch):
+    cache = ImageFetchCache()
+    monkeypatch.setattr(api.index, "IMAGE_FETCH", cache)
+    return cache
+
+def _ask(url):
+    r = app.test_client().post("/api/answer", json={"provider": "google", "imageUrl": url}, headers={"Cache-Control": "no-cache"})
+    assert r.status_code == 200 and r.get_json()["answer"]
+
+def test_stale_image_is_revalidated_and_reused_on_304(stubs, fetch_cache):
+    origin = Origin("max-age=0")
+    try:
+        _ask(origin.url); _ask(origin.url)
+    finally: origin.server.shutdown()
+    assert origin.requests == [(None, 200), ('"v1"', 304)]
+    assert fetch_cache.stats()["misses"] == 1 and fetch_cache.stats()["revalidated"] == 1
+
+def test_fresh_image_is_served_without_a_request(stubs, fetch_cache):
+    origin = Origin("max-age=60")
+    try:
+        _ask(origin.url); _ask(origin.url)
+    finally: origin.server.shutdown()
+    assert origin.requests == [(None, 200)] and fetch_cache.stats()["hits"] == 1
@@ -0,0 +1,43 @@
+import time, asyncio
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import ModelRouter
+
+def _half_open(router, name):
+    """Put `name`'s breaker past its cool-down: the next allow() is its one probe."""
+    breaker = router._get(f"models/{name}").breaker
+    breaker.failures, breaker.open_until = 3, time.monotonic() - 1
+    return breaker
+
+def test_ranking_does_not_claim_a_half_open_probe():
+    router = ModelRouter(["primary", "fallback"])
+    breaker = _half_open(router, "fallback")
+    for _ in range(3): assert router.candidates("primary") == ["primary", "fallback"]
+    assert breaker.allow()  # the probe is still there for whoever calls the model
+
+def test_probe_is_claimed_only_when_the_model_is_reached():
+    router = ModelRouter(["primary", "fallback"])
+    breaker = _half_open(router, "fallback")
+    attempts = router.attempts("primary")
+    assert next(attempts) == "primary"
+    assert breaker._probe_started is None
+    assert next(attempts) == "fallback" and breaker._probe_started is not None
+    assert list(router.attempts("primary")) == ["primary"]  # probe already out: skipped
+
+def test_last_model_is_tried_when_every_breaker_refuses():
+    router = ModelRouter(["only"])
+    breaker = router._get("models/only").breaker
+    breaker.open_until = time.monotonic() + 60
+    router._catalog_at = time.monotonic()  # cached (empty) catalog: no list_models() call
+    assert list(router.attempts("only")) == ["only"]
+
+def test_async_mode_lists_models_over_the_pooled_client(stubs, monkeypatch):
+    asgi = pytest.importorskip("asgi")
+    router = ModelRouter(["gemini-2.0-flash", "not-in-catalog"])
+    monkeypatch.setattr(asgi, "GEMINI_ROUTER", router)
+    monkeypatch.setattr(router, "catalog", lambda: pytest.fail("blocking SDK listing on the event loop"))
+    for _ in range(3): router.record("gemini-9", False, 0.1, RuntimeError("boom"))
+    assert list(asyncio.run(asgi._gemini_attempts("gemini-9"))) == ["gemini-2.0-flash"]
+    assert "models/gemini-2.0-flash" in router.cached_catalog() and "models/not-in-catalog" not in router.cached_catalog()
@@ -0,0 +1,77 @@
+import time, contextvars
+
+import httpx
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import RetryPolicy, DeadlineExceeded, AdmissionRejected, begin_request_deadline, _is_rate_limited, _retry_after
+from bench.stubs import StubConfig
+
+def _chat(stubs):
+    """One non-streaming chat completion against the OpenAI stub; HTTP errors raise httpx.HTTPStatusError."""
+    r = httpx.post(f"{stubs.url}/v1/chat/completions", json={"model": "stub", "messages": []}, timeout=5)
+    r.raise_for_status()
+    return r.json()
+
+def _with_deadline(ms, fn, *args):
+    """Run fn as a request whose deadline header allows `ms` milliseconds, without leaking the deadline."""
+    def run():
+        begin_request_deadline("/api/answer", str(ms))
+        return fn(*args)
+    return contextvars.copy_context().run(run)
+
+def test_rate_limited_call_waits_for_retry_after_then_gives_up(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, ratelimit=1.0, retry_after=0.1)
+    t0 = time.monotonic()
+    with pytest.raises(httpx.HTTPStatusError) as failed: RetryPolicy(max_attempts=3, min_attempt=0)(_chat)(stubs)
+    assert _is_rate_limited(failed.value) and _retry_after(failed.value) == 0.1
+    assert stubs.stats()["openai"]["ratelimited"] == 3
+    assert time.monotonic() - t0 >= 0.2  # two waits of Retry-After, none after the last attempt
+
+def test_transient_error_is_retried_until_it_succeeds(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, error=1.0)
+    calls = []
+    def flaky():
+        calls.append(1)
+        if len(calls) == 3: stubs.configs["openai"] = StubConfig(latency=0)
+        return _chat(stubs)
+    assert RetryPolicy(max_attempts=3, base_delay=0.01, min_attempt=0)(flaky)()["choices"]
+    assert len(calls) == 3
+
+def test_retry_after_beyond_the_cap_is_not_waited_for(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, ratelimit=1.0, retry_after=60)
+    before = stubs.stats()["openai"]["calls"]
+    with pytest.raises(httpx.HTTPStatusError): RetryPolicy(max_attempts=3, max_retry_after=30)(_chat)(stubs)
+    assert stubs.stats()["openai"]["calls"] == before + 1
+
+def test_no_retry_that_could_not_finish_before_the_deadline(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, ratelimit=1.0, retry_after=0.1)
+    before = stubs.stats()["openai"]["calls"]
+    with pytest.raises(httpx.HTTPStatusError): _with_deadline(500, RetryPolicy(max_attempts=3, min_attempt=1.0)(_chat), stubs)
+    assert stubs.stats()["openai"]["calls"] == before + 1
+
+def test_retry_within_the_deadline(stubs):
+    stubs.configs["openai"] = StubConfig(latency=0, ratelimit=1.0, retry_after=0.05)
+    before = stubs.stats()["openai"]["calls"]
+    with pytest.raises(httpx.HTTPStatusError): _with_deadline(5000, RetryPolicy(max_attempts=2, min_attempt=1.0)(_chat), stubs)
+    assert stubs.stats()["openai"]["calls"] == before + 2
+
+@pytest.mark.parametrize("error", [ValueError("bad image"), DeadlineExceeded("late"), AdmissionRejected("busy", 2),
+                                   RuntimeError("generate failed"), RuntimeError("upstream said: try again later")])
+def test_fatal_errors_are_not_retried(error):
+    calls = []
+    def fail():
+        calls.append(1)
+        raise error
+    with pytest.raises(type(error)): RetryPolicy(max_attempts=3, base_delay=0)(fail)()
+    assert calls == [1]
+
+def test_typed_transport_errors_are_retried():
+    assert RetryPolicy.retryable(TimeoutError()) and RetryPolicy.retryable(ConnectionResetError())
+    assert RetryPolicy.retryable(httpx.ConnectError("refused"))
+
+def test_rate_limit_needs_a_status_type_or_whole_phrase():
+    assert not _is_rate_limited(RuntimeError("generate failed"))
+    assert not _is_rate_limited(RuntimeError("accurate transcription unavailable"))
+    assert _is_rate_limited(RuntimeError("Rate limit reached for requests"))
+    assert _is_rate_limited(RuntimeError("RESOURCE_EXHAUSTED: quota exceeded"))
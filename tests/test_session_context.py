@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import SessionContextStore, _stitch
+
+def _chunk(store, seq, text, session="s"):
+    """Run one chunk through the store the way /api/transcribe does; returns (ctx, emitted text)."""
+    ctx = store.begin(session, seq)
+    return ctx, store.commit(ctx, text)
+
+def test_overlap_at_a_chunk_boundary_is_stitched_away():
+    store = SessionContextStore()
+    _chunk(store, 0, "so tell me about")
+    ctx, text = _chunk(store, 1, "me about a time you had")
+    assert ctx["status"] == "next" and ctx["stitched_words"] == 2
+    assert text == "a time you had"
+    assert store.begin("s", 2)["prompt"] == "so tell me about a time you had"
+
+def test_a_single_repeated_word_is_kept():
+    assert _stitch("we need that", "that that works") == ("that that works", 0)
+
+def test_retried_chunk_replays_its_first_answer():
+    store = SessionContextStore()
+    _chunk(store, 0, "hello there")
+    ctx = store.begin("s", 0)
+    assert ctx["status"] == "replayed" and store.replay(ctx) == "hello there"
+    assert store.replay(store.begin("s", 1)) is None
+
+def test_gap_is_reported_and_late_chunks_are_not_stitched():
+    store = SessionContextStore()
+    _chunk(store, 0, "first part")
+    ctx, _ = _chunk(store, 3, "fourth part")
+    assert ctx["status"] == "gap" and ctx["gap"] == 2
+    ctx, text = _chunk(store, 1, "part fourth part")
+    assert ctx["status"] == "late" and text == "part fourth part"
+    assert store.begin("s", 4)["prompt"] == "first part fourth part"
+    assert store.stats()["gap"] == 1 and store.stats()["late"] == 1
+
+def test_older_clients_prompt_with_previous_text_until_the_session_has_a_tail():
+    store = SessionContextStore()
+    ctx = store.begin("s", None, "what the client heard")
+    assert ctx["status"] == "unsequenced" and ctx["prompt"] == "what the client heard"
+    store.commit(ctx, "new words")
+    assert store.begin("s", None, "what the client heard")["prompt"] == "new words"
+
+def test_only_recent_results_and_sessions_are_kept():
+    store = SessionContextStore(max_sessions=2, remember=2)
+    for seq in range(4): _chunk(store, seq, f"word{seq}")
+    assert list(store.load("s")["results"]) == ["2", "3"]
+    _chunk(store, 0, "other", session="b")
+    _chunk(store, 0, "third", session="c")
+    assert store.load("s")["last_seq"] == -1 and store.stats()["evictions"] == 1
@@ -0,0 +1,64 @@
+import math, array
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import SpeechGate, _opus_packets, _pcm_to_wav
+
+UNKNOWN_SIZE = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+CELT_20MS = 19 << 3  # TOC config 19: CELT fullband, 20 ms frames
+
+def _webm(packets):
+    """A MediaRecorder-shaped WebM: EBML header, then a Segment and a Cluster of unknown size holding one
+    SimpleBlock (track 1, no lacing) per Opus packet."""
+    blocks = b"".join(b"\xa3" + bytes([0x80 | len(p) + 4]) + b"\x81\x00\x00\x80" + p for p in packets)
+    return b"\x1a\x45\xdf\xa3\x80" + b"\x18\x53\x80\x67" + UNKNOWN_SIZE + b"\x1f\x43\xb6\x75" + UNKNOWN_SIZE + blocks
+
+def _opus(size, frames_code=0):
+    return bytes([CELT_20MS | frames_code]) + b"\x00" * (size - 1)
+
+def _pcm(seconds, amplitude, rate=16000):
+    samples = array.array("h", (int(amplitude * math.sin(2 * math.pi * 440 * i / rate)) for i in range(int(rate * seconds))))
+    return samples.tobytes()
+
+def test_opus_packets_are_sized_and_timed():
+    packets = list(_opus_packets(_webm([_opus(80), _opus(3), _opus(40, frames_code=1)])))
+    assert packets == [(80, 20), (3, 20), (40, 40)]
+
+def test_truncated_webm_stops_quietly():
+    buf = _webm([_opus(80)] * 5)
+    assert len(list(_opus_packets(buf[:-85]))) == 4  # cut between the last SimpleBlock's id and its size
+
+def test_speech_in_opus_passes_the_gate():
+    gate = SpeechGate()
+    analysis = gate.analyze(_webm([_opus(80)] * 50), "audio/webm;codecs=opus")
+    assert analysis == {"method": "opus-bitrate", "voiced_ms": 1000, "duration_ms": 1000}
+    assert not gate.is_silent(analysis)
+
+def test_silent_opus_is_skipped():
+    gate = SpeechGate()
+    analysis = gate.analyze(_webm([_opus(3)] * 45 + [_opus(80)] * 5), "audio/webm;codecs=opus")
+    assert analysis["voiced_ms"] == 100 and gate.is_silent(analysis)
+
+def test_wav_is_measured_by_frame_energy():
+    gate = SpeechGate()
+    loud = gate.analyze(_pcm_to_wav(_pcm(1.0, 8000), 16000), "audio/wav")
+    quiet = gate.analyze(_pcm_to_wav(_pcm(1.0, 0), 16000), "audio/wav")
+    assert loud == {"method": "pcm-energy", "voiced_ms": 1000, "duration_ms": 1000} and not gate.is_silent(loud)
+    assert quiet["voiced_ms"] == 0 and gate.is_silent(quiet)
+
+def test_unmeasurable_audio_is_always_transcribed():
+    gate = SpeechGate()
+    assert gate.analyze(b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 200, "audio/mp4") is None
+    assert gate.analyze(b"RIFF garbage", "audio/wav") is None
+    assert not gate.is_silent(None)
+
+def test_only_whole_chunk_hallucinations_are_dropped():
+    gate = SpeechGate()
+    assert gate.is_hallucination("Thank you.") and gate.is_hallucination("Thanks for watching! Thank you.")
+    assert not gate.is_hallucination("thank you for the question")
+    assert not gate.is_hallucination("")
+
+def test_one_word_replies_are_kept():
+    gate = SpeechGate()
+    assert not gate.is_hallucination("You.") and not gate.is_hallucination("Bye!")
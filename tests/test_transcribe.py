@@ -0,0 +1,22 @@
+import base64
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import app, _pcm_to_wav
+from tests.test_speech_gate import _pcm
+
+SPEECH = base64.b64encode(_pcm_to_wav(_pcm(1.0, 8000), 16000)).decode()
+
+def _transcribe(**fields):
+    return app.test_client().post("/api/transcribe", json={"audioBase64": SPEECH, "mimeType": "audio/wav", **fields})
+
+@pytest.mark.parametrize("budget", ["abc", "nan", "inf"])
+def test_unusable_budget_is_a_bad_request(budget):
+    r = _transcribe(sessionId="budget-bad", seq=0, budgetMs=budget)
+    assert r.status_code == 400 and "budgetMs" in r.get_json()["error"]
+
+@pytest.mark.parametrize("budget", ["-5", "0", ""])
+def test_non_positive_budget_means_the_server_default(stubs, budget):
+    r = _transcribe(sessionId=f"budget{budget}", seq=0, budgetMs=budget)
+    assert r.status_code == 200 and r.get_json()["text"]
@@ -0,0 +1,107 @@
+import time, asyncio, threading
+
+import pytest
+
+pytest.importorskip("flask")  # api.index is the Flask app
+from api.index import UpstreamGate, AdmissionRejected, _client_key
+from tests.conftest import wait_until
+
+def _waiter(gate, priority, timeout, log):
+    """Start a thread that takes a slot, notes its priority in `log` and holds the slot until released."""
+    release = threading.Event()
+    def run():
+        try:
+            with gate.admit(priority, timeout):
+                log.append(priority)
+                release.wait(2)
+        except AdmissionRejected as e:
+            log.append(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, release
+
+def test_free_slot_is_granted_at_once():
+    gate = UpstreamGate("t", max_inflight=2, max_queue=1)
+    with gate.admit(0, 1.0), gate.admit(0, 1.0): assert gate.stats()["inflight"] == 2
+    assert gate.stats()["inflight"] == 0 and gate.stats()["queued"] == 0
+
+def test_released_slot_goes_to_the_best_waiter():
+    gate, log = UpstreamGate("t", max_inflight=1, max_queue=4), []
+    granted = gate.acquire(0, 1.0)
+    low, low_release = _waiter(gate, 2, 2.0, log)
+    wait_until(lambda: gate.stats()["queued_now"] == 1)
+    high, high_release = _waiter(gate, 0, 2.0, log)
+    wait_until(lambda: gate.stats()["queued_now"] == 2)
+    gate.release(time.monotonic() - granted)
+    wait_until(lambda: log == [0])
+    high_release.set(); high.join(2)
+    wait_until(lambda: log == [0, 2])
+    low_release.set(); low.join(2)
+    assert gate.stats()["inflight"] == 0
+
+def test_full_queue_evicts_the_worst_waiter_for_a_better_one():
+    gate, log = UpstreamGate("t", max_inflight=1, max_queue=1), []
+    gate.acquire(0, 1.0)
+    low, _ = _waiter(gate, 2, 2.0, log)
+    wait_until(lambda: gate.stats()["queued_now"] == 1)
+    high, high_release = _waiter(gate, 0, 2.0, log)
+    low.join(2)
+    assert isinstance(log[0], AdmissionRejected) and "queue full" in str(log[0])
+    assert gate.stats()["evicted"] == 1 and gate.stats()["queued_now"] == 1
+    gate.release(0.0)
+    wait_until(lambda: log[1:] == [0])
+    high_release.set(); high.join(2)
+
+def test_full_queue_rejects_a_newcomer_that_does_not_outrank_it():
+    gate = UpstreamGate("t", max_inflight=1, max_queue=1)
+    gate.acquire(1, 1.0)
+    queued, queued_release = _waiter(gate, 1, 2.0, [])
+    wait_until(lambda: gate.stats()["queued_now"] == 1)
+    with pytest.raises(AdmissionRejected) as rejected: gate.acquire(1, 1.0)
+    assert rejected.value.retry_after >= 1 and gate.stats()["rejected"] == 1
+    gate.release(0.0)
+    queued_release.set(); queued.join(2)
+
+def test_wait_times_out_and_leaves_the_queue():
+    gate = UpstreamGate("t", max_inflight=1, max_queue=2)
+    gate.acquire(0, 1.0)
+    t0 = time.monotonic()
+    with pytest.raises(AdmissionRejected, match="busy"): gate.acquire(0, 0.05)
+    assert time.monotonic() - t0 >= 0.05
+    assert gate.stats()["timeouts"] == 1 and gate.stats()["queued_now"] == 0
+    gate.release(0.0)
+    assert gate.stats()["inflight"] == 0
+
+def test_async_wait_times_out_and_leaves_the_queue():
+    gate = UpstreamGate("t", max_inflight=1, max_queue=2)
+    gate.acquire(0, 1.0)
+    with pytest.raises(AdmissionRejected): asyncio.run(gate.acquire_async(0, 0.05))
+    assert gate.stats()["timeouts"] == 1 and gate.stats()["queued_now"] == 0
+
+def test_cancelled_async_waiter_frees_its_place():
+    gate = UpstreamGate("t", max_inflight=1, max_queue=2)
+    gate.acquire(0, 1.0)
+    async def cancel_waiting():
+        task = asyncio.ensure_future(gate.acquire_async(0, 2.0))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+    asyncio.run(cancel_waiting())
+    assert gate.stats()["queued_now"] == 0
+    gate.release(0.0)
+    assert gate.stats()["inflight"] == 0
+
+def test_release_once_frees_the_slot_a_single_time():
+    gate = UpstreamGate("t", max_inflight=2, max_queue=1)
+    release = gate.release_once(gate.acquire(0, 1.0))
+    gate.acquire(0, 1.0)
+    release(); release()
+    assert gate.stats()["inflight"] == 1
+
+def test_client_key_prefers_api_key_then_origin_then_address():
+    forwarded = {"X-Forwarded-For": "6.6.6.6, 203.0.113.7"}
+    assert _client_key({**forwarded, "X-API-Key": "k1"}, "10.0.0.1", 1) == _client_key({"Authorization": "Bearer k1"}, "10.0.0.2", 0)
+    assert _client_key({**forwarded, "Origin": "chrome-extension://abc"}, "10.0.0.1", 1) == "origin:chrome-extension://abc@203.0.113.7"
+    assert _client_key(forwarded, "10.0.0.1", 1) == "addr:203.0.113.7"
+    assert _client_key(forwarded, "10.0.0.1", 0) == "addr:10.0.0.1"  # no trusted proxy: the header is ignored
+    assert _client_key({"X-Forwarded-For": "203.0.113.7"}, "10.0.0.1", 2) == "addr:10.0.0.1"